@@ -0,0 +1,138 @@
+"""
+Бенчмарк длинного диалога /friend: серверная история (CONVERSATION_MEMORY=server,
+цепочка previous_response_id) против локальной с бюджетом токенов (local).
+
+Запросы идут через helpers.open_ai_helper в фейковый OpenAI из benchmarks.fakes,
+который считает входные токены вместе со всей цепочкой previous_response_id
+и добавляет задержку на каждую тысячу входных токенов. БД не нужна: история
+хранится в памяти процесса. Для каждого режима печатаются p50/p95 задержки
+и средние входные токены реплики по группам ходов, в конце - итог с учетом
+запросов на сворачивание истории.
+
+Запуск: python -m benchmarks.conversation_bench --users 10 --turns 40 --budget 3000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from benchmarks.fakes import FakeLatency, FakeOpenAI, start_server
+
+MODEL = "gpt-4o-mini"
+SUMMARY_MODEL = "gpt-5-mini"
+FIRST_USER_ID = 8_000_000
+
+
+def configure_environment(openai_url: str, budget: int) -> None:
+    """Настройки читаются при импорте модулей бота, поэтому выставляются до него"""
+    os.environ.update({
+        "BOT_TOKEN": "42:BENCHMARK",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "CONVERSATION_STORE": "memory",
+        "CONVERSATION_TOKEN_BUDGET": str(budget),
+        "CONVERSATION_SUMMARY_MODEL": SUMMARY_MODEL,
+        "RESPONSE_CACHE_ENABLED": "false",
+        "METRICS_ENABLED": "false",
+        # Учет токенов пишет в БД - в бенчмарке он только копит счетчики
+        "USAGE_FLUSH_INTERVAL": str(24 * 3600),
+        "OPENAI_RATE_LIMITS": json.dumps({model: {"rpm": 10 ** 7} for model in (MODEL, SUMMARY_MODEL)}),
+        "OPENAI_DEFAULT_RPM": str(10 ** 7),
+        "USER_MAX_PENDING": "10000",
+        "MODEL_MAX_IN_FLIGHT": "10000",
+        "MODEL_MAX_WAITING": "10000",
+    })
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def user_message(turn: int) -> str:
+    return (
+        f"Turn {turn}. Yesterday I went hiking with my friends near the lake, the weather was great "
+        f"and we talked about books, movies and our plans for the summer. What would you do in my place?"
+    )
+
+
+async def run_mode(mode: str, fake_openai: FakeOpenAI, users: list[int], turns: int, group: int) -> None:
+    from config.settings import reload_settings
+    from helpers.open_ai_helper import get_answer_from_friend, _compacting
+
+    os.environ["CONVERSATION_MEMORY"] = mode
+    reload_settings()
+    print(f"\nРежим {mode}")
+    print(f"{'ходы':>9} {'p50 мс':>8} {'p95 мс':>8} {'вход ток.':>10}")
+
+    started_total = time.perf_counter()
+    summary_before = fake_openai.input_tokens[SUMMARY_MODEL]
+    chat_before = fake_openai.input_tokens[MODEL]
+    latencies: list[float] = []
+    tokens_before = chat_before
+
+    async def ask(user_id: int, turn: int) -> None:
+        started = time.perf_counter()
+        await get_answer_from_friend(str(user_id), user_message(turn), MODEL)
+        latencies.append(time.perf_counter() - started)
+
+    for turn in range(1, turns + 1):
+        # Ход диалога у всех пользователей идет одновременно, следующий - после ответа
+        await asyncio.gather(*(ask(user, turn) for user in users))
+        if turn % group == 0 or turn == turns:
+            tokens = fake_openai.input_tokens[MODEL] - tokens_before
+            print(
+                f"{turn - len(latencies) // len(users) + 1:>4}-{turn:<4} "
+                f"{percentile(latencies, 0.5) * 1000:>8.0f} {percentile(latencies, 0.95) * 1000:>8.0f} "
+                f"{tokens / len(latencies):>10.0f}"
+            )
+            latencies = []
+            tokens_before = fake_openai.input_tokens[MODEL]
+
+    await asyncio.gather(*_compacting.values(), return_exceptions=True)
+    elapsed = time.perf_counter() - started_total
+    chat_tokens = fake_openai.input_tokens[MODEL] - chat_before
+    summary_tokens = fake_openai.input_tokens[SUMMARY_MODEL] - summary_before
+    print(
+        f"Итого за {elapsed:.1f} с: входных токенов {chat_tokens + summary_tokens} "
+        f"(диалог {chat_tokens}, сворачивание {summary_tokens})"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    latency = FakeLatency(openai=args.openai_latency, per_1k_input=args.per_1k_input)
+    fake_openai = FakeOpenAI(latency)
+    openai_runner, openai_url = await start_server(fake_openai.build_app())
+    configure_environment(openai_url, args.budget)
+
+    # Модули бота импортируются только после настройки окружения
+    from helpers.open_ai_helper import close_client, init_client
+
+    init_client()
+    for offset, mode in enumerate(args.modes):
+        # У каждого режима свои пользователи, чтобы истории не пересекались
+        start = FIRST_USER_ID + offset * args.users
+        await run_mode(mode, fake_openai, list(range(start, start + args.users)), args.turns, args.group)
+    print(f"\nВызовы OpenAI: {dict(fake_openai.calls)}")
+
+    await close_client()
+    await openai_runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--group", type=int, default=10, help="по сколько ходов сводить строки таблицы")
+    parser.add_argument("--budget", type=int, default=3000, help="CONVERSATION_TOKEN_BUDGET")
+    parser.add_argument("--modes", nargs="+", choices=["server", "local"], default=["server", "local"])
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--per-1k-input", type=float, default=0.05, help="задержка на 1000 входных токенов, с")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
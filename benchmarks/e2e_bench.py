@@ -0,0 +1,228 @@
+"""
+Сквозной бенчмарк: синтетические обновления проходят через настоящий Dispatcher
+из main.build_dispatcher со всеми middleware и роутерами, а Telegram и OpenAI
+заменены локальными фейковыми серверами из benchmarks.fakes.
+
+Нужна доступная БД из .env - бот работает с ней как обычно, посетители bench* остаются
+в таблице visitor. Сценарии прогоняются
+по очереди, для каждого печатаются пропускная способность, p50/p95/p99, запросы к БД
+на обновление и вызовы фейковых API, в конце - прирост памяти по tracemalloc.
+
+Запуск: python -m benchmarks.e2e_bench --users 50 --updates 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import statistics
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable
+
+from benchmarks.fakes import FakeLatency, FakeOpenAI, FakeTelegram, start_server
+
+BOT_TOKEN = "42:BENCHMARK"
+FIRST_USER_ID = 7_000_000
+# Модели, для которых снимаются клиентские лимиты - мерить нужно бота, а не ограничитель
+MODELS = ["gpt-4o-mini", "gpt-4o", "gpt-5.1", "gpt-5-mini", "o4-mini", "whisper-1", "tts-1"]
+
+_update_ids = itertools.count(1)
+
+
+class ErrorCounter(logging.Handler):
+    """Обработчики ловят исключения и пишут их в лог - считаем их здесь"""
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+
+
+def configure_environment(openai_url: str, users: list[int]) -> None:
+    """Настройки читаются при импорте модулей бота, поэтому выставляются до него"""
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "OPENAI_API_KEY": "sk-benchmark",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "DRY_MODE": "false",
+        "ADMINS": "",
+        "USERNAMES": ",".join(f"bench{user}" for user in users),
+        "RESPONSE_CACHE_ENABLED": "false",
+        "METRICS_ENABLED": "false",
+        "OPENAI_RATE_LIMITS": json.dumps({model: {"rpm": 10 ** 7} for model in MODELS}),
+        "OPENAI_DEFAULT_RPM": str(10 ** 7),
+        "USER_MAX_PENDING": "10000",
+        "MODEL_MAX_IN_FLIGHT": "10000",
+        "MODEL_MAX_WAITING": "10000",
+    })
+
+
+def make_message(user_id: int, **content: Any) -> dict[str, Any]:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"},
+            **content,
+        },
+    }
+
+
+def text_update(user_id: int) -> dict[str, Any]:
+    # Разный текст, чтобы запросы не совпадали
+    return make_message(user_id, text=f"Расскажи что-нибудь интересное, запрос {next(_update_ids)}")
+
+
+def voice_update(user_id: int) -> dict[str, Any]:
+    voice = {"file_id": f"voice{user_id}", "file_unique_id": f"u{user_id}", "duration": 5, "mime_type": "audio/ogg"}
+    return make_message(user_id, voice=voice)
+
+
+def command_update(user_id: int, command: str) -> dict[str, Any]:
+    return make_message(user_id, text=command, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+
+# Сценарий: команда, переводящая пользователя в нужный режим, и генератор измеряемых обновлений
+SCENARIOS: dict[str, tuple[str, Callable[[int], dict[str, Any]]]] = {
+    "text": ("/cancel", text_update),
+    "voice": ("/cancel", voice_update),
+    "friend_text": ("/friend", text_update),
+    "friend_voice": ("/friend", voice_update),
+    "teacher_voice": ("/teacher", voice_update),
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(
+        name: str,
+        bot: Any,
+        dp: Any,
+        users: list[int],
+        updates: int,
+        concurrency: int,
+        queries: Counter[str],
+        errors: ErrorCounter,
+) -> None:
+    command, make_update = SCENARIOS[name]
+    await asyncio.gather(*(dp.feed_raw_update(bot, command_update(user, command)) for user in users))
+
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(update: dict[str, Any]) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await dp.feed_raw_update(bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    batch = [make_update(users[i % len(users)]) for i in range(updates)]
+    queries_before = queries["total"]
+    errors_before = errors.count
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(update) for update in batch))
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{name:>14} {updates / elapsed:>8.1f} {percentile(latencies, 0.5) * 1000:>8.0f} "
+        f"{percentile(latencies, 0.95) * 1000:>8.0f} {percentile(latencies, 0.99) * 1000:>8.0f} "
+        f"{statistics.mean(latencies) * 1000:>8.0f} {(queries['total'] - queries_before) / updates:>10.2f} "
+        f"{errors.count - errors_before:>7}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    latency = FakeLatency(
+        telegram=args.telegram_latency,
+        openai=args.openai_latency,
+        deltas=args.deltas,
+        delta_interval=args.delta_interval,
+    )
+    fake_telegram = FakeTelegram(latency)
+    fake_openai = FakeOpenAI(latency)
+    telegram_runner, telegram_url = await start_server(fake_telegram.build_app())
+    openai_runner, openai_url = await start_server(fake_openai.build_app())
+
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    configure_environment(openai_url, users)
+
+    # Модули бота импортируются только после настройки окружения
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from sqlalchemy import event
+
+    from main import build_dispatcher
+    from service.database import start_db_async, get_engine_async
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    await start_db_async()
+    queries: Counter[str] = Counter()
+
+    def count_query(*_: Any) -> None:
+        queries["total"] += 1
+
+    event.listen(get_engine_async().sync_engine, "before_cursor_execute", count_query)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(telegram_url))
+    bot = Bot(token=BOT_TOKEN, session=session)
+    dp = build_dispatcher()
+    await dp.emit_startup(bot=bot)
+
+    # Прогрев: посетители заводятся в БД, соединения открываются
+    await asyncio.gather(*(dp.feed_raw_update(bot, command_update(user, "/start")) for user in users))
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    snapshot_before = tracemalloc.take_snapshot()
+
+    print(f"{'сценарий':>14} {'upd/s':>8} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'ср. мс':>8} {'SQL/upd':>10} {'ошибок':>7}")
+    for name in args.scenarios:
+        await run_scenario(name, bot, dp, users, args.updates, args.concurrency, queries, errors)
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().compare_to(snapshot_before, "lineno")[:5]
+    tracemalloc.stop()
+    print(
+        f"\nПамять: прирост {(memory_after - memory_before) / 1024:.0f} КБ, "
+        f"пик {memory_peak / 1024:.0f} КБ"
+    )
+    for stat in top:
+        print(f"  {stat}")
+    print(f"\nВызовы Telegram: {dict(fake_telegram.calls)}")
+    print(f"Вызовы OpenAI: {dict(fake_openai.calls)}")
+
+    await dp.emit_shutdown(bot=bot)
+    await session.close()
+    await telegram_runner.cleanup()
+    await openai_runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=100, help="обновлений на сценарий")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--deltas", type=int, default=40)
+    parser.add_argument("--delta-interval", type=float, default=0.02)
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
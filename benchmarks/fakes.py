@@ -0,0 +1,201 @@
+"""
+Локальные фейковые серверы Telegram Bot API и OpenAI для сквозного бенчмарка.
+
+Оба отвечают минимально достаточными для aiogram и SDK OpenAI данными,
+с настраиваемой задержкой, и считают вызовы по методам.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import web
+
+
+@dataclass
+class FakeLatency:
+    telegram: float = 0.05
+    openai: float = 0.3
+    # Поток ответа: сколько дельт и пауза между ними
+    deltas: int = 40
+    delta_interval: float = 0.02
+    whisper: float = 0.5
+    tts: float = 0.4
+    # Дополнительная задержка на каждую тысячу входных токенов, включая историю previous_response_id
+    per_1k_input: float = 0.0
+
+
+class FakeTelegram:
+    """Bot API: /bot<token>/<method> и скачивание файлов /file/bot<token>/<path>"""
+
+    def __init__(self, latency: FakeLatency, file_size: int = 32 * 1024):
+        self.latency = latency
+        self.file_size = file_size
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.method_handler)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file_handler)
+        return app
+
+    async def method_handler(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        fields = await request.post()
+        await asyncio.sleep(self.latency.telegram)
+        return web.json_response({"ok": True, "result": self._result(method, fields)})
+
+    async def file_handler(self, request: web.Request) -> web.StreamResponse:
+        self.calls["download"] += 1
+        await asyncio.sleep(self.latency.telegram)
+        response = web.StreamResponse()
+        response.content_type = "audio/ogg"
+        await response.prepare(request)
+        chunk = b"\0" * 16 * 1024
+        for _ in range(self.file_size // len(chunk)):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    def _result(self, method: str, fields: Any) -> Any:
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getFile":
+            return {
+                "file_id": fields.get("file_id"),
+                "file_unique_id": "unique",
+                "file_size": self.file_size,
+                "file_path": "voice/file.oga",
+            }
+        if method in ("sendMessage", "editMessageText", "sendVoice", "sendAudio"):
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(fields.get("chat_id", 0)), "type": "private"},
+                "text": fields.get("text", ""),
+            }
+        return True
+
+
+class FakeOpenAI:
+    """
+    Responses API (обычный и потоковый), транскрипция и синтез речи.
+
+    Входные токены считаются как у настоящего API: сам вход плюс вся цепочка
+    previous_response_id, поэтому рост серверной истории виден в usage и задержке.
+    """
+
+    def __init__(self, latency: FakeLatency):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+        # Токены истории, которую продолжает каждый сохраненный ответ
+        self._context_tokens: dict[str, int] = {}
+        self.input_tokens: Counter[str] = Counter()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/responses", self.responses_handler)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions_handler)
+        app.router.add_post("/v1/audio/speech", self.speech_handler)
+        return app
+
+    async def responses_handler(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls["responses"] += 1
+        model = body.get("model", "gpt-4o-mini")
+        words = [f"слово{i}" for i in range(self.latency.deltas)]
+        input_tokens = self._input_tokens(body)
+        self.input_tokens[model] += input_tokens
+        await asyncio.sleep(self.latency.openai + self.latency.per_1k_input * input_tokens / 1000)
+        if not body.get("stream"):
+            return web.json_response(self._response(model, " ".join(words), input_tokens, body.get("store")))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for sequence, word in enumerate(words):
+            event = {
+                "type": "response.output_text.delta",
+                "item_id": "msg_1",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": word + " ",
+                "sequence_number": sequence,
+            }
+            await response.write(self._sse(event))
+            await asyncio.sleep(self.latency.delta_interval)
+        completed = {
+            "type": "response.completed",
+            "response": self._response(model, " ".join(words), input_tokens, body.get("store")),
+            "sequence_number": len(words),
+        }
+        await response.write(self._sse(completed))
+        await response.write_eof()
+        return response
+
+    async def transcriptions_handler(self, request: web.Request) -> web.Response:
+        self.calls["transcriptions"] += 1
+        await request.read()
+        await asyncio.sleep(self.latency.whisper)
+        return web.Response(text="Привет, это тестовое голосовое сообщение для бенчмарка")
+
+    async def speech_handler(self, request: web.Request) -> web.Response:
+        self.calls["speech"] += 1
+        await request.read()
+        await asyncio.sleep(self.latency.tts)
+        return web.Response(body=b"\0" * 8 * 1024, content_type="audio/ogg")
+
+    def _input_tokens(self, body: dict[str, Any]) -> int:
+        request_input = body.get("input", "")
+        if not isinstance(request_input, str):
+            request_input = " ".join(str(item.get("content", "")) for item in request_input)
+        return len(request_input) // 4 + self._context_tokens.get(body.get("previous_response_id") or "", 0)
+
+    def _response(self, model: str, text: str, input_tokens: int = 50, store: bool = True) -> dict[str, Any]:
+        output_tokens = len(text) // 3
+        response_id = f"resp_{next(self._ids)}"
+        if store is not False:
+            self._context_tokens[response_id] = input_tokens + output_tokens
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": "completed",
+            "model": model,
+            "output": [{
+                "type": "message",
+                "id": "msg_1",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    @staticmethod
+    def _sse(event: dict[str, Any]) -> bytes:
+        return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+
+
+async def start_server(app: web.Application) -> tuple[web.AppRunner, str]:
+    """Поднимает приложение на свободном порту 127.0.0.1 и возвращает его базовый адрес"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="127.0.0.1", port=0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    return runner, f"http://127.0.0.1:{port}"
@@ -0,0 +1,43 @@
+"""
+Микробенчмарк нарезки длинных ответов на сообщения.
+
+Запуск: python -m benchmarks.markdown_bench
+"""
+import random
+import timeit
+
+from helpers.markdown_helper import split_markdown, tg_len
+
+PARAGRAPH = (
+    "Вот **важный** момент: функция `get_visitor` берет *кэш*, а потом идет в БД. "
+    "Подробнее [в документации](https://docs.sqlalchemy.org/en/20/). Цена 1.5$ (примерно)!"
+)
+CODE = "```python\nasync def handler(message: Message) -> None:\n    await message.answer(\"ok\")  # `tick`\n```"
+LIST = "- первый пункт\n- второй пункт с __акцентом__\n1. нумерованный"
+
+
+def make_response(size: int, seed: int = 0) -> str:
+    """Ответ модели примерно заданного размера из абзацев, списков и блоков кода"""
+    rng = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        block = rng.choice([PARAGRAPH, PARAGRAPH, LIST, CODE, "## Заголовок"])
+        blocks.append(block)
+        length += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def main() -> None:
+    print(f"{'размер':>8} {'кусков':>7} {'макс. длина':>12} {'мс на ответ':>12}")
+    for size in (2_000, 8_000, 32_000, 128_000):
+        text = make_response(size)
+        chunks = split_markdown(text)
+        assert all(tg_len(chunk.text) <= 4096 for chunk in chunks)
+        number = max(1, 200_000 // size)
+        seconds = timeit.timeit(lambda: split_markdown(text), number=number) / number
+        print(f"{len(text):>8} {len(chunks):>7} {max(tg_len(c.text) for c in chunks):>12} {seconds * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
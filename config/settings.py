@@ -1,13 +1,18 @@
+import re
+from functools import cached_property
+from typing import Optional
+
 from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class CommonSettings(BaseSettings):
-    """Общие настройки"""
+    """Общие настройки. Загружаются один раз через get_settings"""
     model_config = SettingsConfigDict(
         env_file='.env',
         env_file_encoding='utf-8',
-        extra="allow"
+        extra="allow",
+        frozen=True
     )
 
     ADMINS: str
@@ -16,6 +21,141 @@ class CommonSettings(BaseSettings):
     OPENAI_API_KEY: str
     DRY_MODE: bool
 
+    # Кэш посетителей локален для процесса. Смена статуса и модели рассылается другим репликам
+    # через Postgres NOTIFY (VISITOR_CACHE_NOTIFY). Пока слушатель переподключается или если
+    # уведомления выключены, изменение доходит до других реплик не позже VISITOR_CACHE_TTL
+    VISITOR_CACHE_SIZE: int = 10000
+    VISITOR_CACHE_TTL: float = 300.0
+    VISITOR_CACHE_NEGATIVE_TTL: float = 5.0
+    VISITOR_CACHE_NOTIFY: bool = True
+    VISITOR_CACHE_RECONNECT_DELAY: float = 5.0
+
+    # memory - только в памяти процесса, postgres - память + таблица conversation_state
+    CONVERSATION_STORE: str = "postgres"
+    CONVERSATION_CACHE_SIZE: int = 10000
+    CONVERSATION_IDLE_TTL: float = 3600.0
+    # В режиме postgres кэш процесса держит response_id недолго: диалог могут продолжить в другой реплике
+    CONVERSATION_SHARED_CACHE_TTL: float = 2.0
+    CONVERSATION_TTL: float = 7 * 24 * 3600.0
+    # server - цепочка previous_response_id на стороне OpenAI, local - своя история с бюджетом токенов:
+    # в запрос идут краткое содержание и последние реплики, старые сворачиваются в содержание в фоне
+    CONVERSATION_MEMORY: str = "server"
+    CONVERSATION_TOKEN_BUDGET: int = 3000
+    CONVERSATION_TOKEN_BUDGETS: dict[str, int] = {}
+    CONVERSATION_SUMMARY_MODEL: str = "gpt-5-mini"
+    CONVERSATION_SUMMARY_MAX_CHARS: int = 2000
+
+    # Хранилище FSM: memory - только в процессе, postgres - общее для реплик и переживает рестарт.
+    # Состояние в postgres читается и пишется напрямую, кэш и отложенная запись - только для данных
+    FSM_STORAGE: str = "memory"
+    FSM_CACHE_SIZE: int = 10000
+    FSM_CACHE_TTL: float = 10.0
+    FSM_FLUSH_INTERVAL: float = 0.5
+    FSM_TTL: float = 30 * 24 * 3600.0
+
+    # Потоковая выдача ответов: одно сообщение редактируется по мере генерации
+    STREAMING_ENABLED: bool = True
+    STREAM_EDIT_INTERVAL: float = 1.5
+    STREAM_MIN_EDIT_CHARS: int = 20
+
+    # Расход токенов по посетителям копится в памяти и пишется в token_usage раз в интервал
+    USAGE_FLUSH_INTERVAL: float = 10.0
+
+    # Рассылки и уведомления админам: Telegram пускает ~30 сообщений в секунду всего и ~1 в секунду в один чат
+    FANOUT_GLOBAL_PER_SECOND: float = 25.0
+    FANOUT_PER_CHAT_PER_SECOND: float = 1.0
+    FANOUT_CONCURRENCY: int = 20
+    FANOUT_MAX_ATTEMPTS: int = 3
+
+    # Фоновые задачи deep research: опрос OpenAI с интервалом от RESEARCH_POLL_MIN, растущим до RESEARCH_POLL_MAX
+    RESEARCH_CONCURRENCY: int = 4
+    RESEARCH_BATCH_SIZE: int = 50
+    RESEARCH_POLL_MIN: float = 5.0
+    RESEARCH_POLL_MAX: float = 60.0
+    RESEARCH_POLL_BACKOFF: float = 1.5
+    RESEARCH_SUBMIT_LEASE: float = 300.0
+
+    # Метрики Prometheus: /metrics на отдельном порту в обоих режимах. Там расход по пользователям,
+    # поэтому порт не публикуется наружу (в compose открыт только порт вебхука)
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = "0.0.0.0"
+    METRICS_PORT: int = 9100
+
+    # polling - для локальной разработки, webhook - для продакшена и нескольких реплик
+    BOT_MODE: str = "polling"
+    WEBHOOK_BASE_URL: str = ""
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    # Каждая реплика ставит вебхук при старте. Сброс очереди обновлений при этом выкинул бы
+    # обновления, которые ждут еще работающие реплики, поэтому включать только на разовый деплой
+    WEBHOOK_DROP_PENDING_UPDATES: bool = False
+
+    # Очереди запросов к OpenAI
+    USER_MAX_PENDING: int = 3
+    SCHEDULER_MAX_PENDING: int = 500
+    MODEL_MAX_IN_FLIGHT: int = 20
+    MODEL_IN_FLIGHT_LIMITS: dict[str, int] = {}
+    MODEL_MAX_WAITING: int = 200
+
+    # Каталог моделей и выбор модели для варианта auto по наблюдаемой задержке и доле ошибок
+    MODEL_CATALOG_PATH: str = "gpt_models.json"
+    ROUTER_WINDOW_SIZE: int = 200
+    ROUTER_WINDOW_SECONDS: float = 600.0
+    ROUTER_MIN_SAMPLES: int = 5
+    ROUTER_MAX_ERROR_RATE: float = 0.2
+    # Модель считается медленной, если p95 превышает ее latency_target из каталога во столько раз
+    ROUTER_SLOW_FACTOR: float = 1.5
+    ROUTER_LONG_PROMPT_TOKENS: int = 500
+
+    # Устойчивость запросов к моделям: если основная модель не ответила за HEDGE_PERCENTILE
+    # своей задержки, параллельно уходит запрос к запасной (fallback из каталога), побеждает первый.
+    # Срок ответа (deadline) задается для каждой модели в каталоге
+    HEDGE_ENABLED: bool = True
+    HEDGE_PERCENTILE: float = 0.95
+    HEDGE_MIN_DELAY: float = 1.0
+    BREAKER_FAILURES: int = 5
+    BREAKER_COOLDOWN: float = 30.0
+
+    # Кэш ответов на запросы без истории диалога
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_PERSISTENT: bool = False
+    RESPONSE_CACHE_SIZE: int = 5000
+    RESPONSE_CACHE_MAX_ENTRY_CHARS: int = 20000
+    RESPONSE_CACHE_TTL: float = 3600.0
+    RESPONSE_CACHE_TTLS: dict[str, float] = {}
+    RESPONSE_CACHE_WEB_SEARCH: bool = False
+
+    # Озвучка ответов: по предложениям, параллельно, голосовыми сообщениями
+    TTS_MODEL: str = "tts-1"
+    TTS_VOICE: str = "alloy"
+    TTS_FORMAT: str = "opus"
+    TTS_PARALLELISM: int = 3
+    TTS_FIRST_SEGMENT_CHARS: int = 200
+    TTS_SEGMENT_CHARS: int = 800
+    # Кэш озвученных фраз ограничен суммарным размером аудио: длина фрагментов бывает разной
+    TTS_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    TTS_CACHE_TTL: float = 24 * 3600.0
+
+    # Голосовые, аудио и кружочки: лимиты проверяются до скачивания, файл передается в whisper потоком.
+    # Bot API отдает ботам файлы не больше 20 МБ
+    VOICE_STREAMING: bool = True
+    MAX_VOICE_DURATION: int = 3600
+    MAX_VOICE_SIZE: int = 20 * 1024 * 1024
+    VOICE_STREAM_CHUNK_SIZE: int = 64 * 1024
+    VOICE_STREAM_BUFFER_CHUNKS: int = 4
+
+    # Длинные записи режутся ffmpeg по паузам и транскрибируются параллельно
+    SEGMENT_THRESHOLD: int = 180
+    SEGMENT_SECONDS: float = 90.0
+    SEGMENT_SEARCH_WINDOW: float = 15.0
+    SEGMENT_OVERLAP_SECONDS: float = 1.5
+    SEGMENT_SILENCE_DB: int = -30
+    SEGMENT_MIN_SILENCE: float = 0.4
+    TRANSCRIBE_PARALLELISM: int = 4
+
     @field_validator("USERNAMES")
     def check_username(cls, usernames: str) -> str:
         names = [i.strip() for i in usernames.strip().split(",")]
@@ -23,6 +163,36 @@ class CommonSettings(BaseSettings):
             raise ValueError("Не указаны имена пользователей")
         return " ".join(names)
 
+    @cached_property
+    def admins(self) -> frozenset[str]:
+        return _parse_usernames(self.ADMINS)
+
+    @cached_property
+    def usernames(self) -> frozenset[str]:
+        return _parse_usernames(self.USERNAMES)
+
+
+def _parse_usernames(value: str) -> frozenset[str]:
+    return frozenset(name.lstrip("@") for name in re.split(r"[\s,]+", value) if name.strip())
+
+
+_settings: Optional[CommonSettings] = None
+
+
+def get_settings() -> CommonSettings:
+    """Возвращает закэшированные настройки, читая .env только при первом вызове"""
+    global _settings
+    if _settings is None:
+        _settings = CommonSettings()
+    return _settings
+
+
+def reload_settings() -> CommonSettings:
+    """Перечитывает .env. Вызывается по SIGHUP или командой админа /reload"""
+    global _settings
+    _settings = CommonSettings()
+    return _settings
+
 
 class PGSettings(BaseSettings):
     """Настройки для подключения к БД"""
@@ -38,8 +208,62 @@ class PGSettings(BaseSettings):
     POSTGRES_DB: str
     PG_PORT: str
 
+    PG_POOL_SIZE: int = 10
+    PG_MAX_OVERFLOW: int = 10
+    PG_POOL_RECYCLE: int = 1800
+    PG_POOL_TIMEOUT: float = 30.0
+    PG_POOL_PRE_PING: bool = False
+    PG_STATEMENT_CACHE_SIZE: int = 100
+    # Сколько соединений открыть заранее при старте, чтобы первый запрос не ждал подключения
+    PG_PREWARM_CONNECTIONS: int = 4
+    # upgrade - накатить миграции alembic, если версия схемы отстает, check - только проверить
+    PG_SCHEMA_MODE: str = "upgrade"
+
     def db_connection_sync(self) -> str:
         return f"postgresql+psycopg2://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_URL}:{self.PG_PORT}/{self.POSTGRES_DB}"
 
     def db_connection_async(self) -> str:
         return f"postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_URL}:{self.PG_PORT}/{self.POSTGRES_DB}"
+
+
+class OpenAISettings(BaseSettings):
+    """Настройки клиента OpenAI"""
+    model_config = SettingsConfigDict(
+        env_file='.env',
+        env_file_encoding='utf-8',
+        extra="allow"
+    )
+
+    OPENAI_API_KEY: str
+    # Другой адрес API, например локальный фейковый сервер в benchmarks
+    OPENAI_BASE_URL: Optional[str] = None
+    OPENAI_HTTP2: bool = False
+    OPENAI_MAX_CONNECTIONS: int = 100
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    OPENAI_KEEPALIVE_EXPIRY: float = 60.0
+    OPENAI_CONNECT_TIMEOUT: float = 5.0
+    OPENAI_CHAT_TIMEOUT: float = 600.0
+    OPENAI_WHISPER_TIMEOUT: float = 120.0
+    OPENAI_TTS_TIMEOUT: float = 60.0
+
+    # Лимиты вида {"gpt-5.1": {"rpm": 500, "tpm": 500000}} поверх значений по умолчанию
+    OPENAI_RATE_LIMITS: dict[str, dict[str, int]] = {}
+    OPENAI_DEFAULT_RPM: int = 500
+    OPENAI_DEFAULT_TPM: int = 0
+    OPENAI_RATE_HEADROOM: float = 0.9
+    OPENAI_EXPECTED_OUTPUT_TOKENS: int = 1000
+    OPENAI_RETRY_BUDGET: float = 30.0
+    OPENAI_MAX_ATTEMPTS: int = 5
+    OPENAI_BACKOFF_BASE: float = 0.5
+    OPENAI_BACKOFF_CAP: float = 8.0
+
+
+_openai_settings: Optional[OpenAISettings] = None
+
+
+def get_openai_settings() -> OpenAISettings:
+    """Настройки клиента OpenAI. Читаются при первом обращении, а не при импорте модулей"""
+    global _openai_settings
+    if _openai_settings is None:
+        _openai_settings = OpenAISettings()
+    return _openai_settings
@@ -1,8 +1,9 @@
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
 from typing import Optional
 
-from sqlalchemy import MetaData, BigInteger, func
+from sqlalchemy import MetaData, BigInteger, Index, func, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -26,8 +27,22 @@ class Status(Enum):
     VERIFIED = 3
 
 
+class JobStatus(Enum):
+    QUEUED = "queued"
+    SUBMITTING = "submitting"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
 class Visitor(Base):
     __tablename__ = "visitor"
+    __table_args__ = (
+        # Постраничный /users: фильтр по статусу с сортировкой по chat_id и поиск по началу ника
+        Index("visitor_status_chat_id_idx", "status", "chat_id"),
+        Index("visitor_username_lower_idx", text("lower(username) text_pattern_ops")),
+    )
 
     chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     is_admin: Mapped[bool] = mapped_column(default=False)
@@ -55,3 +70,94 @@ class Visitor(Base):
 
     def __str__(self):
         return f"{self.full_name} @{self.username} со {Status(self.status)} и моделью {self.model}"
+
+
+class TokenUsage(Base):
+    """Расход токенов посетителя на модель за сутки (UTC). Пишется пачками из UsageLedger"""
+    __tablename__ = "token_usage"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    model: Mapped[str] = mapped_column(primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True, index=True)
+    requests: Mapped[int] = mapped_column(default=0)
+    input_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    output_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    reasoning_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<TokenUsage(user_id={self.user_id}, model={self.model}, day={self.day}, requests={self.requests})>"
+
+
+class ConversationState(Base):
+    """Последний response_id пользователя для продолжения диалога через previous_response_id"""
+    __tablename__ = "conversation_state"
+
+    user_id: Mapped[str] = mapped_column(primary_key=True)
+    response_id: Mapped[str] = mapped_column()
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ConversationState(user_id={self.user_id}, response_id={self.response_id})>"
+
+
+class ConversationTranscript(Base):
+    """Локальная история диалога: краткое содержание старых реплик и последние реплики целиком"""
+    __tablename__ = "conversation_transcript"
+
+    user_id: Mapped[str] = mapped_column(primary_key=True)
+    summary: Mapped[str] = mapped_column(default="")
+    turns: Mapped[list] = mapped_column(JSONB, default=list)
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<ConversationTranscript(user_id={self.user_id}, turns={len(self.turns)})>"
+
+
+class CachedResponse(Base):
+    """Ответ модели на запрос без истории. key - sha256 нормализованного запроса"""
+    __tablename__ = "response_cache"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    model: Mapped[str] = mapped_column()
+    text: Mapped[str] = mapped_column()
+    response_id: Mapped[Optional[str]] = mapped_column()
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+    created_at: Mapped[Optional[datetime]] = mapped_column(server_default=func.now())
+
+    def __repr__(self):
+        return f"<CachedResponse(key={self.key}, model={self.model}, expires_at={self.expires_at})>"
+
+
+class FSMRecord(Base):
+    """Состояние и данные FSM aiogram. key собирается из StorageKey"""
+    __tablename__ = "fsm_state"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column()
+    data: Mapped[dict] = mapped_column(JSONB, default=dict)
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<FSMRecord(key={self.key}, state={self.state})>"
+
+
+class ResearchJob(Base):
+    """Долгий запрос к модели в фоновом режиме OpenAI. Переживает рестарт бота"""
+    __tablename__ = "research_job"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    model: Mapped[str] = mapped_column()
+    prompt: Mapped[str] = mapped_column()
+    status: Mapped[str] = mapped_column(default=JobStatus.QUEUED.value, index=True)
+    response_id: Mapped[Optional[str]] = mapped_column()
+    error: Mapped[Optional[str]] = mapped_column()
+    poll_interval: Mapped[float] = mapped_column(default=0.0)
+    next_poll_at: Mapped[datetime] = mapped_column(server_default=func.now(), index=True)
+    created_at: Mapped[Optional[datetime]] = mapped_column(server_default=func.now())
+    updated_at: Mapped[Optional[datetime]] = mapped_column(server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ResearchJob(id={self.id}, user_id={self.user_id}, model={self.model}, status={self.status})>"
@@ -1,33 +1,201 @@
+import math
+import re
+from dataclasses import dataclass
 from re import Match
-from typing import List
+from typing import List, Optional
 
 from aiogram import Router, F
-from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
 
+from config.settings import reload_settings
 from domain.models import Status, Visitor
+from helpers.fanout import FanOutResult, get_fanout
+from helpers.model_router import get_model_router
+from helpers.open_ai_helper import get_rate_limiter
+from helpers.resilience import get_resilience
+from helpers.response_cache import get_response_cache
+from helpers.scheduler import get_scheduler
+from helpers.tghelper import Paginator
 from middlware.is_admin_middleware import Authorize
-from service.visitor_actions import get_visitor, change_visitor_status, get_all_visitors
+from service.conversation_memory import get_conversation_memory, is_local_memory
+from service.conversation_store import get_conversation_store
+from service.database import get_pool_stats
+from service.fsm_storage import PostgresStorage
+from service.usage_ledger import get_usage_ledger
+from service.visitor_actions import get_visitor, change_visitor_status, get_visitor_cache, count_visitors, \
+    get_visitors_page, iter_visitor_chat_ids
 
 router = Router()
 router.message.middleware(Authorize())
 router.callback_query.middleware(Authorize())
 
 
+USERS_PAGE_SIZE = 10
+USERS_CALLBACK = "users"
+# callback_data ограничена 64 байтами, из них "users <страница> <страница> " занимает до 16.
+# Префикс ника обрезается по байтам UTF-8: кириллица занимает по два
+MAX_QUERY_IN_CALLBACK = 48
+
+
+@dataclass(frozen=True)
+class UsersQuery:
+    """Фильтр /users и ключи текущей страницы: chat_id первого и последнего посетителя"""
+    status: Optional[Status] = None
+    prefix: str = ""
+    first: Optional[int] = None
+    last: Optional[int] = None
+
+    def pack(self) -> str:
+        status = self.status.value if self.status else ""
+        first = "" if self.first is None else self.first
+        last = "" if self.last is None else self.last
+        keys = f"{first}:{last}:{status}:"
+        budget = max(0, MAX_QUERY_IN_CALLBACK - len(keys.encode()))
+        return keys + self.prefix.encode()[:budget].decode(errors="ignore")
+
+    @classmethod
+    def unpack(cls, value: str) -> "UsersQuery":
+        first, last, status, prefix = value.split(":", 3)
+        return cls(
+            status=Status(int(status)) if status else None,
+            prefix=prefix,
+            first=int(first) if first else None,
+            last=int(last) if last else None,
+        )
+
+
+def parse_users_filter(args: Optional[str]) -> UsersQuery:
+    """/users [processing|declined|verified] [@начало_ника]"""
+    status = None
+    prefix = ""
+    for arg in (args or "").split():
+        if arg.upper() in Status.__members__:
+            status = Status[arg.upper()]
+        else:
+            prefix = re.sub(r"\W", "", arg)
+    return UsersQuery(status, prefix)
+
+
 def format_visitors(visitors: List[Visitor]) -> str:
-    result = "Список пользователей:\n\n"
-    for visitor in visitors:
-        result += f"{str(visitor)}\n/allow{visitor.chat_id}\n/decline{visitor.chat_id}\n\n"
-    return result
+    return "\n\n".join(
+        f"{str(visitor)}\n/allow{visitor.chat_id}\n/decline{visitor.chat_id}" for visitor in visitors
+    )
+
+
+async def render_users_page(query: UsersQuery, page: int, current_page: int) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Переходит на страницу page от текущей по ключам query: на соседнюю - просто за ключом,
+    на дальнюю из видимых на клавиатуре - с пропуском нескольких страниц за ключом
+    """
+    total = await count_visitors(query.status, query.prefix)
+    if total == 0:
+        return "Пользователи не найдены", None
+    pages = math.ceil(total / USERS_PAGE_SIZE)
+    if page > pages:
+        # Пока листали, часть посетителей ушла из выборки - показываем последнюю страницу
+        page, query = pages, UsersQuery(query.status, query.prefix)
+    if page > current_page and query.last is not None:
+        visitors = await get_visitors_page(
+            USERS_PAGE_SIZE, query.status, query.prefix,
+            after=query.last, skip=(page - current_page - 1) * USERS_PAGE_SIZE
+        )
+    elif page < current_page and query.first is not None:
+        visitors = await get_visitors_page(
+            USERS_PAGE_SIZE, query.status, query.prefix,
+            before=query.first, skip=(current_page - page - 1) * USERS_PAGE_SIZE
+        )
+    else:
+        visitors = await get_visitors_page(
+            USERS_PAGE_SIZE, query.status, query.prefix, skip=(page - 1) * USERS_PAGE_SIZE
+        )
+    paginator = Paginator(page, visitors, visible_results=USERS_PAGE_SIZE, total=total)
+    keys = UsersQuery(query.status, query.prefix, visitors[0].chat_id, visitors[-1].chat_id) if visitors else query
+    text = paginator.result_message() + format_visitors(paginator.get_objects_on_page())
+    return text, paginator.create_keyboard(f"{USERS_CALLBACK} {page}", keys.pack())
 
 
 @router.message(Command("users"))
-async def get_users_handler(message: Message) -> None:
-    visitors = await get_all_visitors()
-    text = format_visitors(visitors)
+async def get_users_handler(message: Message, command: CommandObject) -> None:
+    text, keyboard = await render_users_page(parse_users_filter(command.args), 1, 1)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith(f"{USERS_CALLBACK} "))
+async def users_page_handler(call: CallbackQuery) -> None:
+    await call.answer()
+    _, current_page, page, query = call.data.split(" ", 3)  # type: ignore
+    if page == current_page:
+        return
+    text, keyboard = await render_users_page(UsersQuery.unpack(query), int(page), int(current_page))
+    await call.message.edit_text(text, reply_markup=keyboard)  # type: ignore
+
+
+def format_stats(title: str, stats: dict) -> str:
+    lines = [f"{key}: {value}" for key, value in stats.items()]
+    return f"{title}:\n" + "\n".join(lines)
+
+
+@router.message(Command("stats"))
+async def get_stats_handler(message: Message, state: FSMContext) -> None:
+    text = "\n\n".join([
+        format_stats("Пул соединений БД", get_pool_stats()),
+        format_stats("Кэш посетителей", get_visitor_cache().stats()),
+        format_stats("Кэш диалогов", get_conversation_store().stats()),
+        format_stats("Очереди запросов", get_scheduler().stats()),
+        format_stats("Лимиты OpenAI", get_rate_limiter().stats()),
+        format_stats("Модели", get_model_router().stats()),
+        format_stats("Хеджирование и запасные модели", get_resilience().stats()),
+        format_stats("Учет токенов", get_usage_ledger().stats()),
+    ])
+    if cache := get_response_cache():
+        text += "\n\n" + format_stats("Кэш ответов", cache.stats())
+    if is_local_memory():
+        text += "\n\n" + format_stats("Локальная история диалогов", get_conversation_memory().stats())
+    if isinstance(state.storage, PostgresStorage):
+        text += "\n\n" + format_stats("Хранилище FSM", state.storage.stats())
     await message.answer(text)
 
 
+@router.message(Command("top"))
+async def top_handler(message: Message, command: CommandObject) -> None:
+    """/top [дней] - самые расходные посетители, по умолчанию за неделю"""
+    days = int(command.args) if command.args and command.args.isdigit() else 7
+    consumers = await get_usage_ledger().get_top(max(days, 1), 10)
+    if not consumers:
+        await message.answer(f"За {days} дн. запросов не было")
+        return
+    lines = [
+        f"{i}. {consumer.full_name} @{consumer.username}: {consumer.tokens} токенов, {consumer.requests} запросов"
+        for i, consumer in enumerate(consumers, 1)
+    ]
+    await message.answer(f"Топ расхода за {days} дн.:\n\n" + "\n".join(lines))
+
+
+@router.message(Command("broadcast"))
+async def broadcast_handler(message: Message, command: CommandObject) -> None:
+    """/broadcast текст - рассылка всем одобренным посетителям в фоне"""
+    if not command.args:
+        await message.answer("Укажите текст: /broadcast текст рассылки")
+        return
+
+    async def report(result: FanOutResult) -> None:
+        await message.answer(f"Рассылка завершена: {result}")
+
+    get_fanout().submit(message.bot, iter_visitor_chat_ids(Status.VERIFIED), command.args, on_done=report)
+    await message.answer("Рассылка запущена, по окончании пришлю итог")
+
+
+@router.message(Command("reload"))
+async def reload_settings_handler(message: Message) -> None:
+    settings = reload_settings()
+    await message.answer(
+        f"Настройки перечитаны. Админов: {len(settings.admins)}, "
+        f"разрешенных пользователей: {len(settings.usernames)}, DRY_MODE: {settings.DRY_MODE}"
+    )
+
+
 @router.message(F.text.regexp(r"^(\/allow)(\d+)$").as_("match"))
 async def allow_handler(message: Message, match: Match[str]) -> None:
     chat_id = int(match.group(2))
@@ -18,7 +18,7 @@ router = Router()
 @router.message(F.text.casefold().contains("отменить"))
 @router.message(F.text.casefold().contains("отмена"))
 async def cancel_handler(message: Message, state: FSMContext) -> None:
-    clean(str(message.from_user.id))
+    await clean(str(message.from_user.id))
     current_state = await state.get_state()
     if current_state:
         await state.clear()
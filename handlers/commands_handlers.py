@@ -6,9 +6,11 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, CallbackQuery
 
-from domain.models import Visitor
-from helpers.open_ai_helper import GPTModel, clean
+from domain.models import Visitor, JobStatus
+from helpers.model_catalog import AUTO_MODEL, get_model_catalog
+from helpers.open_ai_helper import clean
 from helpers.tghelper import get_inline_keyboard
+from service.research_jobs import get_research_worker
 from service.visitor_actions import change_visitor_model
 
 router = Router()
@@ -32,20 +34,21 @@ async def start_handler(message: Message) -> None:
 /settings для изменения модели (по умолчанию - gpt-4o-mini)
 /help для вызова подсказки по командам
 /clean для очистки истории
+/jobs для списка фоновых задач deep research
 """
     await message.answer(text)
 
 
 @router.message(Command("settings"))
 async def settings_handler(message: Message, visitor: Visitor) -> None:
-    options = list(GPTModel) + ["Отмена"]
+    models = get_model_catalog().selectable()
+    options = [model.name for model in models] + [AUTO_MODEL, "Отмена"]
     keyboard = get_inline_keyboard(options, "model")
+    descriptions = "\n".join(f"- {model.name} - {model.description}" for model in models)
     text = f"""Ваша текущая модель: {visitor.model}.\n 
 Какую выберете вместо нее?
-- gpt-5.1 - базовый вариант
-- gpt-5-mini - если хочется сэкономить
-- o4-mini-deep-research - ооочень долгая, дорогая, но умная 
-- o4-mini - дешевая и слегка устаревшая 
+{descriptions}
+- {AUTO_MODEL} - бот сам подберет модель под каждый запрос
 """
     await message.answer(text, reply_markup=keyboard)
 
@@ -53,10 +56,12 @@ async def settings_handler(message: Message, visitor: Visitor) -> None:
 @router.callback_query(F.data.regexp(r"^model_([^ ]*)$").as_("match"))
 async def choose_model_handler(call: CallbackQuery, match: Match[str]) -> None:
     await call.answer()
-    if match.group(1) == "Отмена":
+    model = match.group(1)
+    if model == "Отмена":
         await call.message.answer("Вы отменили действие")  # type: ignore
+    elif not get_model_catalog().is_known(model):
+        await call.message.answer(f"Модели {model} больше нет в списке")  # type: ignore
     else:
-        model = GPTModel(match.group(1))
         await change_visitor_model(call.message.chat.id, model)
         await call.message.answer(f"Вы изменили модель на {model}")  # type: ignore
     await call.message.delete()  # type: ignore
@@ -64,7 +69,7 @@ async def choose_model_handler(call: CallbackQuery, match: Match[str]) -> None:
 
 @router.message(Command("friend"))
 async def start_friend_chat_handler(message: Message, state: FSMContext) -> None:
-    clean(str(message.from_user.id))
+    await clean(str(message.from_user.id))
     text = "Включен режим диалога! Болтайте с ботом голосовыми или текстом - он будет отвечать тем же способом"
     await message.answer(text)
     await state.set_state(Modes.conversation)
@@ -72,7 +77,7 @@ async def start_friend_chat_handler(message: Message, state: FSMContext) -> None
 
 @router.message(Command("teacher"))
 async def start_monolog_handler(message: Message, state: FSMContext) -> None:
-    clean(str(message.from_user.id))
+    await clean(str(message.from_user.id))
     text = """Включен режим обучения! 
 Присылайте текст или аудио - и учитель будет предлагать, как сделать речь правильней и естественней"""
     await message.answer(text)
@@ -81,5 +86,43 @@ async def start_monolog_handler(message: Message, state: FSMContext) -> None:
 
 @router.message(Command("clean"))
 async def clean_history_handler(message: Message) -> None:
-    clean(str(message.from_user.id))
+    await clean(str(message.from_user.id))
     await message.answer("История сообщений очищена")
+
+
+JOB_STATUS_NAMES = {
+    JobStatus.QUEUED.value: "в очереди",
+    JobStatus.SUBMITTING.value: "отправляется",
+    JobStatus.RUNNING.value: "выполняется",
+    JobStatus.COMPLETED.value: "готово",
+    JobStatus.FAILED.value: "ошибка",
+    JobStatus.CANCELLED.value: "отменено",
+}
+
+ACTIVE_JOB_STATUSES = {JobStatus.QUEUED.value, JobStatus.SUBMITTING.value, JobStatus.RUNNING.value}
+
+
+@router.message(Command("jobs"))
+async def jobs_handler(message: Message) -> None:
+    jobs = await get_research_worker().list_jobs(message.from_user.id)
+    if not jobs:
+        await message.answer("Фоновых задач пока нет")
+        return
+    lines = []
+    for job in jobs:
+        line = f"{job.id}. {job.model}, {JOB_STATUS_NAMES[job.status]}: {job.prompt[:50]}"
+        if job.status in ACTIVE_JOB_STATUSES:
+            line += f"\n/stopjob{job.id}"
+        lines.append(line)
+    await message.answer("Ваши фоновые задачи:\n\n" + "\n\n".join(lines))
+
+
+@router.message(F.text.regexp(r"^(\/stopjob)(\d+)$").as_("match"))
+async def stop_job_handler(message: Message, match: Match[str]) -> None:
+    job = await get_research_worker().cancel(int(match.group(2)), message.from_user.id)
+    if job is None:
+        await message.answer("Задача не найдена")
+    elif job.status == JobStatus.CANCELLED.value:
+        await message.answer(f"Задача {job.id} отменена")
+    else:
+        await message.answer(f"Задача {job.id} уже завершена: {JOB_STATUS_NAMES[job.status]}")
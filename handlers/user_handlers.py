@@ -1,28 +1,93 @@
+import asyncio
+import io
 import logging
+import tempfile
+from pathlib import Path
 
 from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.filters import StateFilter
 from aiogram.types import Message
 
+from config.settings import get_settings
 from domain.models import Visitor
 from handlers.commands_handlers import Modes
 from helpers import tghelper
-from helpers.open_ai_helper import generate_text, WEB_SEARCH_MODELS, audio_to_text, get_answer_from_friend, text_to_audio, \
-    get_english_teacher_comment
-from helpers.tghelper import get_random_processing_phrase, process_file_for_tg, send_text_any_size
+from helpers.audio_segmenter import transcribe_segmented
+from helpers.metrics import track
+from helpers.model_catalog import get_model_catalog
+from helpers.open_ai_helper import generate_text, audio_to_text, audio_to_text_stream, get_answer_from_friend, \
+    get_english_teacher_comment, generate_text_stream, stream_answer_from_friend, stream_english_teacher_comment
+from helpers.tghelper import get_random_processing_phrase, send_text_any_size, send_text_streaming, send_voice_notes
+from helpers.tts_pipeline import synthesize_segments
 from middlware.dry_mode_middlware import DryMode
+from middlware.queue_middleware import UserQueue
+from service.research_jobs import get_research_worker
+
+TEACHER_PREFIX = "Коммент учителя английского: \n\n"
 
 router = Router()
 router.message.middleware(DryMode())
 router.callback_query.middleware(DryMode())
+router.message.middleware(UserQueue())
+
+
+async def transcribe_voice(message: Message) -> str:
+    """
+    Транскрибирует запись. Длинные режутся на сегменты и распознаются параллельно,
+    остальные по умолчанию передаются в whisper прямо во время скачивания
+    """
+    with track("transcription"):
+        return await _transcribe(message)
+
+
+async def _transcribe(message: Message) -> str:
+    settings = get_settings()
+    duration = tghelper.get_media(message).duration or 0
+    if duration > settings.SEGMENT_THRESHOLD:
+        with tempfile.TemporaryDirectory() as directory:
+            path = await tghelper.save_voice_from_tg(message, Path(directory))
+            try:
+                return await transcribe_segmented(path, duration, Path(directory))
+            except FileNotFoundError:
+                logging.warning("ffmpeg не найден, запись распознается одним запросом")
+                audio = io.BytesIO(await asyncio.to_thread(path.read_bytes))
+                audio.name = path.name
+                return await audio_to_text(audio)
+    if not settings.VOICE_STREAMING:
+        in_memory_file = await tghelper.get_voice_from_tg(message)
+        return await audio_to_text(in_memory_file)
+    stream = await tghelper.open_voice_stream(message)
+    return await audio_to_text_stream(stream.chunks(), stream.filename)
+
+
+async def enqueue_research(message: Message, visitor: Visitor, prompt: str) -> None:
+    """Долгие модели не держат обработчик: запрос уходит в очередь, ответ придет отдельным сообщением"""
+    job = await get_research_worker().enqueue(message.from_user.id, message.chat.id, visitor.model, prompt)
+    await message.answer(
+        f"Модель {visitor.model} отвечает долго, запрос поставлен в очередь (задача {job.id}). "
+        f"Пришлю ответ, как только он будет готов. Список задач - /jobs, отменить - /stopjob{job.id}"
+    )
 
 
 @router.message(StateFilter(None), F.content_type.in_({'text'}))
 async def search_text_handler(message: Message, visitor: Visitor) -> None:
+    if get_model_catalog().is_background(visitor.model):
+        await enqueue_research(message, visitor, message.text)
+        return
     tmp_message = await message.answer(get_random_processing_phrase())
+    # Нужен ли поиск этому запросу, решает helpers.model_router
+    use_web_search = True
+    if get_settings().STREAMING_ENABLED:
+        try:
+            chunks = generate_text_stream(str(message.from_user.id), message.text, visitor.model, use_web_search=use_web_search)
+            await send_text_streaming(message, chunks, placeholder=tmp_message)
+        except Exception as e:
+            await message.answer(f"Произошла ошибка: {str(e)[:100]}...")
+            logging.error(f"Ошибка в search_text_handler: {e}")
+        return
     try:
-        result = await generate_text(str(message.from_user.id), message.text, visitor.model, use_web_search=visitor.model in WEB_SEARCH_MODELS)
+        result = await generate_text(str(message.from_user.id), message.text, visitor.model, use_web_search=use_web_search)
         await tmp_message.delete()
         await send_text_any_size(message, result)
     except Exception as e:
@@ -31,13 +96,19 @@ async def search_text_handler(message: Message, visitor: Visitor) -> None:
         logging.error(f"Ошибка в search_text_handler: {e}")
 
 
-@router.message(StateFilter(None), F.content_type.in_({'voice'}))
+@router.message(StateFilter(None), F.content_type.in_({'voice', 'audio', 'video_note'}))
 async def search_audio_handler(message: Message, visitor: Visitor) -> None:
     try:
-        in_memory_file = await tghelper.get_voice_from_tg(message)
-        transcript = await audio_to_text(in_memory_file)
+        transcript = await transcribe_voice(message)
         await message.answer(f"Транскрипт вашего аудио: \n\n{transcript}")
+        if get_model_catalog().is_background(visitor.model):
+            await enqueue_research(message, visitor, transcript)
+            return
         tmp_message = await message.answer(get_random_processing_phrase())
+        if get_settings().STREAMING_ENABLED:
+            chunks = generate_text_stream(str(message.from_user.id), transcript, visitor.model)
+            await send_text_streaming(message, chunks, placeholder=tmp_message)
+            return
         result = await generate_text(str(message.from_user.id), transcript, visitor.model)
         await tmp_message.delete()
         await send_text_any_size(message, result)
@@ -46,17 +117,14 @@ async def search_audio_handler(message: Message, visitor: Visitor) -> None:
         logging.error(f"Ошибка в search_audio_handler: {e}")
 
 
-@router.message(Modes.conversation, F.content_type.in_({'voice'}))
+@router.message(Modes.conversation, F.content_type.in_({'voice', 'audio', 'video_note'}))
 async def continue_friend_chat_audio_handler(message: Message, visitor: Visitor) -> None:
     try:
-        in_memory_file = await tghelper.get_voice_from_tg(message)
-        transcript = await audio_to_text(in_memory_file)
+        transcript = await transcribe_voice(message)
         await message.answer(f"Транскрипт вашего аудио: \n\n{transcript}")
         result = await get_answer_from_friend(str(message.from_user.id), transcript, visitor.model)
         if result:
-            audio = await text_to_audio(result)
-            tg_file = process_file_for_tg(audio, "mp3")
-            await message.reply_document(tg_file)
+            await send_voice_notes(message, synthesize_segments(result), get_settings().TTS_FORMAT)
     except Exception as e:
         await message.answer(f"Произошла ошибка: {str(e)[:100]}...")
         logging.error(f"Ошибка в continue_friend_chat_audio_handler: {e}")
@@ -65,6 +133,10 @@ async def continue_friend_chat_audio_handler(message: Message, visitor: Visitor)
 @router.message(Modes.conversation, F.content_type.in_({'text'}))
 async def continue_friend_chat_text_handler(message: Message, visitor: Visitor) -> None:
     try:
+        if get_settings().STREAMING_ENABLED:
+            chunks = stream_answer_from_friend(str(message.from_user.id), message.text, visitor.model)
+            await send_text_streaming(message, chunks)
+            return
         result = await get_answer_from_friend(str(message.from_user.id), message.text, visitor.model)
         await send_text_any_size(message, result)
     except Exception as e:
@@ -72,14 +144,17 @@ async def continue_friend_chat_text_handler(message: Message, visitor: Visitor)
         logging.error(f"Ошибка в continue_friend_chat_text_handler: {e}")
 
 
-@router.message(Modes.monolog, F.content_type.in_({'voice'}))
+@router.message(Modes.monolog, F.content_type.in_({'voice', 'audio', 'video_note'}))
 async def feedback_audio_handler(message: Message, visitor: Visitor) -> None:
     try:
-        in_memory_file = await tghelper.get_voice_from_tg(message)
-        transcript = await audio_to_text(in_memory_file)
+        transcript = await transcribe_voice(message)
         await message.answer(f"Транскрипт вашего аудио: \n\n{transcript}")
+        if get_settings().STREAMING_ENABLED:
+            chunks = stream_english_teacher_comment(str(message.from_user.id), transcript, visitor.model)
+            await send_text_streaming(message, chunks, prefix=TEACHER_PREFIX)
+            return
         result = await get_english_teacher_comment(str(message.from_user.id), transcript, visitor.model)
-        text = f"Коммент учителя английского: \n\n{result}" if result else "Не удалось получить ответ"
+        text = f"{TEACHER_PREFIX}{result}" if result else "Не удалось получить ответ"
         await send_text_any_size(message, text)
     except Exception as e:
         await message.answer(f"Произошла ошибка: {str(e)[:100]}...")
@@ -89,8 +164,12 @@ async def feedback_audio_handler(message: Message, visitor: Visitor) -> None:
 @router.message(Modes.monolog, F.content_type.in_({'text'}))
 async def feedback_text_handler(message: Message, visitor: Visitor) -> None:
     try:
+        if get_settings().STREAMING_ENABLED:
+            chunks = stream_english_teacher_comment(str(message.from_user.id), message.text, visitor.model)
+            await send_text_streaming(message, chunks, prefix=TEACHER_PREFIX)
+            return
         result = await get_english_teacher_comment(str(message.from_user.id), message.text, visitor.model)
-        text = f"Коммент учителя английского: \n\n{result}" if result else "Не удалось получить ответ"
+        text = f"{TEACHER_PREFIX}{result}" if result else "Не удалось получить ответ"
         await send_text_any_size(message, text)
     except Exception as e:
         await message.answer(f"Произошла ошибка: {str(e)[:100]}...")
@@ -0,0 +1,120 @@
+"""
+Параллельная транскрипция длинных аудио.
+
+Файл режется ffmpeg по паузам на сегменты около SEGMENT_SECONDS с небольшим перекрытием,
+сегменты транскрибируются одновременно (не больше TRANSCRIBE_PARALLELISM), а тексты склеиваются
+с удалением слов, попавших в перекрытие дважды. ffmpeg запускается как дочерний процесс,
+так что event loop не блокируется ни на поиске пауз, ни на нарезке.
+"""
+import asyncio
+import io
+import logging
+import re
+from pathlib import Path
+
+from config.settings import get_settings
+from helpers.open_ai_helper import audio_to_text
+
+_SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+_WORD = re.compile(r"\w+")
+
+# Сколько слов в начале следующего сегмента сравнивать с концом предыдущего
+MAX_OVERLAP_WORDS = 30
+
+
+async def run_ffmpeg(*args: str) -> str:
+    """Запускает ffmpeg и возвращает его stderr, где он пишет диагностику"""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostats", "-y", *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    output = stderr.decode(errors="ignore")
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {output[-300:]}")
+    return output
+
+
+async def detect_silences(path: Path, noise_db: int, min_silence: float) -> list[tuple[float, float]]:
+    """Интервалы тишины (начало, конец) в секундах"""
+    output = await run_ffmpeg(
+        "-i", str(path), "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"
+    )
+    starts = [float(value) for value in _SILENCE_START.findall(output)]
+    ends = [float(value) for value in _SILENCE_END.findall(output)]
+    return list(zip(starts, ends))
+
+
+def choose_cut_points(
+        duration: float,
+        silences: list[tuple[float, float]],
+        target: float,
+        window: float
+) -> list[float]:
+    """
+    Точки разреза примерно через каждые target секунд. Берется середина паузы,
+    ближайшей к желаемой точке в пределах window, а если пауз нет - сама точка
+    """
+    cuts: list[float] = []
+    position = 0.0
+    middles = [(start + end) / 2 for start, end in silences]
+    while duration - position > target * 1.5:
+        desired = position + target
+        candidates = [middle for middle in middles if abs(middle - desired) <= window and middle > position + 1]
+        cut = min(candidates, key=lambda middle: abs(middle - desired)) if candidates else desired
+        cuts.append(cut)
+        position = cut
+    return cuts
+
+
+def stitch(texts: list[str]) -> str:
+    """Склеивает тексты сегментов, убирая повтор слов на стыке из-за перекрытия"""
+    result: list[str] = []
+    for text in texts:
+        words = text.split()
+        if result and words:
+            words = words[_overlap_length(result, words):]
+        result.extend(words)
+    return " ".join(result)
+
+
+def _overlap_length(previous: list[str], current: list[str]) -> int:
+    """Длина самого длинного конца previous, совпадающего с началом current"""
+    tail = [_normalize(word) for word in previous[-MAX_OVERLAP_WORDS:]]
+    head = [_normalize(word) for word in current[:MAX_OVERLAP_WORDS]]
+    for size in range(min(len(tail), len(head)), 0, -1):
+        if tail[-size:] == head[:size] and any(head[:size]):
+            return size
+    return 0
+
+
+def _normalize(word: str) -> str:
+    return "".join(_WORD.findall(word.lower()))
+
+
+async def transcribe_segmented(path: Path, duration: float, workdir: Path) -> str:
+    settings = get_settings()
+    silences = await detect_silences(path, settings.SEGMENT_SILENCE_DB, settings.SEGMENT_MIN_SILENCE)
+    cuts = choose_cut_points(duration, silences, settings.SEGMENT_SECONDS, settings.SEGMENT_SEARCH_WINDOW)
+    bounds = list(zip([0.0] + cuts, cuts + [duration]))
+    overlap = settings.SEGMENT_OVERLAP_SECONDS
+    semaphore = asyncio.Semaphore(settings.TRANSCRIBE_PARALLELISM)
+    logging.info(f"Аудио {duration:.0f} с делится на {len(bounds)} сегментов")
+
+    async def transcribe_segment(index: int, start: float, end: float) -> str:
+        async with semaphore:
+            segment_path = workdir / f"segment_{index}.ogg"
+            # Перекрытие только с предыдущим сегментом, конец остается на точке разреза
+            start = max(0.0, start - overlap)
+            await run_ffmpeg(
+                "-ss", f"{start:.2f}", "-t", f"{end - start:.2f}", "-i", str(path),
+                "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", str(segment_path)
+            )
+            audio = io.BytesIO(await asyncio.to_thread(segment_path.read_bytes))
+            audio.name = segment_path.name
+            return await audio_to_text(audio)
+
+    texts = await asyncio.gather(*(transcribe_segment(i, start, end) for i, (start, end) in enumerate(bounds)))
+    return stitch(list(texts))
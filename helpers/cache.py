@@ -0,0 +1,111 @@
+"""
+Простой LRU-кэш с временем жизни записей для горячего пути бота.
+
+Classes
+--------
+TTLCache
+    Ограниченный по размеру кэш: при переполнении вытесняется самая давно использованная
+    запись, устаревшие записи считаются промахом и удаляются при обращении. С функцией sizeof
+    maxsize ограничивает не число записей, а их суммарный размер, например в байтах.
+"""
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """LRU-кэш с TTL и счетчиками попаданий"""
+
+    def __repr__(self) -> str:
+        return f"TTLCache(maxsize={self.maxsize}, ttl={self.ttl}, size={len(self._data)})"
+
+    def __init__(self, maxsize: int, ttl: float, sizeof: Optional[Callable[[V], int]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+        self._total = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not _MISSING
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """Возвращает значение и учитывает попадание или промах"""
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value  # type: ignore
+
+    def lookup(self, key: K) -> Tuple[bool, Optional[V]]:
+        """Как get, но отличает закэшированный None от отсутствия записи"""
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, value  # type: ignore
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        self.pop(key)
+        if self._size(value) > self.maxsize:
+            # Запись больше всего кэша вытеснила бы остальные и все равно не поместилась
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._total += self._size(value)
+        while self._total > self.maxsize:
+            _, (_, evicted) = self._data.popitem(last=False)
+            self._total -= self._size(evicted)
+            self.evictions += 1
+
+    def pop(self, key: K) -> Optional[V]:
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        self._total -= self._size(item[1])
+        return item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._total = 0
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        result: dict[str, float] = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+        if self.sizeof is not None:
+            result["total_size"] = self._total
+        return result
+
+    def _lookup(self, key: K) -> object:
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def _size(self, value: V) -> int:
+        return 1 if self.sizeof is None else self.sizeof(value)
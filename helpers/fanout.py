@@ -0,0 +1,151 @@
+"""
+Рассылка одного сообщения многим чатам в фоне.
+
+Отправляют FANOUT_CONCURRENCY воркеров из ограниченной очереди получателей, поэтому
+даже рассылка по всем посетителям не держит в памяти весь список. Частота ограничена
+двумя ведрами токенов из rate_limiter: общим на бота и отдельным на каждый чат.
+TelegramRetryAfter приостанавливает общее ведро на указанное время, и сообщение
+отправляется повторно. Заблокировавшие бота чаты не повторяются.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from config.settings import get_settings
+from helpers.cache import TTLCache
+from helpers.rate_limiter import TokenBucket
+
+
+@dataclass
+class FanOutResult:
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    retried: int = 0
+
+    def __str__(self) -> str:
+        return f"доставлено {self.sent}, бот заблокирован {self.blocked}, ошибок {self.failed}, повторов {self.retried}"
+
+
+class FanOut:
+
+    def __init__(self, global_per_second: float, per_chat_per_second: float, concurrency: int, max_attempts: int):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.per_chat_per_second = per_chat_per_second
+        self.bucket = TokenBucket(global_per_second * 60, capacity=global_per_second)
+        # Ведро чата, который давно не получал сообщений, уже полное - его можно забыть
+        self.chat_buckets: TTLCache[int, TokenBucket] = TTLCache(100_000, 60.0)
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(
+            self,
+            bot: Bot,
+            chat_ids: Iterable[int] | AsyncIterable[int],
+            text: str,
+            on_done: Optional[Callable[[FanOutResult], Awaitable[None]]] = None
+    ) -> asyncio.Task:
+        """Запускает рассылку в фоне, не задерживая обработку текущего обновления"""
+        task = asyncio.create_task(self._run(bot, chat_ids, text, on_done))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send_all(self, bot: Bot, chat_ids: Iterable[int] | AsyncIterable[int], text: str) -> FanOutResult:
+        result = FanOutResult()
+        queue: asyncio.Queue[Optional[int]] = asyncio.Queue(self.concurrency * 2)
+
+        async def produce() -> None:
+            if isinstance(chat_ids, AsyncIterable):
+                async for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await queue.put(chat_id)
+
+        async def work() -> None:
+            while (chat_id := await queue.get()) is not None:
+                await self._send(bot, chat_id, text, result)
+
+        workers = [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await produce()
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            # Если получатели не дочитались из-за ошибки, воркеры не должны ждать очередь вечно
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return result
+
+    async def close(self) -> None:
+        """Отменяет незаконченные рассылки при остановке бота"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _run(
+            self,
+            bot: Bot,
+            chat_ids: Iterable[int] | AsyncIterable[int],
+            text: str,
+            on_done: Optional[Callable[[FanOutResult], Awaitable[None]]]
+    ) -> FanOutResult:
+        try:
+            result = await self.send_all(bot, chat_ids, text)
+        except Exception as e:
+            logging.error(f"Рассылка прервана: {e}")
+            raise
+        logging.info(f"Рассылка завершена: {result}")
+        if on_done is not None:
+            await on_done(result)
+        return result
+
+    async def _send(self, bot: Bot, chat_id: int, text: str, result: FanOutResult) -> None:
+        for attempt in range(self.max_attempts):
+            await self._get_chat_bucket(chat_id).acquire(1)
+            await self.bucket.acquire(1)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                result.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                result.retried += 1
+                logging.warning(f"Telegram просит подождать {e.retry_after} с при отправке в {chat_id}")
+            except TelegramForbiddenError:
+                result.blocked += 1
+                return
+            except Exception as e:
+                logging.warning(f"Не удалось отправить сообщение в {chat_id}: {e}")
+                break
+        result.failed += 1
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_per_second * 60, capacity=1)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+
+_fanout: Optional[FanOut] = None
+
+
+def get_fanout() -> FanOut:
+    global _fanout
+    if _fanout is None:
+        settings = get_settings()
+        _fanout = FanOut(
+            settings.FANOUT_GLOBAL_PER_SECOND,
+            settings.FANOUT_PER_CHAT_PER_SECOND,
+            settings.FANOUT_CONCURRENCY,
+            settings.FANOUT_MAX_ATTEMPTS,
+        )
+    return _fanout
@@ -0,0 +1,229 @@
+"""
+Перевод Markdown от модели в MarkdownV2 телеграма и нарезка на сообщения.
+
+Текст режется по границам блоков кода, абзацев и строк, а каждый кусок конвертируется
+отдельно, поэтому разметка в куске всегда сбалансирована и сообщение отправляется с первой попытки.
+"""
+import re
+from typing import Callable, NamedTuple
+
+MESSAGE_LIMIT = 4096
+
+_SPECIAL = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+_CODE_SPECIAL = re.compile(r"([`\\])")
+_URL_SPECIAL = re.compile(r"([)\\])")
+
+_FENCE = re.compile(r"^\s*```")
+_HEADER = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+_NUMBERED = re.compile(r"^(\s*)(\d+)[.)]\s+(.*)$")
+_QUOTE = re.compile(r"^\s*>\s?(.*)$")
+_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+
+_INLINE = re.compile(
+    r"`(?P<code>[^`\n]+)`"
+    r"|\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^()\s]+)\)"
+    r"|\*\*(?P<bold>[^\n]+?)\*\*"
+    r"|(?<!\w)__(?P<bold_alt>[^\n]+?)__(?!\w)"
+    r"|~~(?P<strike>[^\n]+?)~~"
+    r"|(?<![\w*])\*(?P<italic>[^\s*](?:[^*\n]*[^\s*])?)\*(?![\w*])"
+    r"|(?<![\w_])_(?P<italic_alt>[^\s_](?:[^_\n]*[^\s_])?)_(?![\w_])"
+)
+
+
+class MarkdownChunk(NamedTuple):
+    """Кусок ответа: исходный текст и он же в MarkdownV2"""
+    source: str
+    text: str
+
+
+def escape(text: str) -> str:
+    return _SPECIAL.sub(r"\\\1", text)
+
+
+def escape_code(text: str) -> str:
+    """Внутри кода экранируются только обратная кавычка и обратный слэш"""
+    return _CODE_SPECIAL.sub(r"\\\1", text)
+
+
+def escape_url(text: str) -> str:
+    return _URL_SPECIAL.sub(r"\\\1", text)
+
+
+def tg_len(text: str) -> int:
+    """Длина так, как ее считает телеграм - в UTF-16 code units"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def fit_escaped(text: str, limit: int) -> int:
+    """Сколько первых символов text после экранирования влезает в limit UTF-16 code units"""
+    size = 0
+    for index, char in enumerate(text):
+        size += (2 if ord(char) > 0xFFFF else 1) + (1 if _SPECIAL.match(char) else 0)
+        if size > limit:
+            return index
+    return len(text)
+
+
+def convert_inline(text: str) -> str:
+    """Конвертирует строчную разметку. Непарные маркеры экранируются как обычный текст"""
+    result = []
+    position = 0
+    for match in _INLINE.finditer(text):
+        result.append(escape(text[position:match.start()]))
+        groups = match.groupdict()
+        if groups["code"] is not None:
+            result.append(f"`{escape_code(groups['code'])}`")
+        elif groups["link_text"] is not None:
+            result.append(f"[{convert_inline(groups['link_text'])}]({escape_url(groups['link_url'])})")
+        elif groups["bold"] is not None or groups["bold_alt"] is not None:
+            result.append(f"*{convert_inline(groups['bold'] or groups['bold_alt'])}*")
+        elif groups["strike"] is not None:
+            result.append(f"~{convert_inline(groups['strike'])}~")
+        else:
+            result.append(f"_{escape(groups['italic'] or groups['italic_alt'])}_")
+        position = match.end()
+    result.append(escape(text[position:]))
+    return "".join(result)
+
+
+def convert_line(line: str) -> str:
+    """Конвертирует строку абзаца с учетом заголовков, списков и цитат"""
+    if _RULE.match(line):
+        return "——————"
+    if match := _HEADER.match(line):
+        return f"*{convert_inline(match.group(1).replace('**', ''))}*"
+    if match := _BULLET.match(line):
+        return f"{match.group(1)}• {convert_inline(match.group(2))}"
+    if match := _NUMBERED.match(line):
+        return f"{match.group(1)}{match.group(2)}\\. {convert_inline(match.group(3))}"
+    if match := _QUOTE.match(line):
+        return f">{convert_inline(match.group(1))}"
+    return convert_inline(line)
+
+
+def convert_code(language: str, body: str) -> str:
+    return f"```{language}\n{escape_code(body)}\n```"
+
+
+def split_markdown(text: str, limit: int = MESSAGE_LIMIT) -> list[MarkdownChunk]:
+    """Делит текст на куски, каждый из которых после конвертации влезает в одно сообщение"""
+    chunks: list[MarkdownChunk] = []
+    sources: list[str] = []
+    rendered: list[str] = []
+    size = 0
+    for source, block in _fit_blocks(text, limit):
+        block_size = tg_len(block)
+        if rendered and size + 2 + block_size > limit:
+            chunks.append(MarkdownChunk("\n\n".join(sources), "\n\n".join(rendered)))
+            sources, rendered, size = [], [], 0
+        size += block_size + (2 if rendered else 0)
+        sources.append(source)
+        rendered.append(block)
+    if rendered:
+        chunks.append(MarkdownChunk("\n\n".join(sources), "\n\n".join(rendered)))
+    return chunks
+
+
+def _split_blocks(text: str) -> list[tuple[str, str, str]]:
+    """Делит текст на блоки: ("code", язык, тело) и ("text", "", абзац)"""
+    blocks: list[tuple[str, str, str]] = []
+    paragraph: list[str] = []
+    code: list[str] = []
+    language = ""
+    in_code = False
+
+    def flush_paragraph() -> None:
+        if paragraph:
+            blocks.append(("text", "", "\n".join(paragraph)))
+            paragraph.clear()
+
+    for line in text.splitlines():
+        if _FENCE.match(line):
+            if in_code:
+                blocks.append(("code", language, "\n".join(code)))
+                code.clear()
+                in_code = False
+            else:
+                flush_paragraph()
+                language = line.strip()[3:].strip().split(" ")[0]
+                in_code = True
+        elif in_code:
+            code.append(line)
+        elif line.strip():
+            paragraph.append(line)
+        else:
+            flush_paragraph()
+    if in_code:
+        # Незакрытый блок кода от модели - все равно отправляем как код
+        blocks.append(("code", language, "\n".join(code)))
+    flush_paragraph()
+    return blocks
+
+
+def _fit_blocks(text: str, limit: int) -> list[tuple[str, str]]:
+    """Блоки, которые не влезают в лимит, дробятся по строкам, а строки - по словам"""
+    result = []
+    for kind, language, body in _split_blocks(text):
+        if kind == "code":
+            rendered = convert_code(language, body)
+            if tg_len(rendered) <= limit:
+                result.append((f"```{language}\n{body}\n```", rendered))
+                continue
+            overhead = tg_len(convert_code(language, ""))
+            for piece in _split_lines(body, limit - overhead, lambda part: tg_len(escape_code(part))):
+                result.append((f"```{language}\n{piece}\n```", convert_code(language, piece)))
+            continue
+        rendered = _convert_paragraph(body)
+        if tg_len(rendered) <= limit:
+            result.append((body, rendered))
+            continue
+        for piece in _split_lines(body, limit, lambda part: tg_len(convert_line(part))):
+            result.append((piece, _convert_paragraph(piece)))
+    return result
+
+
+def _convert_paragraph(body: str) -> str:
+    return "\n".join(convert_line(line) for line in body.split("\n"))
+
+
+def _split_lines(body: str, limit: int, measure: Callable[[str], int]) -> list[str]:
+    pieces: list[str] = []
+    current: list[str] = []
+    size = 0
+    for line in body.split("\n"):
+        line_size = measure(line)
+        if line_size > limit:
+            if current:
+                pieces.append("\n".join(current))
+                current, size = [], 0
+            pieces.extend(_split_words(line, limit, measure))
+            continue
+        if current and size + 1 + line_size > limit:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        size += line_size + (1 if current else 0)
+        current.append(line)
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def _split_words(line: str, limit: int, measure: Callable[[str], int]) -> list[str]:
+    pieces: list[str] = []
+    current = ""
+    for word in line.split(" "):
+        candidate = f"{current} {word}" if current else word
+        if measure(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            pieces.append(current)
+        # Слово длиннее лимита режем жестко. Экранирование не более чем удваивает длину
+        while measure(word) > limit:
+            pieces.append(word[:limit // 2])
+            word = word[limit // 2:]
+        current = word
+    if current:
+        pieces.append(current)
+    return pieces
@@ -0,0 +1,75 @@
+"""
+Метрики Prometheus: сколько длится каждый этап обработки, сколько токенов уходит,
+какие ошибки случаются и сколько этапов выполняется прямо сейчас.
+
+Этапы (stage): update, auth_lookup, tg_download, transcription, whisper, llm,
+llm_first_token, tts, tg_send. Режим (mode) - base, friend или teacher - выставляет
+middleware Metrics в контекстной переменной, чтобы не протаскивать его через все вызовы.
+На горячем пути только поиск меток в словаре и пара арифметических операций.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from aiohttp import web
+from openai.types.responses import ResponseUsage
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+current_mode: ContextVar[str] = ContextVar("current_mode", default="base")
+
+# От запроса в БД до deep research
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Длительность этапа обработки", ["stage", "model", "mode"], buckets=BUCKETS
+)
+STAGE_ERRORS = Counter("bot_stage_errors_total", "Ошибки этапа по типу исключения", ["stage", "error"])
+IN_FLIGHT = Gauge("bot_stage_in_flight", "Этапы, которые выполняются прямо сейчас", ["stage"])
+TOKENS = Counter("bot_openai_tokens_total", "Токены OpenAI: input, cached, output, reasoning", ["model", "mode", "kind"])
+
+
+@contextmanager
+def track(stage: str, model: str = "") -> Iterator[None]:
+    """Замеряет длительность блока, считает его ошибки и держит его в in-flight"""
+    in_flight = IN_FLIGHT.labels(stage)
+    in_flight.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.labels(stage, type(e).__name__).inc()
+        raise
+    finally:
+        in_flight.dec()
+        STAGE_SECONDS.labels(stage, model, current_mode.get()).observe(time.perf_counter() - started)
+
+
+def observe(stage: str, seconds: float, model: str = "") -> None:
+    STAGE_SECONDS.labels(stage, model, current_mode.get()).observe(seconds)
+
+
+def record_usage(model: str, usage: Optional[ResponseUsage]) -> None:
+    if usage is None:
+        return
+    mode = current_mode.get()
+    TOKENS.labels(model, mode, "input").inc(usage.input_tokens)
+    TOKENS.labels(model, mode, "output").inc(usage.output_tokens)
+    if usage.input_tokens_details and usage.input_tokens_details.cached_tokens:
+        TOKENS.labels(model, mode, "cached").inc(usage.input_tokens_details.cached_tokens)
+    if usage.output_tokens_details and usage.output_tokens_details.reasoning_tokens:
+        TOKENS.labels(model, mode, "reasoning").inc(usage.output_tokens_details.reasoning_tokens)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер для /metrics, чтобы метрики не попадали на публичный порт вебхука"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
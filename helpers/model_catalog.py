@@ -0,0 +1,92 @@
+"""
+Каталог моделей из gpt_models.json: возможности, цены и целевые задержки.
+
+Читается один раз при старте (MODEL_CATALOG_PATH). Из него берутся список моделей
+в /settings, лимиты запросов и то, какие модели умеют reasoning, веб-поиск и
+фоновый режим. Цены - в долларах за миллион токенов, latency_target - ожидаемый
+p95 времени до первого фрагмента потокового ответа в секундах, quality - грубый ранг
+качества для выбора модели в auto. deadline - сколько секунд ждать первого фрагмента
+потокового ответа, включая запрос к запасной модели fallback.
+"""
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from config.settings import get_settings
+
+# Вариант в /settings, при котором модель выбирается под каждый запрос
+AUTO_MODEL = "auto"
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    name: str
+    description: str = ""
+    # Показывать в /settings
+    selectable: bool = True
+    # Может быть выбрана в режиме auto
+    auto: bool = True
+    reasoning: bool = False
+    web_search: bool = False
+    # Отвечает минутами: запросы уходят в фоновый режим через service.research_jobs
+    background: bool = False
+    quality: int = 1
+    price_input: float = 0.0
+    price_output: float = 0.0
+    latency_target: float = 30.0
+    deadline: float = 120.0
+    fallback: Optional[str] = None
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+
+
+class ModelCatalog:
+
+    def __init__(self, models: list[ModelInfo]):
+        self.models = {model.name: model for model in models}
+
+    @classmethod
+    def load(cls, path: Path) -> "ModelCatalog":
+        entries = json.loads(path.read_text(encoding="utf-8"))
+        return cls([ModelInfo(**entry) for entry in entries])
+
+    def get(self, model: str) -> Optional[ModelInfo]:
+        return self.models.get(model)
+
+    def selectable(self) -> list[ModelInfo]:
+        return [model for model in self.models.values() if model.selectable]
+
+    def auto_candidates(self) -> list[ModelInfo]:
+        return [model for model in self.models.values() if model.auto and not model.background]
+
+    def supports_reasoning(self, model: str) -> bool:
+        info = self.get(model)
+        return info is not None and info.reasoning
+
+    def supports_web_search(self, model: str) -> bool:
+        info = self.get(model)
+        return info is not None and info.web_search
+
+    def is_background(self, model: str) -> bool:
+        info = self.get(model)
+        return info is not None and info.background
+
+    def fallback_for(self, model: str) -> Optional[str]:
+        info = self.get(model)
+        if info is None or info.fallback is None or info.fallback == model:
+            return None
+        return info.fallback
+
+    def is_known(self, model: str) -> bool:
+        return model == AUTO_MODEL or model in self.models
+
+
+_catalog: Optional[ModelCatalog] = None
+
+
+def get_model_catalog() -> ModelCatalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = ModelCatalog.load(Path(get_settings().MODEL_CATALOG_PATH))
+    return _catalog
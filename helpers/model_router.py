@@ -0,0 +1,269 @@
+"""
+Выбор модели и параметров запроса к ней.
+
+Для выбранной посетителем модели роутер только решает, нужен ли веб-поиск и какое
+усилие reasoning. Для auto он еще и выбирает модель из каталога: простые запросы
+уходят самой дешевой здоровой модели, сложные - самой качественной здоровой из
+умеющих reasoning. Здоровье - p95 задержки до первого фрагмента потокового ответа
+и доля ошибок по последним ROUTER_WINDOW_SIZE запросам не старше ROUTER_WINDOW_SECONDS.
+Полное время ответов без потока копится в отдельном окне: оно намного больше времени
+до первого фрагмента, и в общем окне искажало бы p95. Пока замеров меньше
+ROUTER_MIN_SAMPLES, модель считается здоровой. После BREAKER_FAILURES ошибок
+подряд автомат модели размыкается на BREAKER_COOLDOWN: auto ее не выбирает, а запросы
+к ней сразу уходят на запасную модель (см. helpers.resilience).
+
+Эвристики намеренно дешевые: длина запроса, режим и пара регулярных выражений.
+"""
+import re
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Optional
+
+from config.settings import get_settings
+from helpers.metrics import current_mode
+from helpers.model_catalog import AUTO_MODEL, ModelCatalog, ModelInfo, get_model_catalog
+from helpers.rate_limiter import estimate_tokens
+
+# Вопросы о свежих событиях, ценах, погоде и ссылки - без поиска модель ответит устаревшими данными
+WEB_SEARCH_HINTS = re.compile(
+    r"\b(?:сегодня|сейчас|вчера|новост\w*|погод\w*|свеж\w*|цен[аыуе]|расписани\w*|курс\w* (?:доллар|евро|валют|рубл)\w*)\b|"
+    r"\b(?:today|now|latest|news|current|price|weather)\b|https?://|\b20[2-9]\d\b",
+    re.IGNORECASE,
+)
+
+# Задачи, где размышление заметно улучшает ответ
+REASONING_HINTS = re.compile(
+    r"\b(?:почему|докажи|реши\w*|сравни|объясни|посчитай|вычисли|алгоритм\w*|задач\w*|пошагово)\b|"
+    r"\b(?:why|prove|solve|compare|explain|calculate|algorithm|step by step)\b|```",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    model: str
+    reasoning_effort: Optional[str] = None
+    web_search: bool = False
+
+
+class ModelHealth:
+    """Скользящее окно замеров одной модели: время, задержка, успех"""
+
+    def __init__(self, size: int, window: float):
+        self.window = window
+        self.samples: deque[tuple[float, float, bool]] = deque(maxlen=size)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self.samples.append((time.monotonic(), seconds, ok))
+
+    def count(self) -> int:
+        return len(self._recent())
+
+    def p95(self) -> Optional[float]:
+        return self.percentile(0.95)
+
+    def percentile(self, q: float) -> Optional[float]:
+        latencies = sorted(seconds for _, seconds, ok in self._recent() if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def error_rate(self) -> float:
+        samples = self._recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def _recent(self) -> deque[tuple[float, float, bool]]:
+        threshold = time.monotonic() - self.window
+        while self.samples and self.samples[0][0] < threshold:
+            self.samples.popleft()
+        return self.samples
+
+
+class CircuitBreaker:
+    """Размыкается после failures ошибок подряд, через cooldown пропускает одну пробу"""
+
+    def __init__(self, failures: int, cooldown: float):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opens = 0
+        self.opened_until: Optional[float] = None
+
+    def is_open(self) -> bool:
+        return self.opened_until is not None and time.monotonic() < self.opened_until
+
+    def allow(self) -> bool:
+        if self.opened_until is None:
+            return True
+        now = time.monotonic()
+        if now < self.opened_until:
+            return False
+        # Полуоткрытое состояние: проба уходит, следующая - не раньше чем через cooldown
+        self.opened_until = now + self.cooldown
+        return True
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.failures = 0
+            self.opened_until = None
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if not self.is_open():
+                self.opens += 1
+            self.opened_until = time.monotonic() + self.cooldown
+
+
+class ModelRouter:
+
+    def __init__(
+            self,
+            catalog: ModelCatalog,
+            window_size: int,
+            window_seconds: float,
+            min_samples: int,
+            max_error_rate: float,
+            slow_factor: float,
+            long_prompt_tokens: int,
+            breaker_failures: int,
+            breaker_cooldown: float
+    ):
+        self.catalog = catalog
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.slow_factor = slow_factor
+        self.long_prompt_tokens = long_prompt_tokens
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        # До первого фрагмента потока и полное время ответа без потока
+        self.health: dict[str, ModelHealth] = {}
+        self.totals: dict[str, ModelHealth] = {}
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.routed: Counter[str] = Counter()
+
+    def route(self, model: str, content: str, allow_web_search: bool = False) -> Route:
+        # В беседе с другом и учителем нужен быстрый ответ, а не поиск и долгие размышления
+        conversational = current_mode.get() != "base"
+        long_prompt = estimate_tokens(content) > self.long_prompt_tokens
+        hinted = bool(REASONING_HINTS.search(content))
+        complex_query = not conversational and (long_prompt or hinted)
+        needs_web = allow_web_search and not conversational and bool(WEB_SEARCH_HINTS.search(content))
+
+        if model == AUTO_MODEL:
+            model = self._choose(complex_query, needs_web)
+            self.routed[model] += 1
+
+        effort = None
+        if self.catalog.supports_reasoning(model):
+            effort = "low"
+            if complex_query:
+                effort = "high" if long_prompt and hinted else "medium"
+        return Route(model, effort, needs_web and self.catalog.supports_web_search(model))
+
+    def record(self, model: str, seconds: float, ok: bool, total: bool = False) -> None:
+        """
+        Замер запроса к модели и его успех. total=False - задержка до первого фрагмента
+        потока, total=True - полное время ответа без потока
+        """
+        self._health(model, total).record(seconds, ok)
+        self.breaker(model).record(ok)
+
+    def record_latency(self, model: str, seconds: float, total: bool = False) -> None:
+        """Запрос отменили до ответа: задержка не меньше seconds, но ошибкой это не считается"""
+        self._health(model, total).record(seconds, ok=True)
+
+    def percentile(self, model: str, q: float, total: bool = False) -> Optional[float]:
+        """Перцентиль задержки модели или None, пока замеров мало"""
+        health = (self.totals if total else self.health).get(model)
+        if health is None or health.count() < self.min_samples:
+            return None
+        return health.percentile(q)
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return breaker
+
+    def is_healthy(self, model: ModelInfo) -> bool:
+        if self.breaker(model.name).is_open():
+            return False
+        for window in (self.health.get(model.name), self.totals.get(model.name)):
+            if window is not None and window.count() >= self.min_samples and window.error_rate() > self.max_error_rate:
+                return False
+        # latency_target - ожидание первого фрагмента, поэтому сравнивается только с ним
+        health = self.health.get(model.name)
+        if health is None or health.count() < self.min_samples:
+            return True
+        p95 = health.p95()
+        return p95 is None or p95 <= model.latency_target * self.slow_factor
+
+    def stats(self) -> dict[str, str]:
+        result = {}
+        for name in {**self.health, **self.totals}:
+            health = self._health(name)
+            p95 = health.p95()
+            total_p95 = self._health(name, total=True).p95()
+            breaker = self.breaker(name)
+            result[name] = (
+                f"p95 до первого фрагмента {f'{p95:.1f} с' if p95 is not None else '-'}, "
+                f"p95 без потока {f'{total_p95:.1f} с' if total_p95 is not None else '-'}, "
+                f"ошибок {health.error_rate():.0%}, "
+                f"замеров {health.count()}, выбрана в auto {self.routed[name]}, "
+                f"автомат {'разомкнут' if breaker.is_open() else 'замкнут'} (размыкался {breaker.opens})"
+            )
+        return result
+
+    def _choose(self, complex_query: bool, needs_web: bool) -> str:
+        candidates = self.catalog.auto_candidates()
+        if not candidates:
+            raise ValueError("В каталоге моделей нет ни одной модели для auto")
+        suitable = [
+            model for model in candidates
+            if (model.reasoning or not complex_query) and (model.web_search or not needs_web)
+        ] or candidates
+        if complex_query:
+            suitable.sort(key=lambda model: (-model.quality, model.price_output))
+        else:
+            suitable.sort(key=lambda model: (model.price_input + model.price_output, model.latency_target))
+        for model in suitable:
+            if self.is_healthy(model):
+                return model.name
+        # Деградировали все подходящие - берем ту, что сейчас реже ошибается и быстрее отвечает
+        return min(
+            suitable,
+            key=lambda model: (self._health(model.name).error_rate(), self._health(model.name).p95() or 0.0)
+        ).name
+
+    def _health(self, model: str, total: bool = False) -> ModelHealth:
+        windows = self.totals if total else self.health
+        health = windows.get(model)
+        if health is None:
+            health = windows[model] = ModelHealth(self.window_size, self.window_seconds)
+        return health
+
+
+_router: Optional[ModelRouter] = None
+
+
+def get_model_router() -> ModelRouter:
+    global _router
+    if _router is None:
+        settings = get_settings()
+        _router = ModelRouter(
+            get_model_catalog(),
+            settings.ROUTER_WINDOW_SIZE,
+            settings.ROUTER_WINDOW_SECONDS,
+            settings.ROUTER_MIN_SAMPLES,
+            settings.ROUTER_MAX_ERROR_RATE,
+            settings.ROUTER_SLOW_FACTOR,
+            settings.ROUTER_LONG_PROMPT_TOKENS,
+            settings.BREAKER_FAILURES,
+            settings.BREAKER_COOLDOWN,
+        )
+    return _router
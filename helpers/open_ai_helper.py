@@ -1,43 +1,37 @@
+import asyncio
 import logging
-from enum import StrEnum
-from typing import BinaryIO, Dict, Optional, List
-
-from openai import AsyncOpenAI
-
-from config.settings import CommonSettings
-
-token = CommonSettings().OPENAI_API_KEY
-
-# Храним последний response_id для каждого пользователя для продолжения разговора
-user_last_response_id: Dict[str, str] = {}
-
-# Модели, поддерживающие reasoning
-REASONING_MODELS = {
-    "gpt-5.1",
-    "gpt-5-mini",
-    "o4-mini"
-}
-
-# Модели, поддерживающие веб-поиск
-WEB_SEARCH_MODELS = {
-    "gpt-5.1",
-    "gpt-5-mini",
-    "o4-mini-deep-research",
-    "o4-mini"
-}
-
-
-class GPTModel(StrEnum):
-    gpt_5_1 = "gpt-5.1"
-    gpt_5_mini = "gpt-5-mini"
-    o4_mini = "o4-mini"
-    o4_mini_deep_research = "o4-mini-deep-research"
-
-
-def clean(user_id: str) -> None:
+import time
+import uuid
+from typing import Any, AsyncIterator, BinaryIO, Dict, Optional, List, Tuple
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.responses import Response
+
+from config.settings import get_openai_settings, get_settings
+from helpers.metrics import observe, record_usage, track
+from helpers.model_catalog import get_model_catalog
+from helpers.model_router import get_model_router
+from helpers.resilience import get_resilience
+from helpers.rate_limiter import ModelRateLimiter, RateLimit, estimate_tokens
+from helpers.response_cache import CacheEntry, get_response_cache
+from helpers.scheduler import get_scheduler
+from service.conversation_memory import Turn, get_conversation_memory, get_token_budget, is_local_memory, window
+from service.conversation_store import ConversationStore, get_conversation_store
+from service.usage_ledger import get_usage_ledger
+
+# Единственный клиент на процесс: создается при старте бота и закрывается при остановке
+_client: Optional[AsyncOpenAI] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_rate_limiter: Optional[ModelRateLimiter] = None
+# Пользователи, чья история сейчас сворачивается в краткое содержание, и сами фоновые задачи
+_compacting: Dict[str, asyncio.Task] = {}
+
+
+async def clean(user_id: str) -> None:
     """Очистить историю разговора для конкретного пользователя."""
-    if user_id in user_last_response_id:
-        del user_last_response_id[user_id]
+    await get_conversation_store().delete(user_id)
+    await get_conversation_memory().delete(user_id)
 
 
 async def generate_text(
@@ -53,112 +47,505 @@ async def generate_text(
     Args:
         user_id: user id to maintain separate conversation history
         content: User's message content
-        model: OpenAI model to use
+        model: OpenAI model to use, or "auto" to let helpers.model_router pick one
         developer_message: Optional system message to set context
-        use_web_search: Whether to enable web search tool for the request
+        use_web_search: Whether web search is allowed if the query looks like it needs it
 
     Returns:
         str containing the model's response text
     """
     client = get_client()
+    store = get_conversation_store()
+    router = get_model_router()
+    request_params = await prepare_request(user_id, content, model, developer_message, use_web_search)
+    primary = request_params["model"]
+    cache = get_response_cache()
+    cache_key = cache.make_key(request_params) if cache else None
+
+    async def attempt(attempt_model: str) -> Tuple[Response, Dict[str, Any]]:
+        params = request_params
+        if attempt_model != primary:
+            params = await prepare_request(user_id, content, attempt_model, developer_message, use_web_search)
+        estimated_tokens = estimate_request_tokens(params)
+        with track("llm", attempt_model):
+            async with get_scheduler().model_slot(attempt_model):
+                started = time.perf_counter()
+                try:
+                    response = await get_rate_limiter().call(
+                        attempt_model,
+                        estimated_tokens,
+                        lambda: client.responses.create(**params, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+                    )
+                except asyncio.CancelledError:
+                    # Проиграл хеджированному запросу: модель отвечает как минимум столько
+                    router.record_latency(attempt_model, time.perf_counter() - started, total=True)
+                    raise
+                except Exception:
+                    router.record(attempt_model, time.perf_counter() - started, ok=False, total=True)
+                    raise
+                router.record(attempt_model, time.perf_counter() - started, ok=True, total=True)
+        get_rate_limiter().settle(attempt_model, estimated_tokens, response.usage.total_tokens)
+        return response, params
+
+    try:
+        if cache_key and (cached := await cache.get(cache_key)):
+            await continue_from_cached(store, user_id, content, cached, primary)
+            return cached.text
+
+        (response, params), model = await get_resilience().call(primary, attempt)
+        response_text = extract_text(response)
+        # Сохраняем ID ответа или реплики для следующего запроса
+        await remember(user_id, content, response_text, response.id, model)
+        log_usage(response, model, user_id)
+        if cache and (key := cache.make_key(params)):
+            await cache.set(key, model, CacheEntry(response_text, response.id))
+        return response_text
+
+    except Exception as e:
+        logging.error(f"Ошибка при обращении к OpenAI API: {e}")
+        raise
+
+
+async def generate_text_stream(
+    user_id: str,
+    content: str,
+    model: str = "gpt-4o-mini",
+    developer_message: Optional[Dict] = None,
+    use_web_search: bool = False,
+) -> AsyncIterator[str]:
+    """
+    Same as generate_text, but yields response text deltas as soon as the model produces them.
+
+    The response id is saved for the next turn once the stream completes. Only the
+    first delta is raced against the fallback model, see helpers.resilience.
+    """
+    client = get_client()
+    store = get_conversation_store()
+    router = get_model_router()
+    request_params = await prepare_request(user_id, content, model, developer_message, use_web_search)
+    primary = request_params["model"]
+    cache = get_response_cache()
+    cache_key = cache.make_key(request_params) if cache else None
+
+    async def attempt(attempt_model: str) -> AsyncIterator[str]:
+        params = request_params
+        if attempt_model != primary:
+            params = await prepare_request(user_id, content, attempt_model, developer_message, use_web_search)
+        estimated_tokens = estimate_request_tokens(params)
+        key = cache.make_key(params) if cache else None
+        started = time.perf_counter()
+        first_token = True
+        with track("llm", attempt_model):
+            async with get_scheduler().model_slot(attempt_model):
+                try:
+                    # Повторить можно только установку потока: после первых токенов ответ уже у пользователя
+                    stream = await get_rate_limiter().call(
+                        attempt_model,
+                        estimated_tokens,
+                        lambda: client.responses.create(
+                            **params, stream=True, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT)
+                        )
+                    )
+                    async for event in stream:
+                        if event.type == "response.output_text.delta":
+                            if first_token:
+                                observe("llm_first_token", time.perf_counter() - started, attempt_model)
+                                router.record(attempt_model, time.perf_counter() - started, ok=True)
+                                first_token = False
+                            yield event.delta
+                        elif event.type == "response.completed":
+                            response_text = extract_text(event.response)
+                            await remember(user_id, content, response_text, event.response.id, attempt_model)
+                            log_usage(event.response, attempt_model, user_id)
+                            get_rate_limiter().settle(attempt_model, estimated_tokens, event.response.usage.total_tokens)
+                            if key:
+                                await cache.set(key, attempt_model, CacheEntry(response_text, event.response.id))  # type: ignore
+                        elif event.type in ("response.failed", "error"):
+                            raise RuntimeError(f"OpenAI прервал генерацию: {event}")
+                except asyncio.CancelledError:
+                    if first_token:
+                        # Проиграл хеджированному запросу: модель отвечает как минимум столько
+                        router.record_latency(attempt_model, time.perf_counter() - started)
+                    raise
+                except Exception:
+                    router.record(attempt_model, time.perf_counter() - started, ok=False)
+                    raise
+
+    try:
+        if cache_key and (cached := await cache.get(cache_key)):
+            await continue_from_cached(store, user_id, content, cached, primary)
+            yield cached.text
+            return
+
+        async for delta in get_resilience().stream(primary, attempt):
+            yield delta
+
+    except Exception as e:
+        logging.error(f"Ошибка при обращении к OpenAI API: {e}")
+        raise
+
+
+async def submit_background(user_id: str, content: str, model: str) -> str:
+    """Отправляет запрос в фоновом режиме OpenAI и возвращает id ответа для опроса"""
+    client = get_client()
+    catalog = get_model_catalog()
+    request_params = await build_request_params(
+        user_id, content, model, use_web_search=catalog.supports_web_search(model)
+    )
+    request_params["background"] = True
+    # Фоновый режим работает только с ответами, сохраненными на сервере
+    request_params["store"] = True
+    response = await get_rate_limiter().call(
+        model,
+        estimate_request_tokens(request_params),
+        lambda: client.responses.create(**request_params, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+    )
+    return response.id
+
+
+async def retrieve_response(response_id: str) -> Response:
+    client = get_client()
+    return await get_rate_limiter().call(
+        "responses.retrieve",
+        0,
+        lambda: client.responses.retrieve(response_id, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+    )
+
+
+async def cancel_background(response_id: str) -> None:
+    await get_client().responses.cancel(response_id, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+
+
+async def finish_background(user_id: str, prompt: str, response: Response, model: str) -> str:
+    """
+    Продолжает диалог с готового фонового ответа и возвращает его текст. В локальном режиме
+    ответ дописывается в историю отдельной репликой. С историей на сервере цепочка переходит
+    на фоновый ответ, только если пользователь не продолжал диалог, пока шла задача
+    """
+    response_text = extract_text(response)
+    if is_local_memory():
+        await remember(user_id, prompt, response_text, response.id, model)
+    elif not await get_conversation_store().replace(user_id, response.previous_response_id, response.id):
+        logging.info(f"Диалог пользователя {user_id} продолжился, пока шла фоновая задача: цепочка не меняется")
+    if response.usage is not None:
+        log_usage(response, model, user_id)
+    return response_text
+
+
+async def prepare_request(
+    user_id: str,
+    content: str,
+    model: str,
+    developer_message: Optional[Dict] = None,
+    use_web_search: bool = False,
+) -> Dict[str, Any]:
+    """Выбирает модель и параметры через helpers.model_router и формирует запрос"""
+    route = get_model_router().route(model, content, use_web_search)
+    return await build_request_params(
+        user_id, content, route.model, developer_message, route.web_search, route.reasoning_effort
+    )
+
+
+async def build_request_params(
+    user_id: str,
+    content: str,
+    model: str,
+    developer_message: Optional[Dict] = None,
+    use_web_search: bool = False,
+    reasoning_effort: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Формирует параметры запроса к Responses API с учетом истории пользователя.
+    Усилие reasoning и нужность веб-поиска выбирает helpers.model_router
+    """
     input_content = []
     if developer_message and isinstance(developer_message, dict):
         input_content.append(
             {"role": "system", "content": developer_message.get("content", "")}
         )
+    previous_response_id = None
+    if is_local_memory():
+        # История идет в самом запросе: содержание и последние реплики в пределах бюджета модели
+        transcript = await get_conversation_memory().get(user_id)
+        if transcript.summary:
+            input_content.append(
+                {"role": "system", "content": f"Краткое содержание предыдущего разговора: {transcript.summary}"}
+            )
+        input_content.extend(window(transcript, get_token_budget(model)))
+    else:
+        previous_response_id = await get_conversation_store().get(user_id)
     input_content.append({"role": "user", "content": content})
-    previous_response_id = user_last_response_id.get(user_id)
 
+    catalog = get_model_catalog()
     reasoning = None
-    if model in REASONING_MODELS:
-        reasoning = {"effort": "medium"}
+    if reasoning_effort and catalog.supports_reasoning(model):
+        reasoning = {"effort": reasoning_effort}
 
     tools = []
     if use_web_search:
-        if model in WEB_SEARCH_MODELS:
+        if catalog.supports_web_search(model):
             tools.append({"type": "web_search"})
         else:
             logging.warning(f"Веб-поиск запрошен, но модель {model} его не поддерживает")
 
-    try:
-        # Формируем параметры запроса
-        request_params = {
-            "model": model,
-            "input": input_content if not previous_response_id else content,
-            "store": True,
-        }
+    request_params: Dict[str, Any] = {
+        "model": model,
+        "input": input_content if not previous_response_id else content,
+        # В локальном режиме ответ на сервере OpenAI не нужен для следующей реплики
+        "store": not is_local_memory(),
+    }
 
-        if previous_response_id:
-            request_params["previous_response_id"] = previous_response_id
+    if previous_response_id:
+        request_params["previous_response_id"] = previous_response_id
 
-        if reasoning:
-            request_params["reasoning"] = reasoning
+    if reasoning:
+        request_params["reasoning"] = reasoning
 
-        if tools:
-            request_params["tools"] = tools
+    if tools:
+        request_params["tools"] = tools
 
-        response = await client.responses.create(**request_params)
+    return request_params
 
-        # Сохраняем ID ответа для следующего запроса
-        user_last_response_id[user_id] = response.id
 
-        # Извлекаем текст ответа
-        response_text = ""
-        for output in response.output:
-            if hasattr(output, "content") and output.content:
-                for content_item in output.content:
-                    if hasattr(content_item, "text"):
-                        response_text += content_item.text
+async def continue_from_cached(
+    store: ConversationStore, user_id: str, content: str, cached: CacheEntry, model: str
+) -> None:
+    """
+    Ответ из кэша продолжает диалог так же, как свежий: сохраненный на сервере ответ
+    с тем же входом годится как previous_response_id для следующей реплики
+    """
+    if is_local_memory():
+        await remember(user_id, content, cached.text, cached.response_id, model)
+    elif cached.response_id:
+        await store.set(user_id, cached.response_id)
+    else:
+        await store.delete(user_id)
+
+
+async def remember(user_id: str, content: str, response_text: str, response_id: Optional[str], model: str) -> None:
+    """
+    Запоминает реплику для следующего запроса. В локальном режиме дописывает ее в историю
+    и, если история вышла за бюджет, сворачивает старые реплики в фоне, не задерживая ответ
+    """
+    if not is_local_memory():
+        if response_id:
+            await get_conversation_store().set(user_id, response_id)
+        return
+    transcript = await get_conversation_memory().append(
+        user_id,
+        [{"role": "user", "content": content}, {"role": "assistant", "content": response_text}]
+    )
+    if transcript.turns_tokens() > get_token_budget(model) and user_id not in _compacting:
+        task = asyncio.create_task(compact_conversation(user_id, model))
+        _compacting[user_id] = task
+        task.add_done_callback(lambda _: _compacting.pop(user_id, None))
 
-        logging.info(
-            f"Запрос к {response.model} использовал {response.usage.total_tokens} токенов"
-        )
-        return response_text
 
+async def compact_conversation(user_id: str, model: str) -> None:
+    """
+    Сворачивает самые старые реплики в краткое содержание так, чтобы оставшиеся
+    занимали не больше половины бюджета. Последний обмен репликами всегда остается целиком
+    """
+    memory = get_conversation_memory()
+    transcript = await memory.get(user_id)
+    keep_tokens = get_token_budget(model) // 2
+    count = len(transcript.turns)
+    kept = 0
+    while count > 0:
+        kept += estimate_tokens(transcript.turns[count - 1]["content"])
+        if kept > keep_tokens and len(transcript.turns) - count >= 2:
+            break
+        count -= 1
+    if count <= 0:
+        return
+    try:
+        summary = await summarize_turns(transcript.summary, transcript.turns[:count])
     except Exception as e:
-        logging.error(f"Ошибка при обращении к OpenAI API: {e}")
-        raise
+        logging.warning(f"Не удалось свернуть историю пользователя {user_id}: {e}")
+        return
+    if not await memory.compact(user_id, transcript, count, summary):
+        logging.info(f"История пользователя {user_id} изменилась, пока сворачивалась: содержание отброшено")
+
+
+async def summarize_turns(summary: str, turns: List[Turn]) -> str:
+    """Дополняет краткое содержание разговора репликами, которые выпадают из окна"""
+    summary_model = get_settings().CONVERSATION_SUMMARY_MODEL
+    max_chars = get_settings().CONVERSATION_SUMMARY_MAX_CHARS
+    dialogue = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    system_prompt = (
+        "Update the summary of a conversation with its new lines. Keep facts about the user, "
+        f"topics discussed and open questions. Answer with the summary only, at most {max_chars} characters."
+    )
+    request_params: Dict[str, Any] = {
+        "model": summary_model,
+        "input": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Summary: {summary or '-'}\n\nNew lines:\n{dialogue}"},
+        ],
+        "store": False,
+    }
+    client = get_client()
+    estimated_tokens = estimate_request_tokens(request_params)
+    with track("llm", summary_model):
+        async with get_scheduler().model_slot(summary_model):
+            response = await get_rate_limiter().call(
+                summary_model,
+                estimated_tokens,
+                lambda: client.responses.create(**request_params, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+            )
+    record_usage(summary_model, response.usage)
+    get_rate_limiter().settle(summary_model, estimated_tokens, response.usage.total_tokens)
+    return extract_text(response).strip()[:max_chars]
+
+
+def extract_text(response: Response) -> str:
+    """Склеивает текст из всех output-элементов ответа"""
+    response_text = ""
+    for output in response.output:
+        if hasattr(output, "content") and output.content:
+            for content_item in output.content:
+                if hasattr(content_item, "text"):
+                    response_text += content_item.text
+    return response_text
+
+
+def estimate_request_tokens(request_params: Dict[str, Any]) -> int:
+    """Оценка токенов запроса для лимита TPM до отправки"""
+    content = request_params["input"]
+    if not isinstance(content, str):
+        content = " ".join(str(item.get("content", "")) for item in content)
+    return estimate_tokens(content, expected_output=get_openai_settings().OPENAI_EXPECTED_OUTPUT_TOKENS)
+
+
+def log_usage(response: Response, model: str, user_id: str) -> None:
+    logging.info(
+        f"Запрос к {response.model} использовал {response.usage.total_tokens} токенов"
+    )
+    record_usage(model, response.usage)
+    get_usage_ledger().record(int(user_id), model, response.usage)
 
 
 async def audio_to_text(audio_file: BinaryIO) -> str:
     client = get_client()
-    transcription = await client.audio.transcriptions.create(
-        model="whisper-1", file=audio_file, response_format="text"
-    )
-    return transcription
 
+    async def request() -> str:
+        # При повторе файл нужно отправить с начала
+        audio_file.seek(0)
+        return await client.audio.transcriptions.create(
+            model="whisper-1",
+            file=audio_file,
+            response_format="text",
+            timeout=get_timeout(get_openai_settings().OPENAI_WHISPER_TIMEOUT),
+        )
+
+    with track("whisper", "whisper-1"):
+        async with get_scheduler().model_slot("whisper-1"):
+            return await get_rate_limiter().call("whisper-1", 0, request)
 
-async def text_to_audio(text: str, response_format: str = "mp3") -> BinaryIO:
+
+async def audio_to_text_stream(chunks: AsyncIterator[bytes], filename: str) -> str:
+    """
+    Transcribe audio while it is still being downloaded.
+
+    The SDK only accepts whole files, so the multipart body is built here and sent
+    with chunked transfer encoding through the shared HTTP pool. A streamed body
+    cannot be replayed, so the request is rate limited but never retried.
+    """
     client = get_client()
-    response = await client.audio.speech.create(
-        model="tts-1",
-        voice="alloy",
-        input=text,
-        response_format=response_format,  # type: ignore
-    )
-    return response.read()  # type: ignore
+    boundary = uuid.uuid4().hex
+    # default_headers клиента содержат заглушки Omit, поэтому заголовки собираются явно
+    headers = {
+        "Authorization": f"Bearer {client.api_key}",
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+    }
+    if client.organization:
+        headers["OpenAI-Organization"] = client.organization
+    if client.project:
+        headers["OpenAI-Project"] = client.project
+
+    async def body() -> AsyncIterator[bytes]:
+        for name, value in (("model", "whisper-1"), ("response_format", "text")):
+            yield f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        async for chunk in chunks:
+            yield chunk
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    with track("whisper", "whisper-1"):
+        async with get_scheduler().model_slot("whisper-1"):
+            await get_rate_limiter().acquire("whisper-1", 0)
+            response = await _http_client.post(  # type: ignore
+                f"{str(client.base_url).rstrip('/')}/audio/transcriptions",
+                content=body(),
+                headers=headers,
+                timeout=get_timeout(get_openai_settings().OPENAI_WHISPER_TIMEOUT),
+            )
+        if response.status_code >= 400:
+            raise RuntimeError(f"Whisper вернул {response.status_code}: {response.text[:200]}")
+    return response.text.strip()
+
+
+async def text_to_audio(text: str, response_format: str = "mp3", voice: str = "alloy", model: str = "tts-1") -> bytes:
+    """
+    Синтезирует речь. Аудио читается из потока по частям, но отдается целиком:
+    фрагмент уходит в Telegram одним голосовым сообщением и целиком ложится в кэш
+    """
+    client = get_client()
+
+    async def request() -> bytes:
+        audio = bytearray()
+        async with client.audio.speech.with_streaming_response.create(
+            model=model,
+            voice=voice,  # type: ignore
+            input=text,
+            response_format=response_format,  # type: ignore
+            timeout=get_timeout(get_openai_settings().OPENAI_TTS_TIMEOUT),
+        ) as response:
+            async for chunk in response.iter_bytes(chunk_size=16384):
+                audio.extend(chunk)
+        return bytes(audio)
+
+    with track("tts", model):
+        async with get_scheduler().model_slot(model):
+            return await get_rate_limiter().call(model, 0, request)
+
+
+FRIEND_PROMPT = {"role": "system", "content": """You are an american man. We are in a friendly dialogue.
+    You can express your opinion and use informal phrases.
+    Sometimes you can make jokes or ironical tone. 
+    """}
+
+TEACHER_PROMPT = {"role": "system", "content": """You are a helpful english teacher. 
+    Please help to improve grammar, vocabulary and naturalness of this speech.
+    Make verbose comment about errors in this areas.
+    """}
 
 
 async def get_answer_from_friend(
     user_id: str, content: str, model: str = "gpt-4o-mini"
 ) -> str:
-    prompt = """You are an american man. We are in a friendly dialogue.
-    You can express your opinion and use informal phrases.
-    Sometimes you can make jokes or ironical tone. 
-    """
-    developer_message = {"role": "system", "content": prompt}
-    return await generate_text(user_id, content, model, developer_message)
+    return await generate_text(user_id, content, model, FRIEND_PROMPT)
+
+
+def stream_answer_from_friend(
+    user_id: str, content: str, model: str = "gpt-4o-mini"
+) -> AsyncIterator[str]:
+    return generate_text_stream(user_id, content, model, FRIEND_PROMPT)
 
 
 async def get_english_teacher_comment(
     user_id: str, content: str, model: str = "gpt-4o-mini"
 ) -> str:
-    prompt = """You are a helpful english teacher. 
-    Please help to improve grammar, vocabulary and naturalness of this speech.
-    Make verbose comment about errors in this areas.
-    """
-    developer_message = {"role": "system", "content": prompt}
-    return await generate_text(user_id, content, model, developer_message)
+    return await generate_text(user_id, content, model, TEACHER_PROMPT)
+
+
+def stream_english_teacher_comment(
+    user_id: str, content: str, model: str = "gpt-4o-mini"
+) -> AsyncIterator[str]:
+    return generate_text_stream(user_id, content, model, TEACHER_PROMPT)
 
 
 async def generate_text_with_web_search(
@@ -186,23 +573,33 @@ async def improve_transcript_by_gpt(transcript: str) -> str:
 
     try:
         client = get_client()
-        response = await client.responses.create(
-            model="gpt-4o",
-            input=[
+        request_params: Dict[str, Any] = {
+            "model": "gpt-4o",
+            "input": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": transcript},
             ],
-            store=False,
-        )
-
-        # Извлекаем текст ответа
-        response_text = ""
-        for output in response.output:
-            if hasattr(output, "content") and output.content:
-                for content_item in output.content:
-                    if hasattr(content_item, "text"):
-                        response_text += content_item.text
-
+            "store": False,
+        }
+        cache = get_response_cache()
+        cache_key = cache.make_key(request_params) if cache else None
+        if cache_key and (cached := await cache.get(cache_key)):
+            return cached.text
+
+        estimated_tokens = estimate_tokens(system_prompt, transcript, expected_output=len(transcript) // 3)
+        with track("llm", "gpt-4o"):
+            async with get_scheduler().model_slot("gpt-4o"):
+                response = await get_rate_limiter().call(
+                    "gpt-4o",
+                    estimated_tokens,
+                    lambda: client.responses.create(**request_params, timeout=get_timeout(get_openai_settings().OPENAI_CHAT_TIMEOUT))
+                )
+        record_usage("gpt-4o", response.usage)
+        get_rate_limiter().settle("gpt-4o", estimated_tokens, response.usage.total_tokens)
+
+        response_text = extract_text(response)
+        if cache_key:
+            await cache.set(cache_key, "gpt-4o", CacheEntry(response_text, None))
         return response_text
 
     except Exception as e:
@@ -210,9 +607,79 @@ async def improve_transcript_by_gpt(transcript: str) -> str:
         raise
 
 
+def init_client() -> AsyncOpenAI:
+    """Создает общий клиент с пулом keep-alive соединений, если он еще не создан"""
+    global _client, _http_client
+    if _client is None:
+        settings = get_openai_settings()
+        _http_client = http_client = DefaultAsyncHttpxClient(
+            http2=settings.OPENAI_HTTP2,
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=get_timeout(settings.OPENAI_CHAT_TIMEOUT),
+        )
+        _client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            organization="org-ivGGIRGxUk5rZmvxkoypdUUy",
+            project="proj_t7kgt6Awz7m2knmH4gL0xeh2",
+            http_client=http_client,
+            # Повторы делает ModelRateLimiter с учетом лимитов и бюджета задержки
+            max_retries=0,
+        )
+    return _client
+
+
+async def warm_client() -> None:
+    """Открывает соединение с OpenAI заранее, чтобы первый запрос не платил за TCP и TLS"""
+    client = init_client()
+    try:
+        await client.models.list(timeout=get_timeout(get_openai_settings().OPENAI_CONNECT_TIMEOUT))
+    except Exception as e:
+        logging.warning(f"Не удалось заранее подключиться к OpenAI: {e}")
+
+
+def get_rate_limiter() -> ModelRateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        settings = get_openai_settings()
+        # Лимиты нашего тарифа из каталога моделей, переопределяются через OPENAI_RATE_LIMITS
+        limits = {
+            model.name: RateLimit(rpm=model.rpm, tpm=model.tpm or 0)
+            for model in get_model_catalog().models.values() if model.rpm
+        }
+        overrides = {model: RateLimit(**limit) for model, limit in settings.OPENAI_RATE_LIMITS.items()}
+        _rate_limiter = ModelRateLimiter(
+            limits={**limits, **overrides},
+            default_limit=RateLimit(rpm=settings.OPENAI_DEFAULT_RPM, tpm=settings.OPENAI_DEFAULT_TPM),
+            headroom=settings.OPENAI_RATE_HEADROOM,
+            retry_budget=settings.OPENAI_RETRY_BUDGET,
+            max_attempts=settings.OPENAI_MAX_ATTEMPTS,
+            backoff_base=settings.OPENAI_BACKOFF_BASE,
+            backoff_cap=settings.OPENAI_BACKOFF_CAP,
+        )
+    return _rate_limiter
+
+
+async def close_client() -> None:
+    """Закрывает общий клиент и его соединения. Вызывается при остановке бота"""
+    global _client, _http_client
+    for task in list(_compacting.values()):
+        task.cancel()
+    await asyncio.gather(*_compacting.values(), return_exceptions=True)
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _http_client = None
+
+
 def get_client() -> AsyncOpenAI:
-    return AsyncOpenAI(
-        api_key=token,
-        organization="org-ivGGIRGxUk5rZmvxkoypdUUy",
-        project="proj_t7kgt6Awz7m2knmH4gL0xeh2",
-    )
+    return init_client()
+
+
+def get_timeout(seconds: float) -> httpx.Timeout:
+    """Таймаут операции с отдельным, более коротким таймаутом на подключение"""
+    return httpx.Timeout(seconds, connect=get_openai_settings().OPENAI_CONNECT_TIMEOUT)
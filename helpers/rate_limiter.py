@@ -0,0 +1,194 @@
+"""
+Клиентский ограничитель частоты запросов к OpenAI.
+
+Classes
+--------
+TokenBucket
+    Ведро токенов с равномерным пополнением. Им считаются и запросы, и токены в минуту.
+ModelRateLimiter
+    Пара ведер (RPM и TPM) на каждую модель и повтор запросов при 429 и 5xx
+    с учетом Retry-After и экспоненциальной задержкой со случайным разбросом.
+"""
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Лимиты тарифа для модели. tpm = 0 - токены не ограничиваются"""
+    rpm: int
+    tpm: int = 0
+
+
+class TokenBucket:
+
+    def __repr__(self) -> str:
+        return f"TokenBucket(rate={self.rate_per_second * 60:.0f}/мин, tokens={self.tokens:.0f})"
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """capacity - допустимый всплеск, по умолчанию равен минутному лимиту"""
+        self.capacity = per_minute if capacity is None else capacity
+        self.rate_per_second = per_minute / 60
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float) -> None:
+        """Ждет, пока в ведре наберется amount. Ожидающие обслуживаются по очереди"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate_per_second)
+
+    def adjust(self, amount: float) -> None:
+        """Возвращает (amount > 0) или досписывает (amount < 0) токены после ответа"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд - так сервер просит через Retry-After"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate_per_second)
+        self._updated_at = now
+
+
+class ModelRateLimiter:
+
+    def __init__(
+            self,
+            limits: dict[str, RateLimit],
+            default_limit: RateLimit,
+            headroom: float,
+            retry_budget: float,
+            max_attempts: int,
+            backoff_base: float,
+            backoff_cap: float
+    ):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.headroom = headroom
+        self.retry_budget = retry_budget
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retries = 0
+        self.throttled = 0
+        self._requests: dict[str, TokenBucket] = {}
+        self._tokens: dict[str, Optional[TokenBucket]] = {}
+
+    async def call(self, model: str, estimated_tokens: int, request: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет запрос в пределах лимитов модели, повторяя его при временных ошибках"""
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            await self.acquire(model, estimated_tokens)
+            try:
+                return await request()
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if not is_retryable(e):
+                    raise
+                if retry_after is not None:
+                    self.throttled += 1
+                    self._get_requests_bucket(model).pause(retry_after)
+                    delay = retry_after + random.uniform(0, self.backoff_base)
+                else:
+                    delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                if attempt >= self.max_attempts or time.monotonic() + delay > deadline:
+                    raise
+                self.retries += 1
+                logging.warning(f"Повтор запроса к {model} через {delay:.1f} с (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(delay)
+
+    async def acquire(self, model: str, estimated_tokens: int) -> None:
+        await self._get_requests_bucket(model).acquire(1)
+        tokens = self._get_tokens_bucket(model)
+        if tokens is not None and estimated_tokens:
+            await tokens.acquire(estimated_tokens)
+
+    def settle(self, model: str, estimated_tokens: int, actual_tokens: int) -> None:
+        """Поправляет ведро токенов по фактическому расходу из response.usage"""
+        tokens = self._get_tokens_bucket(model)
+        if tokens is not None:
+            tokens.adjust(estimated_tokens - actual_tokens)
+
+    def stats(self) -> dict[str, float]:
+        result: dict[str, float] = {"retries": self.retries, "throttled": self.throttled}
+        for model, bucket in self._requests.items():
+            result[f"{model} requests"] = round(bucket.tokens)
+            tokens = self._tokens.get(model)
+            if tokens is not None:
+                result[f"{model} tokens"] = round(tokens.tokens)
+        return result
+
+    def _get_limit(self, model: str) -> RateLimit:
+        return self.limits.get(model, self.default_limit)
+
+    def _get_requests_bucket(self, model: str) -> TokenBucket:
+        if model not in self._requests:
+            self._requests[model] = TokenBucket(self._get_limit(model).rpm * self.headroom)
+        return self._requests[model]
+
+    def _get_tokens_bucket(self, model: str) -> Optional[TokenBucket]:
+        if model not in self._tokens:
+            tpm = self._get_limit(model).tpm
+            self._tokens[model] = TokenBucket(tpm * self.headroom) if tpm else None
+        return self._tokens[model]
+
+
+def is_retryable(error: Exception) -> bool:
+    """429 (кроме исчерпанной квоты), 5xx, таймауты и обрывы соединения"""
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 409
+    return isinstance(error, (openai.APITimeoutError, openai.APIConnectionError))
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Читает retry-after-ms или retry-after из ответа с ошибкой"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if value := headers.get("retry-after-ms"):
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if value := headers.get("retry-after"):
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def estimate_tokens(*texts: str, expected_output: int = 0) -> int:
+    """Грубая оценка до отправки: ~3 символа на токен с запасом на кириллицу"""
+    return sum(len(text) for text in texts) // 3 + 1 + expected_output
@@ -0,0 +1,219 @@
+"""
+Хеджирование запросов к моделям и переход на запасную модель.
+
+Запрос уходит основной модели. Если она не дала первого ответа за HEDGE_PERCENTILE
+своей недавней задержки, параллельно уходит такой же запрос к запасной модели fallback
+из каталога. Для потока это задержка до первого фрагмента (пока замеров мало -
+latency_target из каталога), для ответа без потока - полное время ответов без потока:
+пока их замеров мало, такой запрос не хеджируется. Побеждает первый
+успешный ответ, проигравший отменяется. Если основная модель упала раньше, запасная
+запускается сразу, а при разомкнутом автомате основной модели запрос идет только
+к запасной.
+
+Для потоковых ответов гонка идет до первого фрагмента текста: дальше поток
+победителя передается как есть. Ожидание первого фрагмента ограничено сроком deadline
+основной модели из каталога. Ответ без потока приходит только целиком, и долгий ответ
+там не значит зависание, поэтому deadline к нему не применяется: его ограничивает
+таймаут HTTP-клиента. Экономия задержки - нижняя оценка: медиана основной модели
+минус фактическое время ответа запасной.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from config.settings import get_settings
+from helpers.model_catalog import ModelCatalog, get_model_catalog
+from helpers.model_router import ModelRouter, get_model_router
+
+T = TypeVar("T")
+
+
+@dataclass
+class ResilienceStats:
+    requests: int = 0
+    hedged: int = 0
+    failovers: int = 0
+    rerouted: int = 0
+    fallback_wins: int = 0
+    deadline_exceeded: int = 0
+    saved_seconds: float = 0.0
+
+    def as_dict(self) -> dict[str, str | int]:
+        hit_rate = self.fallback_wins / self.requests if self.requests else 0.0
+        return {
+            "запросов": self.requests,
+            "хеджировано": self.hedged,
+            "переходов после ошибки": self.failovers,
+            "в обход разомкнутого автомата": self.rerouted,
+            "ответила запасная": f"{self.fallback_wins} ({hit_rate:.1%})",
+            "истек срок": self.deadline_exceeded,
+            "сэкономлено, с": f"{self.saved_seconds:.1f}",
+        }
+
+
+class Resilience:
+
+    def __init__(
+            self,
+            catalog: ModelCatalog,
+            router: ModelRouter,
+            enabled: bool,
+            hedge_percentile: float,
+            hedge_min_delay: float
+    ):
+        self.catalog = catalog
+        self.router = router
+        self.enabled = enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.counters = ResilienceStats()
+
+    async def call(self, primary: str, attempt: Callable[[str], Awaitable[T]]) -> tuple[T, str]:
+        """Выполняет attempt(model) для основной модели, при необходимости и для запасной"""
+        return await self._run(primary, attempt, streaming=False)
+
+    async def stream(self, primary: str, attempt: Callable[[str], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """То же для потока: гонка до первого фрагмента, дальше - поток победителя"""
+
+        async def first(model: str) -> tuple[Optional[str], AsyncIterator[str]]:
+            iterator = attempt(model)
+            return await anext(iterator, None), iterator
+
+        async def discard(started: tuple[Optional[str], AsyncIterator[str]]) -> None:
+            await started[1].aclose()  # type: ignore
+
+        (delta, iterator), _ = await self._run(primary, first, streaming=True, discard=discard)
+        try:
+            if delta is None:
+                return
+            yield delta
+            async for delta in iterator:
+                yield delta
+        finally:
+            await iterator.aclose()  # type: ignore
+
+    def stats(self) -> dict[str, str | int]:
+        return self.counters.as_dict()
+
+    async def _run(
+            self,
+            primary: str,
+            start: Callable[[str], Awaitable[T]],
+            streaming: bool,
+            discard: Optional[Callable[[T], Awaitable[None]]] = None
+    ) -> tuple[T, str]:
+        self.counters.requests += 1
+        info = self.catalog.get(primary)
+        if not self.enabled or info is None:
+            return await start(primary), primary
+        if not streaming:
+            return await self._race(primary, start, discard, total=True)
+        try:
+            async with asyncio.timeout(info.deadline):
+                return await self._race(primary, start, discard, total=False)
+        except TimeoutError:
+            self.counters.deadline_exceeded += 1
+            self.router.record(primary, info.deadline, ok=False)
+            raise TimeoutError(f"Модель {primary} не ответила за {info.deadline:.0f} с")
+
+    async def _race(
+            self,
+            primary: str,
+            start: Callable[[str], Awaitable[T]],
+            discard: Optional[Callable[[T], Awaitable[None]]],
+            total: bool
+    ) -> tuple[T, str]:
+        """total - сравнивать с полным временем ответов без потока, а не с первым фрагментом"""
+        fallback = self.catalog.fallback_for(primary)
+        if fallback is not None and self.router.breaker(fallback).is_open():
+            fallback = None
+        started = time.monotonic()
+        tasks: dict[asyncio.Task[T], str] = {}
+        if fallback is not None and not self.router.breaker(primary).allow():
+            logging.warning(f"Автомат модели {primary} разомкнут, запрос уходит {fallback}")
+            self.counters.rerouted += 1
+            tasks[self._spawn(start, fallback)] = fallback
+            fallback = None
+        else:
+            tasks[self._spawn(start, primary)] = primary
+        delay = self._hedge_delay(primary, total)
+        hedge_at = started + delay if delay is not None else None
+        error: Optional[BaseException] = None
+        winner: Optional[asyncio.Task[T]] = None
+        try:
+            while tasks and winner is None:
+                timeout = None
+                if fallback is not None and hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.counters.hedged += 1
+                    tasks[self._spawn(start, fallback)] = fallback  # type: ignore
+                    fallback = None
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                        continue
+                    model = tasks.pop(task)
+                    error = error or task.exception()
+                    logging.warning(f"Модель {model} не ответила: {task.exception()}")
+                    if fallback is not None:
+                        self.counters.failovers += 1
+                        tasks[self._spawn(start, fallback)] = fallback
+                        fallback = None
+            if winner is None:
+                raise error  # type: ignore
+            model = tasks.pop(winner)
+            if model != primary:
+                self.counters.fallback_wins += 1
+                median = self.router.percentile(primary, 0.5, total)
+                if median is not None:
+                    self.counters.saved_seconds += max(0.0, median - (time.monotonic() - started))
+            return winner.result(), model
+        finally:
+            # Проигравшие отменяются, а уже успевшие ответить закрываются
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if discard is not None:
+                for task in tasks:
+                    if not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
+
+    @staticmethod
+    def _spawn(start: Callable[[str], Awaitable[T]], model: str) -> asyncio.Task[T]:
+        async def run() -> T:
+            return await start(model)
+
+        return asyncio.create_task(run())
+
+    def _hedge_delay(self, model: str, total: bool) -> Optional[float]:
+        """Через сколько секунд отправить запрос запасной модели. None - не хеджировать"""
+        delay = self.router.percentile(model, self.hedge_percentile, total)
+        if delay is None:
+            # latency_target - ожидание первого фрагмента, для полного ответа оценки нет
+            info = self.catalog.get(model)
+            if total or info is None:
+                return None
+            delay = info.latency_target
+        return max(self.hedge_min_delay, delay)
+
+
+_resilience: Optional[Resilience] = None
+
+
+def get_resilience() -> Resilience:
+    global _resilience
+    if _resilience is None:
+        settings = get_settings()
+        _resilience = Resilience(
+            get_model_catalog(),
+            get_model_router(),
+            settings.HEDGE_ENABLED,
+            settings.HEDGE_PERCENTILE,
+            settings.HEDGE_MIN_DELAY,
+        )
+    return _resilience
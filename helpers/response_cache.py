@@ -0,0 +1,159 @@
+"""
+Кэш ответов на запросы, которые не зависят от истории диалога.
+
+Такой запрос - чистая функция от модели, системного промпта, текста и инструментов,
+поэтому ключом служит sha256 нормализованного запроса. Первый уровень - LRU в памяти,
+второй (по RESPONSE_CACHE_PERSISTENT) - таблица response_cache.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy import delete, select, func
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import get_settings
+from domain.models import CachedResponse
+from helpers.cache import TTLCache
+from service.database import get_session_factory
+
+
+class CacheEntry(NamedTuple):
+    text: str
+    response_id: Optional[str]
+
+
+class ResponseCache:
+
+    def __init__(
+            self,
+            maxsize: int,
+            max_entry_chars: int,
+            default_ttl: float,
+            ttls: dict[str, float],
+            persistent: bool,
+            cache_web_search: bool
+    ):
+        self.memory: TTLCache[str, CacheEntry] = TTLCache(maxsize, default_ttl)
+        self.max_entry_chars = max_entry_chars
+        self.default_ttl = default_ttl
+        self.ttls = ttls
+        self.persistent = persistent
+        self.cache_web_search = cache_web_search
+        self.db_hits = 0
+
+    def make_key(self, request_params: dict[str, Any]) -> Optional[str]:
+        """Ключ запроса или None, если запрос кэшировать нельзя"""
+        if request_params.get("previous_response_id"):
+            return None
+        if request_params.get("tools") and not self.cache_web_search:
+            return None
+        request_input = request_params["input"]
+        if isinstance(request_input, str):
+            request_input = [{"role": "user", "content": request_input}]
+        normalized = {
+            "model": request_params["model"],
+            "input": [
+                {"role": item.get("role"), "content": " ".join(str(item.get("content", "")).split())}
+                for item in request_input
+            ],
+            "tools": request_params.get("tools"),
+            "reasoning": request_params.get("reasoning"),
+        }
+        payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self.memory.get(key)
+        if entry is not None or not self.persistent:
+            return entry
+        try:
+            factory = get_session_factory()
+            async with factory() as session:
+                result = await session.execute(
+                    select(CachedResponse).where(CachedResponse.key == key).where(CachedResponse.expires_at > func.now())
+                )
+                row = result.scalar_one_or_none()
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать кэш ответов из БД: {e}")
+            return None
+        if row is None:
+            return None
+        self.db_hits += 1
+        entry = CacheEntry(row.text, row.response_id)
+        self.memory.set(key, entry, ttl=self.get_ttl(row.model))
+        return entry
+
+    async def set(self, key: str, model: str, entry: CacheEntry) -> None:
+        if not entry.text or len(entry.text) > self.max_entry_chars:
+            return
+        ttl = self.get_ttl(model)
+        self.memory.set(key, entry, ttl=ttl)
+        if not self.persistent:
+            return
+        statement = insert(CachedResponse).values(
+            key=key,
+            model=model,
+            text=entry.text,
+            response_id=entry.response_id,
+            expires_at=func.now() + timedelta(seconds=ttl)
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[CachedResponse.key],
+            set_={
+                "text": statement.excluded.text,
+                "response_id": statement.excluded.response_id,
+                "expires_at": statement.excluded.expires_at,
+            }
+        )
+        try:
+            factory = get_session_factory()
+            async with factory() as session:
+                await session.execute(statement)
+                await session.commit()
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить ответ в кэш БД: {e}")
+
+    async def purge_expired(self) -> int:
+        if not self.persistent:
+            return 0
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(delete(CachedResponse).where(CachedResponse.expires_at <= func.now()))
+            await session.commit()
+        return result.rowcount  # type: ignore
+
+    def get_ttl(self, model: str) -> float:
+        return self.ttls.get(model, self.default_ttl)
+
+    def stats(self) -> dict[str, float]:
+        result = self.memory.stats()
+        if self.persistent:
+            result["db_hits"] = self.db_hits
+            # Промах памяти, найденный в БД, для пользователя все равно попадание
+            total = self.memory.hits + self.memory.misses
+            result["hit_rate"] = round((self.memory.hits + self.db_hits) / total, 3) if total else 0.0
+        return result
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Кэш ответов или None, если он выключен в настройках"""
+    global _cache
+    settings = get_settings()
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = ResponseCache(
+            maxsize=settings.RESPONSE_CACHE_SIZE,
+            max_entry_chars=settings.RESPONSE_CACHE_MAX_ENTRY_CHARS,
+            default_ttl=settings.RESPONSE_CACHE_TTL,
+            ttls=settings.RESPONSE_CACHE_TTLS,
+            persistent=settings.RESPONSE_CACHE_PERSISTENT,
+            cache_web_search=settings.RESPONSE_CACHE_WEB_SEARCH,
+        )
+    return _cache
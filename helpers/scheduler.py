@@ -0,0 +1,124 @@
+"""
+Планировщик запросов к OpenAI.
+
+Запросы одного пользователя выполняются строго по очереди (FIFO), поэтому порядок реплик
+в диалоге сохраняется и цепочка previous_response_id не ломается. Одновременных запросов
+к каждой модели не больше заданного лимита. Так как у пользователя в работе всегда не больше
+одного запроса, семафор модели (FIFO) по очереди обслуживает разных пользователей,
+и один активный пользователь не может занять все слоты.
+"""
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from config.settings import get_settings
+
+
+class SchedulerOverloaded(Exception):
+    """Очередь переполнена, запрос отклонен"""
+
+
+class RequestScheduler:
+
+    def __repr__(self) -> str:
+        return f"RequestScheduler(users={len(self._user_locks)}, pending={self._total_pending})"
+
+    def __init__(
+            self,
+            max_pending_per_user: int,
+            max_pending_total: int,
+            max_in_flight: int,
+            model_limits: dict[str, int],
+            max_model_waiting: int
+    ):
+        self.max_pending_per_user = max_pending_per_user
+        self.max_pending_total = max_pending_total
+        self.max_in_flight = max_in_flight
+        self.model_limits = model_limits
+        self.max_model_waiting = max_model_waiting
+        self.rejected = 0
+        self._user_locks: dict[str, asyncio.Lock] = {}
+        self._user_pending: dict[str, int] = defaultdict(int)
+        self._total_pending = 0
+        self._model_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._model_waiting: dict[str, int] = defaultdict(int)
+
+    @asynccontextmanager
+    async def user_turn(
+            self,
+            user_id: str,
+            on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> AsyncIterator[None]:
+        """Очередь запросов пользователя. on_queued получает число запросов перед текущим"""
+        ahead = self._user_pending[user_id]
+        if ahead >= self.max_pending_per_user or self._total_pending >= self.max_pending_total:
+            self.rejected += 1
+            raise SchedulerOverloaded("Слишком много запросов в очереди, попробуйте позже")
+        self._user_pending[user_id] += 1
+        self._total_pending += 1
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        try:
+            if ahead and on_queued:
+                await on_queued(ahead)
+            async with lock:
+                yield
+        finally:
+            self._total_pending -= 1
+            self._user_pending[user_id] -= 1
+            if self._user_pending[user_id] == 0:
+                # Никто больше не ждет этот лок - не держим записи неактивных пользователей
+                del self._user_pending[user_id]
+                del self._user_locks[user_id]
+
+    @asynccontextmanager
+    async def model_slot(self, model: str) -> AsyncIterator[None]:
+        """Слот для запроса к модели с ограничением одновременных запросов"""
+        if self._model_waiting[model] >= self.max_model_waiting:
+            self.rejected += 1
+            raise SchedulerOverloaded(f"Модель {model} перегружена, попробуйте позже")
+        semaphore = self._get_semaphore(model)
+        self._model_waiting[model] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._model_waiting[model] -= 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def stats(self) -> dict[str, int]:
+        result = {
+            "pending": self._total_pending,
+            "users": len(self._user_locks),
+            "rejected": self.rejected,
+        }
+        for model, semaphore in self._model_semaphores.items():
+            limit = self.model_limits.get(model, self.max_in_flight)
+            result[f"{model} in_flight"] = limit - semaphore._value
+            result[f"{model} waiting"] = self._model_waiting[model]
+        return result
+
+    def _get_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._model_semaphores:
+            limit = self.model_limits.get(model, self.max_in_flight)
+            self._model_semaphores[model] = asyncio.Semaphore(limit)
+        return self._model_semaphores[model]
+
+
+_scheduler: Optional[RequestScheduler] = None
+
+
+def get_scheduler() -> RequestScheduler:
+    global _scheduler
+    if _scheduler is None:
+        settings = get_settings()
+        _scheduler = RequestScheduler(
+            max_pending_per_user=settings.USER_MAX_PENDING,
+            max_pending_total=settings.SCHEDULER_MAX_PENDING,
+            max_in_flight=settings.MODEL_MAX_IN_FLIGHT,
+            model_limits=settings.MODEL_IN_FLIGHT_LIMITS,
+            max_model_waiting=settings.MODEL_MAX_WAITING,
+        )
+    return _scheduler
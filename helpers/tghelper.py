@@ -6,19 +6,28 @@ Classes
 Paginator
     Дает список объектов на определенной странице и соответствующую инлайн-клавиатуру.
     Методы класса неплохо покрыты тестами.
+StreamingMessage
+    Показывает ответ модели по мере генерации, редактируя сообщение с ограничением частоты.
 """
+import asyncio
 import datetime
 import logging
 import math
 import random
-from typing import Optional, BinaryIO
+import time
+from pathlib import Path
+from typing import Optional, BinaryIO, AsyncIterator
 
-from aiogram import types
+from aiogram import Bot, types
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, Message, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, Message, BufferedInputFile, Audio, Voice, \
+    VideoNote
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
+from config.settings import get_settings
+from helpers.markdown_helper import MESSAGE_LIMIT, MarkdownChunk, escape, fit_escaped, split_markdown, tg_len
+from helpers.metrics import track
 from helpers.texthelper import get_word_ending
 
 THINKING_PHRASES = [
@@ -33,17 +42,166 @@ THINKING_PHRASES = [
 
 
 async def send_text_any_size(message: Message, text: str) -> None:
-    for x in range(0, len(text), 4096):
-        answer = text[x:x + 4096]
-        logging.info(f"Запрос: \n{answer}")
-        # TODO автоматически определять, сообщение в формате markdown или нет
+    with track("tg_send"):
+        for chunk in split_markdown(text):
+            logging.debug(f"Ответ: \n{chunk.source}")
+            await send_markdown_chunk(message, chunk)
+
+
+async def send_markdown_chunk(message: Message, chunk: MarkdownChunk) -> Message:
+    """Отправляет кусок в MarkdownV2, а если телеграм его все же не принял - исходным текстом"""
+    try:
+        return await message.answer(chunk.text, parse_mode=ParseMode.MARKDOWN_V2)
+    except TelegramBadRequest as e:
+        logging.warning(f"Не удалось отправить сообщение в формате MARKDOWN_V2: {e}")
+        return await message.answer(chunk.source[:MESSAGE_LIMIT])
+
+
+async def send_text_to_chat(bot: Bot, chat_id: int, text: str) -> None:
+    """То же, что send_text_any_size, но без входящего сообщения - для фоновых задач"""
+    with track("tg_send"):
+        for chunk in split_markdown(text):
+            try:
+                await bot.send_message(chat_id, chunk.text, parse_mode=ParseMode.MARKDOWN_V2)
+            except TelegramBadRequest as e:
+                logging.warning(f"Не удалось отправить сообщение в формате MARKDOWN_V2: {e}")
+                await bot.send_message(chat_id, chunk.source[:MESSAGE_LIMIT])
+
+
+class StreamingMessage:
+    """
+    Сообщение, которое дописывается по мере генерации ответа.
+    Правки идут не чаще edit_interval секунд, при превышении лимита Telegram
+    текст переносится в новое сообщение.
+    """
+
+    def __init__(self, message: Message, placeholder: Optional[Message] = None, prefix: str = ""):
+        settings = get_settings()
+        self.message = message
+        self.current = placeholder
+        self.edit_interval = settings.STREAM_EDIT_INTERVAL
+        self.min_edit_chars = settings.STREAM_MIN_EDIT_CHARS
+        self.text = prefix
+        self.full_text = ""
+        self.shown = ""
+        self.next_edit_at = 0.0
+
+    async def feed(self, chunks: AsyncIterator[str]) -> str:
+        """Читает поток дельт до конца и возвращает полный текст ответа"""
+        try:
+            async for delta in chunks:
+                self.text += delta
+                self.full_text += delta
+                # Телеграм считает длину в UTF-16, а итоговый текст уходит экранированным
+                while tg_len(escape(self.text)) > MESSAGE_LIMIT:
+                    await self._roll_over()
+                if self._should_edit():
+                    await self._show(self.text)
+        except Exception:
+            if not self.full_text and self.current is not None:
+                await self.current.delete()
+            raise
+        await self._finish()
+        return self.full_text
+
+    def _should_edit(self) -> bool:
+        return time.monotonic() >= self.next_edit_at and len(self.text) - len(self.shown) >= self.min_edit_chars
+
+    async def _roll_over(self) -> None:
+        """Фиксирует заполненное сообщение и начинает следующее"""
+        limit = fit_escaped(self.text, MESSAGE_LIMIT)
+        cut = self.text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = self.text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = self.text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        head, self.text = self.text[:cut], self.text[cut:].lstrip()
+        if head.count("```") % 2:
+            # Блок кода продолжается в следующем сообщении
+            self.text = f"```\n{self.text}"
+        await self._show(head, final=True)
+        self.current = None
+        self.shown = ""
+
+    async def _finish(self) -> None:
+        if self.text.strip():
+            await self._show(self.text, final=True)
+        elif self.current is not None and not self.shown:
+            await self.current.edit_text("Не удалось получить ответ")
+
+    async def _show(self, text: str, final: bool = False) -> None:
         try:
-            await message.answer(answer, parse_mode=ParseMode.MARKDOWN)
-            logging.info("Сообщение отправлено в формате MARKDOWN")
-        except TelegramBadRequest:
-            print("Не удалось отправить сообщение в формате MARKDOWN")
-            logging.warning("Не удалось отправить сообщение в формате MARKDOWN")
-            await message.answer(answer)
+            if final:
+                await self._put_markdown(text)
+            else:
+                await self._put(text)
+            self.shown = text
+        except TelegramRetryAfter as e:
+            logging.warning(f"Telegram ограничил частоту правок на {e.retry_after} с")
+            if not final:
+                self.next_edit_at = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self._show(text, final)
+            return
+        self.next_edit_at = time.monotonic() + self.edit_interval
+
+    async def _put(self, text: str) -> None:
+        """Отправляет первое сообщение или правит текущее"""
+        if self.current is None:
+            self.current = await self.message.answer(text)
+        elif text != self.shown:
+            try:
+                await self.current.edit_text(text)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+
+    async def _put_markdown(self, text: str) -> None:
+        """Финальная версия текста: в MarkdownV2 и, если нужно, в нескольких сообщениях"""
+        chunks = split_markdown(text)
+        if not chunks:
+            return
+        first, rest = chunks[0], chunks[1:]
+        if self.current is None:
+            self.current = await send_markdown_chunk(self.message, first)
+        else:
+            try:
+                await self.current.edit_text(first.text, parse_mode=ParseMode.MARKDOWN_V2)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logging.warning(f"Не удалось отправить сообщение в формате MARKDOWN_V2: {e}")
+                    await self._put(first.source[:MESSAGE_LIMIT])
+        for chunk in rest:
+            self.current = await send_markdown_chunk(self.message, chunk)
+
+
+async def send_text_streaming(
+        message: Message,
+        chunks: AsyncIterator[str],
+        placeholder: Optional[Message] = None,
+        prefix: str = ""
+) -> str:
+    """Выводит поток текста в чат, редактируя одно сообщение, и возвращает полный текст"""
+    return await StreamingMessage(message, placeholder, prefix).feed(chunks)
+
+
+async def send_voice_notes(message: Message, segments: AsyncIterator[bytes], file_format: str = "opus") -> None:
+    """
+    Отправляет фрагменты озвучки по мере готовности: первый - ответом на сообщение.
+    Opus уходит настоящим голосовым, остальные форматы - файлом
+    """
+    is_voice = file_format == "opus"
+    first = True
+    async for audio in segments:
+        tg_file = process_file_for_tg(audio, "ogg" if is_voice else file_format)  # type: ignore
+        if is_voice:
+            await message.answer_voice(tg_file, reply_to_message_id=message.message_id if first else None)
+        else:
+            await message.answer_document(tg_file, reply_to_message_id=message.message_id if first else None)
+        first = False
 
 
 def process_file_for_tg(file: BinaryIO, file_format: str) -> BufferedInputFile:
@@ -55,14 +213,98 @@ def get_random_processing_phrase() -> str:
     return random.choice(THINKING_PHRASES)
 
 
+def get_media(message: Message) -> Audio | Voice | VideoNote:
+    """Голосовое, аудиофайл или кружочек из сообщения"""
+    media = message.voice or message.audio or message.video_note
+    if media is None:
+        raise ValueError("В сообщении нет записи")
+    return media
+
+
+def check_voice_limits(message: Message) -> None:
+    """Проверяет длительность и размер по метаданным сообщения, ничего не скачивая"""
+    settings = get_settings()
+    media = get_media(message)
+    if media.duration and media.duration > settings.MAX_VOICE_DURATION:
+        raise ValueError(f"Запись длиннее {settings.MAX_VOICE_DURATION // 60} минут, запишите покороче")
+    if media.file_size and media.file_size > settings.MAX_VOICE_SIZE:
+        raise ValueError(f"Запись больше {settings.MAX_VOICE_SIZE // (1024 * 1024)} МБ, запишите покороче")
+
+
+class VoiceStream:
+    """
+    Файл из телеграма, который читается по частям. Скачивание идет в фоне
+    через ограниченную очередь, поэтому в памяти не больше нескольких чанков
+    """
+
+    def __repr__(self) -> str:
+        return f"VoiceStream(filename={self.filename}, total={self.total}, peak_buffered={self.peak_buffered})"
+
+    def __init__(self, bot: Bot, url: str, filename: str):
+        settings = get_settings()
+        self.bot = bot
+        self.url = url
+        self.filename = filename
+        self.chunk_size = settings.VOICE_STREAM_CHUNK_SIZE
+        self.queue: asyncio.Queue[bytes | Exception | None] = asyncio.Queue(settings.VOICE_STREAM_BUFFER_CHUNKS)
+        self.total = 0
+        self.buffered = 0
+        self.peak_buffered = 0
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        producer = asyncio.create_task(self._download())
+        try:
+            while (item := await self.queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                self.buffered -= len(item)
+                yield item
+        finally:
+            producer.cancel()
+            logging.info(
+                f"Голосовое {self.filename}: {self.total // 1024} КБ, "
+                f"пиковый буфер {self.peak_buffered // 1024} КБ"
+            )
+
+    async def _download(self) -> None:
+        try:
+            async for chunk in self.bot.session.stream_content(self.url, chunk_size=self.chunk_size):
+                self.total += len(chunk)
+                self.buffered += len(chunk)
+                self.peak_buffered = max(self.peak_buffered, self.buffered)
+                await self.queue.put(chunk)
+            await self.queue.put(None)
+        except Exception as e:
+            await self.queue.put(e)
+
+
+async def open_voice_stream(message: Message) -> VoiceStream:
+    check_voice_limits(message)
+    original_file = await message.bot.get_file(get_media(message).file_id)
+    url = message.bot.session.api.file_url(message.bot.token, original_file.file_path)
+    return VoiceStream(message.bot, url, original_file.file_path)
+
+
 async def get_voice_from_tg(message: Message) -> BinaryIO:
     """Достает из сообщения файл и загружает его в память"""
-    original_file = await message.bot.get_file(message.voice.file_id)
-    in_memory_file = await message.bot.download(file=original_file)  # type: ignore
+    check_voice_limits(message)
+    with track("tg_download"):
+        original_file = await message.bot.get_file(get_media(message).file_id)
+        in_memory_file = await message.bot.download(file=original_file)  # type: ignore
     in_memory_file.name = original_file.file_path  # type: ignore
     return in_memory_file
 
 
+async def save_voice_from_tg(message: Message, directory: Path) -> Path:
+    """Скачивает запись во временную папку - для ffmpeg нужен файл на диске"""
+    check_voice_limits(message)
+    with track("tg_download"):
+        original_file = await message.bot.get_file(get_media(message).file_id)
+        path = directory / Path(original_file.file_path).name
+        await message.bot.download_file(original_file.file_path, destination=path)
+    return path
+
+
 def get_reply_keyboard(elements: list[str]) -> ReplyKeyboardMarkup:
     """Возвращает стандартную клавиатуру с вариантами ответа"""
     builder = ReplyKeyboardBuilder()
@@ -92,16 +334,23 @@ class Paginator:
                f"visible_results={self.visible_results}, " \
                f"page_elements={self.page_elements}, " \
                f"pages={self.pages}, " \
-               f"len objects={len(self.objects)})"
+               f"total={self.total})"
 
     def __str__(self) -> str:
         return f"Пагинатор для страницы {self.page}: " \
                f"количество элементов {self.page_elements}, " \
                f"количество видимых страниц {self.visible_results}"
 
-    def __init__(self, page: int, objects: list, visible_results: int = 5, page_elements: int = 5):
+    def __init__(self, page: int, objects: list, visible_results: int = 5, page_elements: int = 5,
+                 total: Optional[int] = None):
+        """
+        total передается, когда objects - уже выбранная из БД текущая страница,
+        а не полный список. Тогда число страниц считается по total
+        """
         self.objects = objects
-        self.pages = math.ceil(len(objects) / visible_results)
+        self.total = len(objects) if total is None else total
+        self.paged = total is not None
+        self.pages = math.ceil(self.total / visible_results)
         self.visible_results = visible_results
         self.page_elements = page_elements
         self.page = page
@@ -135,6 +384,8 @@ class Paginator:
 
     def get_objects_on_page(self) -> list:
         """Возвращает список объектов на странице"""
+        if self.paged:
+            return self.objects
         left, right = self.get_array_indexes()
         return self.objects[left: right + 1]
 
@@ -146,6 +397,6 @@ class Paginator:
 
     def result_message(self) -> str:
         """Формирует сообщение о результате поиска"""
-        count = len(self.objects)
+        count = self.total
         return f"Всего найден{get_word_ending(count, ['', 'о', 'о'])} " \
                f"{count} результат{get_word_ending(count, ['', 'а', 'ов'])}:\r\n\r\n"
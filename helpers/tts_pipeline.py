@@ -0,0 +1,91 @@
+"""
+Конвейер озвучки длинных ответов.
+
+Ответ делится на фрагменты по границам предложений, фрагменты синтезируются параллельно
+(не более TTS_PARALLELISM одновременно), а отдаются строго по порядку. Первый фрагмент
+короткий, чтобы первое голосовое пришло как можно раньше, пока остальные еще синтезируются.
+Уже озвученные фразы берутся из кэша по хэшу (модель, голос, формат, текст), размер
+кэша ограничен суммой байт аудио TTS_CACHE_MAX_BYTES.
+"""
+import asyncio
+import hashlib
+import re
+from typing import AsyncIterator, Optional
+
+from config.settings import get_settings
+from helpers.cache import TTLCache
+from helpers.open_ai_helper import text_to_audio
+
+# Лимит OpenAI на длину текста для одного запроса синтеза
+TTS_INPUT_LIMIT = 4096
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+_cache: Optional[TTLCache[str, bytes]] = None
+
+
+def get_tts_cache() -> TTLCache[str, bytes]:
+    global _cache
+    if _cache is None:
+        settings = get_settings()
+        _cache = TTLCache(settings.TTS_CACHE_MAX_BYTES, settings.TTS_CACHE_TTL, sizeof=len)
+    return _cache
+
+
+def split_into_segments(text: str, first_chars: int, max_chars: int) -> list[str]:
+    """Склеивает предложения во фрагменты: первый не длиннее first_chars, остальные - max_chars"""
+    segments: list[str] = []
+    current = ""
+    for sentence in _SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        limit = first_chars if not segments else max_chars
+        if current and len(current) + 1 + len(sentence) > limit:
+            segments.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+        # Предложение длиннее лимита синтеза режем по словам
+        while len(current) > TTS_INPUT_LIMIT:
+            cut = current.rfind(" ", 0, TTS_INPUT_LIMIT)
+            cut = cut if cut > 0 else TTS_INPUT_LIMIT
+            segments.append(current[:cut])
+            current = current[cut:].strip()
+    if current:
+        segments.append(current)
+    return segments
+
+
+async def synthesize(text: str) -> bytes:
+    """Озвучивает фрагмент, используя кэш"""
+    settings = get_settings()
+    key = hashlib.sha256(
+        f"{settings.TTS_MODEL}|{settings.TTS_VOICE}|{settings.TTS_FORMAT}|{text}".encode()
+    ).hexdigest()
+    cache = get_tts_cache()
+    audio = cache.get(key)
+    if audio is None:
+        audio = await text_to_audio(text, settings.TTS_FORMAT, settings.TTS_VOICE, settings.TTS_MODEL)
+        cache.set(key, audio)
+    return audio
+
+
+async def synthesize_segments(text: str) -> AsyncIterator[bytes]:
+    """Отдает аудио фрагментов по порядку, синтезируя следующие параллельно"""
+    settings = get_settings()
+    segments = split_into_segments(text, settings.TTS_FIRST_SEGMENT_CHARS, settings.TTS_SEGMENT_CHARS)
+    semaphore = asyncio.Semaphore(settings.TTS_PARALLELISM)
+
+    async def run(segment: str) -> bytes:
+        async with semaphore:
+            return await synthesize(segment)
+
+    # Задачи создаются по порядку, а семафор пропускает их в том же порядке
+    tasks = [asyncio.create_task(run(segment)) for segment in segments]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
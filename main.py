@@ -1,20 +1,81 @@
+import time
+
+# Отсчет до импорта модулей бота, чтобы в разбивке старта был виден и импорт
+_process_started = time.perf_counter()
+
 import asyncio
 import logging
+import signal
+from typing import Awaitable, TypeVar
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
+from aiohttp import web
 
-from config.settings import CommonSettings
+from config.settings import get_settings, reload_settings
 from handlers import user_handlers, admin_handlers, cancel_handlers, commands_handlers
+from helpers.fanout import get_fanout
+from helpers.metrics import start_metrics_server
+from helpers.model_catalog import get_model_catalog
+from helpers.open_ai_helper import close_client, warm_client
+from helpers.response_cache import get_response_cache
 from middlware.auth_middleware import Auth
-from service.visitor_actions import start_db_async
+from middlware.metrics_middleware import Metrics
+from service.conversation_memory import get_conversation_memory
+from service.conversation_store import get_conversation_store
+from service.database import start_db_async, dispose_db_async, warm_db_pool
+from service.fsm_storage import get_fsm_storage, PostgresStorage
+from service.research_jobs import get_research_worker
+from service.usage_ledger import get_usage_ledger
+from service.visitor_actions import get_visitor_listener
 
+T = TypeVar("T")
 
-async def start_bot(token: str) -> None:
-    bot = Bot(token=token)
-    dp = Dispatcher(storage=MemoryStorage())
 
+class StartupTimer:
+    """Разбивка времени старта по этапам. Параллельные этапы пишутся отдельно"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.stages: list[tuple[str, float]] = []
+        self.parallel: list[tuple[str, float]] = []
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    async def timed(self, stage: str, awaitable: Awaitable[T]) -> T:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.parallel.append((stage, time.perf_counter() - started))
+
+    def log_ready(self) -> None:
+        self.mark("запуск диспетчера")
+        stages = ", ".join(f"{stage} {seconds * 1000:.0f} мс" for stage, seconds in self.stages)
+        parallel = ", ".join(f"{stage} {seconds * 1000:.0f} мс" for stage, seconds in self.parallel)
+        logging.info(f"Бот готов за {(self.last - self.started) * 1000:.0f} мс: {stages} (параллельно: {parallel})")
+
+
+def build_dispatcher() -> Dispatcher:
+    storage = get_fsm_storage()
+    dp = Dispatcher(storage=storage)
+    # Отложенные записи FSM нужно дописать до закрытия пула соединений
+    dp.shutdown.register(storage.close)
+    dp.shutdown.register(get_usage_ledger().close)
+    dp.shutdown.register(get_fanout().close)
+    dp.shutdown.register(get_research_worker().stop)
+    dp.shutdown.register(get_visitor_listener().stop)
+    dp.shutdown.register(dispose_db_async)
+    dp.shutdown.register(close_client)
+    dp.startup.register(get_research_worker().start)
+    dp.startup.register(get_visitor_listener().start)
+
+    dp.message.outer_middleware(Metrics())
+    dp.callback_query.outer_middleware(Metrics())
     dp.message.outer_middleware(Auth())
     dp.callback_query.outer_middleware(Auth())
     dp.include_routers(
@@ -24,22 +85,130 @@ async def start_bot(token: str) -> None:
         # должен идти последним, т.к. ловит любой текст:
         user_handlers.router
     )
-    await bot.set_my_commands(
+    return dp
+
+
+async def start_bot(token: str, timer: StartupTimer) -> None:
+    settings = get_settings()
+    bot = Bot(token=token)
+    dp = build_dispatcher()
+    timer.mark("диспетчер")
+    set_commands = bot.set_my_commands(
         [
             BotCommand(command="/friend", description="Чат с американцем"),
             BotCommand(command="/teacher", description="Монолог с учителем"),
             BotCommand(command="/cancel", description="Выйти из текущего режима"),
             BotCommand(command="/settings", description="Изменить настройки запросов"),
-            BotCommand(command="/clean", description="Очистить контекст диалога")
+            BotCommand(command="/clean", description="Очистить контекст диалога"),
+            BotCommand(command="/jobs", description="Фоновые задачи deep research")
         ]
     )
-    await bot.delete_webhook(drop_pending_updates=True)
+    # Соединения с Telegram, БД и OpenAI открываются одновременно, а не первым запросом
+    warmups = [
+        timer.timed("команды telegram", set_commands),
+        timer.timed("пул БД", warm_db_pool()),
+        timer.timed("клиент OpenAI", warm_client()),
+    ]
+    if settings.BOT_MODE != "webhook":
+        warmups.append(timer.timed("удаление вебхука", bot.delete_webhook(drop_pending_updates=True)))
+    await asyncio.gather(*warmups)
+    timer.mark("прогрев соединений")
+    # Метрики - на отдельном внутреннем порту в обоих режимах, а не на публичном порту вебхука
+    metrics_runner = None
+    if settings.METRICS_ENABLED:
+        metrics_runner = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+        logging.info(f"Метрики доступны на {settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+    try:
+        if settings.BOT_MODE == "webhook":
+            await run_webhook(bot, dp, timer)
+        else:
+            await run_polling(bot, dp, timer)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+async def run_polling(bot: Bot, dp: Dispatcher, timer: StartupTimer) -> None:
+    dp.startup.register(timer.log_ready)
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
+async def run_webhook(bot: Bot, dp: Dispatcher, timer: StartupTimer) -> None:
+    """Принимает обновления на WEBHOOK_PORT (тот же 8080, что открыт в Dockerfile и compose)"""
+    # Сервер вебхука нужен только в этом режиме
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    settings = get_settings()
+    if not settings.WEBHOOK_BASE_URL or not settings.WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook нужно указать WEBHOOK_BASE_URL и WEBHOOK_SECRET")
+
+    async def set_webhook() -> None:
+        await bot.set_webhook(
+            url=f"{settings.WEBHOOK_BASE_URL.rstrip('/')}{settings.WEBHOOK_PATH}",
+            secret_token=settings.WEBHOOK_SECRET,
+            max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=settings.WEBHOOK_DROP_PENDING_UPDATES,
+        )
+
+    dp.startup.register(set_webhook)
+    app = web.Application()
+    app.router.add_get("/health", health_handler)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=settings.WEBHOOK_SECRET).register(
+        app, path=settings.WEBHOOK_PATH
+    )
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.WEBHOOK_HOST, port=settings.WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Вебхук слушает {settings.WEBHOOK_HOST}:{settings.WEBHOOK_PORT}{settings.WEBHOOK_PATH}")
+    timer.log_ready()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def on_sighup() -> None:
+    reload_settings()
+    logging.info("Настройки перечитаны по SIGHUP")
+
+
+async def purge_expired() -> None:
+    """Чистка устаревших записей не держит старт: идет в фоне, пока бот уже отвечает"""
+    try:
+        storage = get_fsm_storage()
+        if isinstance(storage, PostgresStorage):
+            await storage.purge_expired()
+        await get_conversation_store().purge_expired()
+        await get_conversation_memory().purge_expired()
+        if cache := get_response_cache():
+            await cache.purge_expired()
+    except Exception as e:
+        logging.warning(f"Не удалось почистить устаревшие записи: {e}")
+
+
 async def main() -> None:
+    timer = StartupTimer(_process_started)
+    timer.mark("импорт модулей")
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, on_sighup)
+    # Каталог моделей читается один раз: ошибка в gpt_models.json видна сразу при старте
+    get_model_catalog()
+    timer.mark("каталог моделей")
     await start_db_async()
-    await start_bot(CommonSettings().BOT_TOKEN)
+    timer.mark("проверка схемы БД")
+    purge = asyncio.create_task(purge_expired())
+    try:
+        await start_bot(get_settings().BOT_TOKEN, timer)
+    finally:
+        purge.cancel()
 
 
 if __name__ == "__main__":
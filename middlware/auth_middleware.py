@@ -3,9 +3,11 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject, CallbackQuery, InaccessibleMessage
 
-from config.settings import CommonSettings
+from config.settings import get_settings
 from domain.models import Visitor, Status
-from service.visitor_actions import get_visitor, get_all_admins, add_visitor
+from helpers.fanout import get_fanout
+from helpers.metrics import track
+from service.visitor_actions import get_visitor, get_admin_chat_ids, add_visitor
 
 
 class Auth(BaseMiddleware):
@@ -20,7 +22,8 @@ class Auth(BaseMiddleware):
         message = event if isinstance(event, Message) else event.message
         if isinstance(message, InaccessibleMessage) or message is None:
             return
-        visitor = await get_visitor(message.chat.id)
+        with track("auth_lookup"):
+            visitor = await get_visitor(message.chat.id)
         if visitor:
             if visitor.status == Status.PROCESSING.value:
                 await message.answer("Подождите, пока админ одобрит ваш запрос")
@@ -32,8 +35,9 @@ class Auth(BaseMiddleware):
                 data["visitor"] = visitor
                 return await handler(event, data)
         username = message.from_user.username
-        is_admin = username in CommonSettings().ADMINS
-        verified = username in CommonSettings().USERNAMES
+        settings = get_settings()
+        is_admin = username in settings.admins
+        verified = username in settings.usernames
         visitor = Visitor(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
@@ -51,10 +55,9 @@ class Auth(BaseMiddleware):
             await message.answer("Вы авторизовались как админ бота!")
             data["visitor"] = visitor
             return await handler(event, data)
-        admins = await get_all_admins()
-        for admin in admins:
-            await message.bot.send_message(
-                chat_id=admin.chat_id,
-                text=f"Пользователь {visitor.full_name} @{username} просит доступ\n/allow{visitor.chat_id}\n/decline{visitor.chat_id}"
-            )
+        get_fanout().submit(
+            message.bot,
+            await get_admin_chat_ids(),
+            f"Пользователь {visitor.full_name} @{username} просит доступ\n/allow{visitor.chat_id}\n/decline{visitor.chat_id}"
+        )
         await message.answer("Пока что нет доступа к боту. Админам отправлен запрос")
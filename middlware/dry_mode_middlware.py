@@ -3,7 +3,7 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject, CallbackQuery
 
-from config.settings import CommonSettings
+from config.settings import get_settings
 
 
 class DryMode(BaseMiddleware):
@@ -13,7 +13,7 @@ class DryMode(BaseMiddleware):
             event: Message | CallbackQuery,
             data: Dict[str, Any]
     ) -> Any:
-        if CommonSettings().DRY_MODE:
+        if get_settings().DRY_MODE:
             if isinstance(event, Message):
                 await event.answer("Бот запущен в тестовом режиме. Запросы к OpenAI временно не выполняются")
                 return
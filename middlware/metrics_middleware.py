@@ -0,0 +1,26 @@
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from handlers.commands_handlers import Modes
+from helpers.metrics import current_mode, track
+
+MODE_NAMES = {
+    Modes.conversation.state: "friend",
+    Modes.monolog.state: "teacher",
+}
+
+
+class Metrics(BaseMiddleware):
+    """Запоминает режим пользователя для метрик и замеряет обработку всего обновления"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        current_mode.set(MODE_NAMES.get(data.get("raw_state"), "base"))
+        with track("update"):
+            return await handler(event, data)
@@ -0,0 +1,28 @@
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+from helpers.scheduler import get_scheduler, SchedulerOverloaded
+
+
+class UserQueue(BaseMiddleware):
+    """Обрабатывает сообщения одного пользователя по очереди, сообщая его место в ней"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Message,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, Message) or event.from_user is None:
+            return await handler(event, data)
+
+        async def on_queued(ahead: int) -> None:
+            await event.reply(f"Запрос в очереди, перед ним еще {ahead}")
+
+        try:
+            async with get_scheduler().user_turn(str(event.from_user.id), on_queued):
+                return await handler(event, data)
+        except SchedulerOverloaded as e:
+            await event.answer(str(e))
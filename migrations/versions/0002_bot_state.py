@@ -0,0 +1,119 @@
+"""Индексы visitor и таблицы учета токенов, истории диалогов, кэша ответов, FSM и фоновых задач
+
+Все создается с if_not_exists: базы, поднятые create_all до появления миграций,
+могли уже получить часть этих таблиц.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("visitor_status_chat_id_idx", "visitor", ["status", "chat_id"], if_not_exists=True)
+    op.create_index(
+        "visitor_username_lower_idx", "visitor", [sa.text("lower(username) text_pattern_ops")], if_not_exists=True
+    )
+
+    op.create_table(
+        "token_usage",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("requests", sa.Integer(), nullable=False),
+        sa.Column("input_tokens", sa.BigInteger(), nullable=False),
+        sa.Column("output_tokens", sa.BigInteger(), nullable=False),
+        sa.Column("reasoning_tokens", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True),
+        sa.PrimaryKeyConstraint("user_id", "model", "day", name="token_usage_pkey"),
+        if_not_exists=True,
+    )
+    op.create_index("token_usage_day_idx", "token_usage", ["day"], if_not_exists=True)
+
+    op.create_table(
+        "conversation_state",
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column("response_id", sa.String(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", name="conversation_state_pkey"),
+        if_not_exists=True,
+    )
+
+    op.create_table(
+        "conversation_transcript",
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column("summary", sa.String(), nullable=False),
+        sa.Column("turns", JSONB(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", name="conversation_transcript_pkey"),
+        if_not_exists=True,
+    )
+    op.create_index(
+        "conversation_transcript_updated_at_idx", "conversation_transcript", ["updated_at"], if_not_exists=True
+    )
+
+    op.create_table(
+        "response_cache",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("text", sa.String(), nullable=False),
+        sa.Column("response_id", sa.String(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True),
+        sa.PrimaryKeyConstraint("key", name="response_cache_pkey"),
+        if_not_exists=True,
+    )
+    op.create_index("response_cache_expires_at_idx", "response_cache", ["expires_at"], if_not_exists=True)
+
+    op.create_table(
+        "fsm_state",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("state", sa.String(), nullable=True),
+        sa.Column("data", JSONB(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False),
+        sa.PrimaryKeyConstraint("key", name="fsm_state_pkey"),
+        if_not_exists=True,
+    )
+    op.create_index("fsm_state_updated_at_idx", "fsm_state", ["updated_at"], if_not_exists=True)
+
+    op.create_table(
+        "research_job",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("chat_id", sa.BigInteger(), nullable=False),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("prompt", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("response_id", sa.String(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("poll_interval", sa.Float(), nullable=False),
+        sa.Column("next_poll_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True),
+        sa.PrimaryKeyConstraint("id", name="research_job_pkey"),
+        if_not_exists=True,
+    )
+    op.create_index("research_job_user_id_idx", "research_job", ["user_id"], if_not_exists=True)
+    op.create_index("research_job_status_idx", "research_job", ["status"], if_not_exists=True)
+    op.create_index("research_job_next_poll_at_idx", "research_job", ["next_poll_at"], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_table("research_job")
+    op.drop_table("fsm_state")
+    op.drop_table("response_cache")
+    op.drop_table("conversation_transcript")
+    op.drop_table("conversation_state")
+    op.drop_table("token_usage")
+    op.drop_index("visitor_username_lower_idx", table_name="visitor")
+    op.drop_index("visitor_status_chat_id_idx", table_name="visitor")
@@ -0,0 +1,203 @@
+"""
+Локальная история диалога для режима CONVERSATION_MEMORY=local.
+
+Вместо цепочки previous_response_id, которую OpenAI каждый раз перечитывает целиком,
+здесь хранятся краткое содержание старой части разговора и последние реплики.
+В запрос уходит содержание и только те последние реплики, что помещаются в бюджет
+токенов модели. Сворачивание старых реплик в содержание делает open_ai_helper в фоне.
+
+Хранится так же, как response_id в conversation_store: LRU в памяти процесса,
+а при CONVERSATION_STORE=postgres еще и таблица conversation_transcript. Тогда кэш
+живет CONVERSATION_SHARED_CACHE_TTL, а реплики дописываются в строку таблицы одним
+запросом: историю могут продолжать несколько процессов сразу.
+"""
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import case, delete, select, update, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import get_settings
+from domain.models import ConversationTranscript
+from helpers.cache import TTLCache
+from helpers.rate_limiter import estimate_tokens
+from service.database import get_session_factory
+
+Turn = dict[str, str]
+
+
+@dataclass
+class Transcript:
+    summary: str = ""
+    turns: list[Turn] = field(default_factory=list)
+
+    def turns_tokens(self) -> int:
+        return sum(turn_tokens(turn) for turn in self.turns)
+
+
+def turn_tokens(turn: Turn) -> int:
+    return estimate_tokens(turn["content"])
+
+
+def window(transcript: Transcript, budget: int) -> list[Turn]:
+    """Последние реплики, которые вместе с содержанием помещаются в budget токенов"""
+    remaining = budget - estimate_tokens(transcript.summary)
+    result: list[Turn] = []
+    for turn in reversed(transcript.turns):
+        remaining -= turn_tokens(turn)
+        if remaining < 0:
+            break
+        result.append(turn)
+    return result[::-1]
+
+
+def _continues(current: Transcript, compacted: Transcript, count: int) -> bool:
+    """current - та же история, что compacted, возможно с новыми репликами в конце"""
+    return current.summary == compacted.summary and current.turns[:count] == compacted.turns[:count]
+
+
+class ConversationMemory:
+
+    def __init__(self, maxsize: int, cache_ttl: float, ttl: float, persistent: bool):
+        self.cache: TTLCache[str, Transcript] = TTLCache(maxsize, cache_ttl)
+        self.ttl = ttl
+        self.persistent = persistent
+
+    async def get(self, user_id: str) -> Transcript:
+        transcript = self.cache.get(user_id)
+        if transcript is not None:
+            return transcript
+        transcript = Transcript()
+        if self.persistent:
+            factory = get_session_factory()
+            async with factory() as session:
+                result = await session.execute(
+                    select(ConversationTranscript.summary, ConversationTranscript.turns)
+                    .where(ConversationTranscript.user_id == user_id)
+                    .where(ConversationTranscript.updated_at > func.now() - timedelta(seconds=self.ttl))
+                )
+                row = result.one_or_none()
+            if row is not None:
+                transcript = Transcript(row.summary or "", list(row.turns or []))
+        self.cache.set(user_id, transcript)
+        return transcript
+
+    async def append(self, user_id: str, turns: list[Turn]) -> Transcript:
+        if not self.persistent:
+            current = await self.get(user_id)
+            transcript = Transcript(current.summary, current.turns + turns)
+            self.cache.set(user_id, transcript)
+            return transcript
+        # Дописываем к строке в БД, а не к копии из кэша: иначе реплики из другого процесса потеряются
+        expired = ConversationTranscript.updated_at <= func.now() - timedelta(seconds=self.ttl)
+        upsert = insert(ConversationTranscript).values(user_id=user_id, summary="", turns=turns)
+        statement = upsert.on_conflict_do_update(
+            index_elements=[ConversationTranscript.user_id],
+            set_={
+                "summary": case((expired, upsert.excluded.summary), else_=ConversationTranscript.summary),
+                "turns": case(
+                    (expired, upsert.excluded.turns),
+                    else_=ConversationTranscript.turns.op("||", return_type=JSONB)(upsert.excluded.turns)
+                ),
+                "updated_at": func.now(),
+            }
+        ).returning(ConversationTranscript.summary, ConversationTranscript.turns)
+        factory = get_session_factory()
+        async with factory() as session:
+            # В READ COMMITTED одновременное дописывание ждет чужую запись и применяется к ней,
+            # а в REPEATABLE READ движка оно падало бы с ошибкой сериализации
+            await session.connection(execution_options={"isolation_level": "READ COMMITTED"})
+            row = (await session.execute(statement)).one()
+            await session.commit()
+        transcript = Transcript(row.summary or "", list(row.turns or []))
+        self.cache.set(user_id, transcript)
+        return transcript
+
+    async def compact(self, user_id: str, compacted: Transcript, count: int, summary: str) -> bool:
+        """
+        Заменяет первые count реплик истории compacted новым содержанием. Реплики, добавленные
+        после, сохраняются. Если историю за это время очистили или уже свернули, содержание
+        отбрасывается и возвращается False
+        """
+        if not self.persistent:
+            current = await self.get(user_id)
+            if not _continues(current, compacted, count):
+                return False
+            self.cache.set(user_id, Transcript(summary, current.turns[count:]))
+            return True
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.connection(execution_options={"isolation_level": "READ COMMITTED"})
+            # Проверка и запись под блокировкой строки: /clean в другом процессе не проскочит между ними
+            result = await session.execute(
+                select(ConversationTranscript.summary, ConversationTranscript.turns)
+                .where(ConversationTranscript.user_id == user_id)
+                .where(ConversationTranscript.updated_at > func.now() - timedelta(seconds=self.ttl))
+                .with_for_update()
+            )
+            row = result.one_or_none()
+            current = Transcript(row.summary or "", list(row.turns or [])) if row is not None else Transcript()
+            if not _continues(current, compacted, count):
+                self.cache.pop(user_id)
+                return False
+            transcript = Transcript(summary, current.turns[count:])
+            await session.execute(
+                update(ConversationTranscript)
+                .where(ConversationTranscript.user_id == user_id)
+                .values(summary=transcript.summary, turns=transcript.turns, updated_at=func.now())
+            )
+            await session.commit()
+        self.cache.set(user_id, transcript)
+        return True
+
+    async def delete(self, user_id: str) -> None:
+        self.cache.set(user_id, Transcript())
+        if not self.persistent:
+            return
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.execute(delete(ConversationTranscript).where(ConversationTranscript.user_id == user_id))
+            await session.commit()
+
+    async def purge_expired(self) -> int:
+        if not self.persistent:
+            return 0
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                delete(ConversationTranscript)
+                .where(ConversationTranscript.updated_at <= func.now() - timedelta(seconds=self.ttl))
+            )
+            await session.commit()
+        return result.rowcount  # type: ignore
+
+    def stats(self) -> dict[str, float]:
+        return self.cache.stats()
+
+
+_memory: Optional[ConversationMemory] = None
+
+
+def get_conversation_memory() -> ConversationMemory:
+    global _memory
+    if _memory is None:
+        settings = get_settings()
+        persistent = settings.CONVERSATION_STORE == "postgres"
+        _memory = ConversationMemory(
+            settings.CONVERSATION_CACHE_SIZE,
+            settings.CONVERSATION_SHARED_CACHE_TTL if persistent else settings.CONVERSATION_IDLE_TTL,
+            settings.CONVERSATION_TTL,
+            persistent=persistent,
+        )
+    return _memory
+
+
+def is_local_memory() -> bool:
+    return get_settings().CONVERSATION_MEMORY == "local"
+
+
+def get_token_budget(model: str) -> int:
+    settings = get_settings()
+    return settings.CONVERSATION_TOKEN_BUDGETS.get(model, settings.CONVERSATION_TOKEN_BUDGET)
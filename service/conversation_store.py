@@ -0,0 +1,183 @@
+"""
+Хранилище состояния диалога: последний response_id каждого пользователя.
+
+Classes
+--------
+MemoryConversationStore
+    LRU в памяти процесса, записи вытесняются после простоя дольше idle_ttl.
+PostgresConversationStore
+    Таблица conversation_state для переживания рестартов и общего доступа из нескольких
+    процессов. LRU перед ней держит записи только cache_ttl секунд: диалог могли продолжить
+    в другом процессе, и устаревший response_id отрезал бы его последние реплики.
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select, update, func, ColumnElement, Executable
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import get_settings
+from domain.models import ConversationState
+from helpers.cache import TTLCache
+from service.database import get_session_factory
+
+
+class ConversationStore(ABC):
+    """Интерфейс хранилища response_id"""
+
+    @abstractmethod
+    async def get(self, user_id: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: str, response_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def replace(self, user_id: str, expected: Optional[str], response_id: str) -> bool:
+        """Ставит response_id, только если текущий равен expected. False - диалог уже ушел дальше"""
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: str) -> None:
+        ...
+
+    async def purge_expired(self) -> int:
+        return 0
+
+    def stats(self) -> dict[str, float]:
+        return {}
+
+
+class MemoryConversationStore(ConversationStore):
+
+    def __init__(self, maxsize: int, idle_ttl: float):
+        # None в кэше - известно, что истории нет, в БД можно не ходить
+        self.cache: TTLCache[str, Optional[str]] = TTLCache(maxsize, idle_ttl)
+
+    async def get(self, user_id: str) -> Optional[str]:
+        found, response_id = self.cache.lookup(user_id)
+        if found:
+            # Продлеваем запись: вытесняются только простаивающие пользователи
+            self.cache.set(user_id, response_id)
+        return response_id
+
+    async def set(self, user_id: str, response_id: str) -> None:
+        self.cache.set(user_id, response_id)
+
+    async def replace(self, user_id: str, expected: Optional[str], response_id: str) -> bool:
+        if await self.get(user_id) != expected:
+            return False
+        self.cache.set(user_id, response_id)
+        return True
+
+    async def delete(self, user_id: str) -> None:
+        self.cache.pop(user_id)
+
+    def stats(self) -> dict[str, float]:
+        return self.cache.stats()
+
+
+class PostgresConversationStore(MemoryConversationStore):
+
+    def __init__(self, maxsize: int, cache_ttl: float, ttl: float):
+        super().__init__(maxsize, cache_ttl)
+        self.ttl = ttl
+
+    async def get(self, user_id: str) -> Optional[str]:
+        # Запись не продлевается: после cache_ttl значение перечитывается из БД
+        found, response_id = self.cache.lookup(user_id)
+        if found:
+            return response_id
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(ConversationState.response_id)
+                .where(ConversationState.user_id == user_id)
+                .where(ConversationState.updated_at > self._expired_before())
+            )
+            response_id = result.scalar_one_or_none()
+        self.cache.set(user_id, response_id)
+        return response_id
+
+    async def set(self, user_id: str, response_id: str) -> None:
+        statement = insert(ConversationState).values(user_id=user_id, response_id=response_id)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ConversationState.user_id],
+            set_={"response_id": statement.excluded.response_id, "updated_at": func.now()}
+        )
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.execute(statement)
+            await session.commit()
+        self.cache.set(user_id, response_id)
+
+    async def replace(self, user_id: str, expected: Optional[str], response_id: str) -> bool:
+        statement: Executable
+        if expected is None:
+            # Истории не было: пишем, если строки нет или она истекла
+            upsert = insert(ConversationState).values(user_id=user_id, response_id=response_id)
+            statement = upsert.on_conflict_do_update(
+                index_elements=[ConversationState.user_id],
+                set_={"response_id": upsert.excluded.response_id, "updated_at": func.now()},
+                where=ConversationState.updated_at <= self._expired_before()
+            )
+        else:
+            statement = (
+                update(ConversationState)
+                .where(ConversationState.user_id == user_id)
+                .where(ConversationState.response_id == expected)
+                .where(ConversationState.updated_at > self._expired_before())
+                .values(response_id=response_id, updated_at=func.now())
+            )
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(statement)
+            await session.commit()
+        replaced = result.rowcount > 0  # type: ignore
+        if replaced:
+            self.cache.set(user_id, response_id)
+        else:
+            # Диалог продолжили в другом процессе: кэш перечитается из БД
+            self.cache.pop(user_id)
+        return replaced
+
+    async def delete(self, user_id: str) -> None:
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.execute(delete(ConversationState).where(ConversationState.user_id == user_id))
+            await session.commit()
+        self.cache.set(user_id, None)
+
+    async def purge_expired(self) -> int:
+        """Удаляет истории, которые не продолжались дольше ttl"""
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                delete(ConversationState).where(ConversationState.updated_at <= self._expired_before())
+            )
+            await session.commit()
+        return result.rowcount  # type: ignore
+
+    def _expired_before(self) -> ColumnElement[datetime]:
+        return func.now() - timedelta(seconds=self.ttl)
+
+
+_store: Optional[ConversationStore] = None
+
+
+def get_conversation_store() -> ConversationStore:
+    """Возвращает хранилище, выбранное в настройке CONVERSATION_STORE"""
+    global _store
+    if _store is None:
+        settings = get_settings()
+        if settings.CONVERSATION_STORE == "postgres":
+            _store = PostgresConversationStore(
+                settings.CONVERSATION_CACHE_SIZE, settings.CONVERSATION_SHARED_CACHE_TTL, settings.CONVERSATION_TTL
+            )
+        elif settings.CONVERSATION_STORE == "memory":
+            _store = MemoryConversationStore(settings.CONVERSATION_CACHE_SIZE, settings.CONVERSATION_IDLE_TTL)
+        else:
+            raise ValueError(f"Неизвестное хранилище диалогов: {settings.CONVERSATION_STORE}")
+    return _store
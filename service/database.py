@@ -0,0 +1,208 @@
+"""
+Общий для всего процесса движок БД и фабрика сессий.
+
+Движок (а значит, и пул соединений asyncpg) создается один раз при старте бота
+через init_db_async и закрывается в dispose_db_async при остановке.
+
+Схемой управляют миграции alembic из migrations/. При старте версия схемы проверяется
+одним запросом к alembic_version, а сам alembic импортируется, только если она отстала.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from sqlalchemy import event, inspect, text, Connection
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from config.settings import PGSettings
+
+# Последняя миграция в migrations/versions. Меняется вместе с каждой новой миграцией
+SCHEMA_REVISION = "0002"
+# Первая миграция - схема исходной версии бота, где create_all создавал только visitor
+BASELINE_REVISION = "0001"
+# Ключ advisory lock, чтобы реплики при выкатке не накатывали миграции одновременно
+MIGRATION_LOCK_ID = 7_226_001
+
+
+@dataclass
+class PoolStats:
+    """Счетчики пула соединений"""
+    waiters: int = 0
+    max_waiters: int = 0
+    checkout_wait_total: float = 0.0
+    checkout_wait_max: float = 0.0
+    checkouts: int = 0
+    connects: int = 0
+    connect_latency_total: float = 0.0
+    connect_latency_max: float = 0.0
+
+    def record_checkout(self, wait: float) -> None:
+        self.checkouts += 1
+        self.checkout_wait_total += wait
+        self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def record_connect(self, latency: float) -> None:
+        self.connects += 1
+        self.connect_latency_total += latency
+        self.connect_latency_max = max(self.connect_latency_max, latency)
+
+
+_stats = PoolStats()
+_pg_settings: Optional[PGSettings] = None
+_engine: Optional[AsyncEngine] = None
+_session_factory: Optional[async_sessionmaker[AsyncSession]] = None
+
+
+class _InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул, который считает ожидающих соединения и время ожидания"""
+
+    def _do_get(self) -> Any:
+        _stats.waiters += 1
+        _stats.max_waiters = max(_stats.max_waiters, _stats.waiters)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _stats.waiters -= 1
+            _stats.record_checkout(time.perf_counter() - started)
+
+
+def _create_engine(settings: PGSettings) -> AsyncEngine:
+    engine = create_async_engine(
+        settings.db_connection_async(),
+        isolation_level="REPEATABLE READ",
+        poolclass=_InstrumentedPool,
+        pool_size=settings.PG_POOL_SIZE,
+        max_overflow=settings.PG_MAX_OVERFLOW,
+        pool_recycle=settings.PG_POOL_RECYCLE,
+        pool_timeout=settings.PG_POOL_TIMEOUT,
+        pool_pre_ping=settings.PG_POOL_PRE_PING,
+        connect_args={"statement_cache_size": settings.PG_STATEMENT_CACHE_SIZE},
+        # echo=True
+    )
+
+    @event.listens_for(engine.sync_engine, "do_connect")
+    def _before_connect(dialect: Any, conn_rec: Any, cargs: Any, cparams: Any) -> None:
+        conn_rec.info["connect_started"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _after_connect(dbapi_connection: Any, conn_rec: Any) -> None:
+        started = conn_rec.info.pop("connect_started", None)
+        if started is not None:
+            _stats.record_connect(time.perf_counter() - started)
+
+    return engine
+
+
+def init_db_engine() -> AsyncEngine:
+    """Создает движок и фабрику сессий, если они еще не созданы"""
+    global _pg_settings, _engine, _session_factory
+    if _engine is None:
+        _pg_settings = PGSettings()
+        _engine = _create_engine(_pg_settings)
+        _session_factory = async_sessionmaker(bind=_engine, expire_on_commit=False)
+    return _engine
+
+
+def get_engine_async() -> AsyncEngine:
+    return init_db_engine()
+
+
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    init_db_engine()
+    return _session_factory  # type: ignore
+
+
+async def start_db_async() -> None:
+    """Проверяет версию схемы и, если она отстала, накатывает миграции (PG_SCHEMA_MODE=upgrade)"""
+    engine = init_db_engine()
+    async with engine.connect() as conn:
+        revision = await _current_revision(conn)
+    if revision == SCHEMA_REVISION:
+        return
+    if _pg_settings.PG_SCHEMA_MODE != "upgrade":  # type: ignore
+        raise RuntimeError(
+            f"Версия схемы БД {revision}, ожидается {SCHEMA_REVISION}. Выполните python -m alembic upgrade head"
+        )
+    logging.info(f"Версия схемы БД {revision}, накатываю миграции до {SCHEMA_REVISION}")
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        await conn.run_sync(_upgrade)
+
+
+async def warm_db_pool(connections: Optional[int] = None) -> None:
+    """Открывает соединения пула заранее, параллельно с остальным стартом"""
+    engine = init_db_engine()
+    count = min(connections or _pg_settings.PG_PREWARM_CONNECTIONS, _pg_settings.PG_POOL_SIZE)  # type: ignore
+
+    async def ping() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.gather(*(ping() for _ in range(count)))
+    except Exception as e:
+        logging.warning(f"Не удалось заранее открыть соединения с БД: {e}")
+
+
+async def _current_revision(conn: Any) -> Optional[str]:
+    try:
+        result = await conn.execute(text("SELECT version_num FROM alembic_version"))
+    except ProgrammingError:
+        # Таблицы alembic_version нет: пустая база или созданная до миграций
+        return None
+    return result.scalar_one_or_none()
+
+
+def _upgrade(connection: Connection) -> None:
+    # alembic нужен только при расхождении версии, обычный старт его не импортирует
+    from alembic import command
+    from alembic.config import Config
+    from alembic.runtime.migration import MigrationContext
+
+    config = Config("alembic.ini")
+    config.attributes["connection"] = connection
+    # Другая реплика могла успеть накатить миграции, пока мы ждали блокировку
+    current = MigrationContext.configure(connection).get_current_revision()
+    if current is None and inspect(connection).has_table("visitor"):
+        logging.warning(f"Схема создана без миграций, отмечаю ее версией {BASELINE_REVISION}")
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, "head")
+
+
+async def dispose_db_async() -> None:
+    """Закрывает все соединения пула. Вызывается при остановке бота"""
+    global _engine, _session_factory
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = None
+    _session_factory = None
+
+
+def get_pool_stats() -> dict[str, Any]:
+    """Текущее состояние пула: занятые соединения, ожидающие, задержка подключения"""
+    result: dict[str, Any] = {
+        "waiters": _stats.waiters,
+        "max_waiters": _stats.max_waiters,
+        "checkouts": _stats.checkouts,
+        "checkout_wait_avg_ms": _avg_ms(_stats.checkout_wait_total, _stats.checkouts),
+        "checkout_wait_max_ms": round(_stats.checkout_wait_max * 1000, 2),
+        "connects": _stats.connects,
+        "connect_latency_avg_ms": _avg_ms(_stats.connect_latency_total, _stats.connects),
+        "connect_latency_max_ms": round(_stats.connect_latency_max * 1000, 2),
+    }
+    if _engine is not None:
+        pool = _engine.sync_engine.pool
+        result["size"] = pool.size()  # type: ignore
+        result["checked_out"] = pool.checkedout()  # type: ignore
+        result["checked_in"] = pool.checkedin()  # type: ignore
+        result["overflow"] = pool.overflow()  # type: ignore
+    return result
+
+
+def _avg_ms(total: float, count: int) -> float:
+    return round(total / count * 1000, 2) if count else 0.0
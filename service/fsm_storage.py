@@ -0,0 +1,186 @@
+"""
+Хранилище FSM aiogram в Postgres - чтобы режимы /friend и /teacher переживали рестарт
+и были общими для нескольких реплик за вебхуком.
+
+Состояние решает, какой обработчик получит обновление, поэтому оно всегда читается
+из БД и пишется сразу: смена режима в одной реплике тут же видна в остальных.
+Данные читаются через кэш в памяти, а их запись откладывается на FSM_FLUSH_INTERVAL
+и уходит в БД одним upsert на все изменившиеся ключи. Пустые записи (нет ни состояния,
+ни данных) удаляются. Данные FSM должны сериализоваться в JSON.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import case, delete, select, func, ColumnElement
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.settings import get_settings
+from domain.models import FSMRecord
+from helpers.cache import TTLCache
+from service.database import get_session_factory
+
+
+def build_key(key: StorageKey) -> str:
+    parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny]
+    return ":".join("" if part is None else str(part) for part in parts)
+
+
+class PostgresStorage(BaseStorage):
+
+    def __init__(self, cache_size: int, cache_ttl: float, flush_interval: float, ttl: float):
+        # Кэшируются только данные, состояние всегда берется из БД
+        self.cache: TTLCache[str, Dict[str, Any]] = TTLCache(cache_size, cache_ttl)
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.pending: dict[str, Dict[str, Any]] = {}
+        self.state_writes = 0
+        self.flushes = 0
+        self.written = 0
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = build_key(key)
+        value = state.state if isinstance(state, State) else state
+        expired = self._expired()
+        statement = insert(FSMRecord).values(key=storage_key, state=value, data={})
+        statement = statement.on_conflict_do_update(
+            index_elements=[FSMRecord.key],
+            set_={
+                "state": statement.excluded.state,
+                # Данные истекшей записи не переходят в новое состояние
+                "data": case((expired, statement.excluded.data), else_=FSMRecord.data),
+                "updated_at": func.now(),
+            }
+        )
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.execute(statement)
+            if value is None:
+                await self._delete_empty(session, [storage_key])
+            await session.commit()
+        self.state_writes += 1
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(FSMRecord.state)
+                .where(FSMRecord.key == build_key(key))
+                .where(~self._expired())
+            )
+            return result.scalar_one_or_none()
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = build_key(key)
+        self.cache.set(storage_key, data.copy())
+        self.pending[storage_key] = data.copy()
+        self._schedule_flush()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load_data(build_key(key))).copy()
+
+    async def close(self) -> None:
+        """Дописывает отложенные изменения. Вызывается при остановке, повторный вызов безопасен"""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        expired = self._expired()
+        statement = insert(FSMRecord).values([{"key": key, "state": None, "data": data} for key, data in batch.items()])
+        statement = statement.on_conflict_do_update(
+            index_elements=[FSMRecord.key],
+            set_={
+                "state": case((expired, statement.excluded.state), else_=FSMRecord.state),
+                "data": statement.excluded.data,
+                "updated_at": func.now(),
+            }
+        )
+        try:
+            factory = get_session_factory()
+            async with factory() as session:
+                await session.execute(statement)
+                await self._delete_empty(session, [key for key, data in batch.items() if not data])
+                await session.commit()
+        except Exception as e:
+            logging.warning(f"Не удалось записать данные {len(batch)} ключей FSM, повторим позже: {e}")
+            # Более свежие изменения, накопившиеся за время записи, важнее неудачной пачки
+            self.pending = batch | self.pending
+            self._schedule_flush()
+            return
+        self.flushes += 1
+        self.written += len(batch)
+
+    async def purge_expired(self) -> int:
+        """Удаляет состояния, которые не менялись дольше ttl"""
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(delete(FSMRecord).where(self._expired()))
+            await session.commit()
+        return result.rowcount  # type: ignore
+
+    def stats(self) -> dict[str, float]:
+        result = self.cache.stats()
+        result["state_writes"] = self.state_writes
+        result["pending"] = len(self.pending)
+        result["flushes"] = self.flushes
+        result["written"] = self.written
+        return result
+
+    async def _load_data(self, key: str) -> Dict[str, Any]:
+        if key in self.pending:
+            return self.pending[key]
+        found, data = self.cache.lookup(key)
+        if found:
+            return data  # type: ignore
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(FSMRecord.data).where(FSMRecord.key == key).where(~self._expired())
+            )
+            data = result.scalar_one_or_none() or {}
+        self.cache.set(key, data)
+        return data
+
+    async def _delete_empty(self, session: AsyncSession, keys: list[str]) -> None:
+        if keys:
+            await session.execute(
+                delete(FSMRecord)
+                .where(FSMRecord.key.in_(keys))
+                .where(FSMRecord.state.is_(None))
+                .where(FSMRecord.data == {})
+            )
+
+    def _expired(self) -> ColumnElement[bool]:
+        return FSMRecord.updated_at <= func.now() - timedelta(seconds=self.ttl)
+
+    def _schedule_flush(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flusher = None
+        await self.flush()
+
+
+def get_fsm_storage() -> BaseStorage:
+    """Возвращает хранилище, выбранное в настройке FSM_STORAGE"""
+    settings = get_settings()
+    if settings.FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if settings.FSM_STORAGE == "postgres":
+        return PostgresStorage(
+            settings.FSM_CACHE_SIZE, settings.FSM_CACHE_TTL, settings.FSM_FLUSH_INTERVAL, settings.FSM_TTL
+        )
+    raise ValueError(f"Неизвестное хранилище FSM: {settings.FSM_STORAGE}")
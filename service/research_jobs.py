@@ -0,0 +1,289 @@
+"""
+Очередь долгих запросов (deep research) в Postgres и воркер, который их выполняет.
+
+Обработчик только кладет задачу в research_job и сразу отвечает. Воркер отправляет
+запрос в фоновом режиме OpenAI (background=True) и опрашивает готовность: все задачи,
+у которых подошел next_poll_at, проверяются одной пачкой параллельно, а интервал опроса
+каждой растет от RESEARCH_POLL_MIN до RESEARCH_POLL_MAX, пока ответ не готов.
+Готовый ответ отправляется в чат. response_id хранится в БД, поэтому после рестарта
+опрос продолжается. Задачи захватываются через FOR UPDATE SKIP LOCKED, так что
+несколько реплик не обрабатывают одну задачу дважды.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Any, Optional, Sequence, cast
+
+from aiogram import Bot
+from openai.types.responses import Response
+from sqlalchemy import select, update, func, bindparam, Interval, ColumnElement, Table
+
+from config.settings import get_settings
+from domain.models import ResearchJob, JobStatus
+from helpers.open_ai_helper import submit_background, retrieve_response, cancel_background, finish_background
+from helpers.tghelper import send_text_to_chat
+from service.database import get_session_factory
+
+# Статусы ответа OpenAI, при которых ответ еще готовится
+PENDING_STATUSES = {"queued", "in_progress"}
+
+
+class ResearchWorker:
+
+    def __init__(
+            self,
+            concurrency: int,
+            batch_size: int,
+            poll_min: float,
+            poll_max: float,
+            poll_backoff: float,
+            submit_lease: float
+    ):
+        self.batch_size = batch_size
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.poll_backoff = poll_backoff
+        self.submit_lease = submit_lease
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+        self.bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, bot: Bot) -> None:
+        """Запускается при старте бота, aiogram передает сюда bot"""
+        self.bot = bot
+        await self._requeue_stale()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def enqueue(self, user_id: int, chat_id: int, model: str, prompt: str) -> ResearchJob:
+        job = ResearchJob(user_id=user_id, chat_id=chat_id, model=model, prompt=prompt)
+        factory = get_session_factory()
+        async with factory() as session:
+            session.add(job)
+            await session.commit()
+        self.wakeup.set()
+        return job
+
+    async def list_jobs(self, user_id: int, limit: int = 10) -> Sequence[ResearchJob]:
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(ResearchJob).where(ResearchJob.user_id == user_id).order_by(ResearchJob.id.desc()).limit(limit)
+            )
+            return result.scalars().all()
+
+    async def cancel(self, job_id: int, user_id: int) -> Optional[ResearchJob]:
+        """Отменяет еще не завершенную задачу пользователя. None - такой задачи нет"""
+        factory = get_session_factory()
+        async with factory() as session:
+            job = await session.get(ResearchJob, job_id, with_for_update=True)
+            if job is None or job.user_id != user_id:
+                return None
+            if job.status in (JobStatus.QUEUED.value, JobStatus.SUBMITTING.value, JobStatus.RUNNING.value):
+                if job.response_id:
+                    try:
+                        await cancel_background(job.response_id)
+                    except Exception as e:
+                        logging.warning(f"Не удалось отменить фоновый ответ {job.response_id}: {e}")
+                job.status = JobStatus.CANCELLED.value
+                await session.commit()
+            return job
+
+    async def _loop(self) -> None:
+        while True:
+            self.wakeup.clear()
+            try:
+                # Каждый проход: задачи, брошенные упавшей репликой, не ждут ее рестарта
+                await self._requeue_stale()
+                await self._submit_queued()
+                await self._poll_due()
+                delay = await self._next_poll_in()
+            except Exception as e:
+                logging.error(f"Ошибка в воркере фоновых задач: {e}")
+                delay = self.poll_max
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _submit_queued(self) -> None:
+        jobs = await self._claim(
+            ResearchJob.status == JobStatus.QUEUED.value,
+            status=JobStatus.SUBMITTING.value
+        )
+        await asyncio.gather(*(self._submit(job) for job in jobs))
+
+    async def _submit(self, job: ResearchJob) -> None:
+        async with self.semaphore:
+            try:
+                response_id = await submit_background(str(job.user_id), job.prompt, job.model)
+            except Exception as e:
+                await self._fail(job, f"Не удалось отправить запрос: {e}")
+                return
+        updated = await self._update(
+            job.id,
+            status=JobStatus.RUNNING.value,
+            response_id=response_id,
+            poll_interval=self.poll_min,
+            next_poll_at=func.now() + timedelta(seconds=self.poll_min),
+        )
+        if not updated:
+            # Задачу отменили, пока шла отправка: фоновый ответ никто не ждет, а он тарифицируется
+            try:
+                await cancel_background(response_id)
+            except Exception as e:
+                logging.warning(f"Не удалось отменить фоновый ответ {response_id}: {e}")
+
+    async def _poll_due(self) -> None:
+        # Аренда на poll_max: пока пачка опрашивается, другие реплики эти задачи не берут
+        jobs = await self._claim(
+            (ResearchJob.status == JobStatus.RUNNING.value) & (ResearchJob.next_poll_at <= func.now()),
+            next_poll_at=func.now() + timedelta(seconds=self.poll_max)
+        )
+        if not jobs:
+            return
+        responses = await asyncio.gather(*(self._retrieve(job) for job in jobs))
+        pending: list[dict[str, Any]] = []
+        for job, response in zip(jobs, responses):
+            if response is None or response.status in PENDING_STATUSES:
+                interval = min(self.poll_max, max(self.poll_min, job.poll_interval) * self.poll_backoff)
+                pending.append({"job_id": job.id, "interval": interval, "delay": timedelta(seconds=interval)})
+            elif response.status == "completed":
+                await self._complete(job, response)
+            elif response.status == "cancelled":
+                await self._update(job.id, status=JobStatus.CANCELLED.value)
+            else:
+                reason = response.error.message if response.error else response.incomplete_details
+                await self._fail(job, f"Модель не смогла ответить: {reason}")
+        if pending:
+            table = cast(Table, ResearchJob.__table__)
+            statement = (
+                update(table)
+                .where(table.c.id == bindparam("job_id"))
+                .values(poll_interval=bindparam("interval"), next_poll_at=func.now() + bindparam("delay", type_=Interval()))
+            )
+            factory = get_session_factory()
+            async with factory() as session:
+                await session.execute(statement, pending)
+                await session.commit()
+
+    async def _retrieve(self, job: ResearchJob) -> Optional[Response]:
+        async with self.semaphore:
+            try:
+                return await retrieve_response(job.response_id)  # type: ignore
+            except Exception as e:
+                logging.warning(f"Не удалось проверить задачу {job.id}: {e}")
+                return None
+
+    async def _complete(self, job: ResearchJob, response: Response) -> None:
+        factory = get_session_factory()
+        async with factory() as session:
+            # Строка заблокирована до конца доставки: /stopjob либо успел раньше, либо ждет
+            status = await session.scalar(
+                select(ResearchJob.status).where(ResearchJob.id == job.id).with_for_update()
+            )
+            if status == JobStatus.CANCELLED.value:
+                return
+            text = await finish_background(str(job.user_id), job.prompt, response, job.model)
+            # Сначала доставка, потом статус: после падения между ними ответ придет дважды, но не потеряется
+            try:
+                await send_text_to_chat(self.bot, job.chat_id, text or "Модель вернула пустой ответ")  # type: ignore
+            except Exception as e:
+                logging.error(f"Не удалось доставить результат задачи {job.id}: {e}")
+            await session.execute(
+                update(ResearchJob).where(ResearchJob.id == job.id).values(status=JobStatus.COMPLETED.value)
+            )
+            await session.commit()
+
+    async def _fail(self, job: ResearchJob, error: str) -> None:
+        logging.warning(f"Задача {job.id} завершилась ошибкой: {error}")
+        await self._update(job.id, status=JobStatus.FAILED.value, error=error[:500])
+        try:
+            await self.bot.send_message(job.chat_id, f"Задача {job.id} не выполнена: {error[:200]}")  # type: ignore
+        except Exception as e:
+            logging.error(f"Не удалось сообщить об ошибке задачи {job.id}: {e}")
+
+    async def _claim(self, condition: ColumnElement[bool], **values: Any) -> Sequence[ResearchJob]:
+        """Атомарно помечает до batch_size задач, которые не держит другая реплика"""
+        claimable = (
+            select(ResearchJob.id)
+            .where(condition)
+            .order_by(ResearchJob.next_poll_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        statement = (
+            update(ResearchJob)
+            .where(ResearchJob.id.in_(claimable.scalar_subquery()))
+            .values(**values)
+            .returning(ResearchJob)
+            .execution_options(synchronize_session=False)
+        )
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(statement)
+            jobs = result.scalars().all()
+            await session.commit()
+        return jobs
+
+    async def _update(self, job_id: int, **values: Any) -> bool:
+        """Обновляет задачу, если ее не отменили, пока шел запрос к OpenAI. False - задача отменена"""
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                update(ResearchJob)
+                .where(ResearchJob.id == job_id)
+                .where(ResearchJob.status != JobStatus.CANCELLED.value)
+                .values(**values)
+            )
+            await session.commit()
+        return result.rowcount > 0  # type: ignore
+
+    async def _requeue_stale(self) -> None:
+        """Задачи, застрявшие в отправке дольше submit_lease из-за падения процесса, возвращаются в очередь"""
+        factory = get_session_factory()
+        async with factory() as session:
+            await session.execute(
+                update(ResearchJob)
+                .where(ResearchJob.status == JobStatus.SUBMITTING.value)
+                .where(ResearchJob.updated_at < func.now() - timedelta(seconds=self.submit_lease))
+                .values(status=JobStatus.QUEUED.value)
+            )
+            await session.commit()
+
+    async def _next_poll_in(self) -> float:
+        """Секунды до ближайшего опроса, но не дольше poll_max"""
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(func.extract("epoch", func.min(ResearchJob.next_poll_at) - func.now()))
+                .where(ResearchJob.status == JobStatus.RUNNING.value)
+            )
+            seconds = result.scalar_one_or_none()
+        if seconds is None:
+            return self.poll_max
+        return min(self.poll_max, max(1.0, float(seconds)))
+
+
+_worker: Optional[ResearchWorker] = None
+
+
+def get_research_worker() -> ResearchWorker:
+    global _worker
+    if _worker is None:
+        settings = get_settings()
+        _worker = ResearchWorker(
+            settings.RESEARCH_CONCURRENCY,
+            settings.RESEARCH_BATCH_SIZE,
+            settings.RESEARCH_POLL_MIN,
+            settings.RESEARCH_POLL_MAX,
+            settings.RESEARCH_POLL_BACKOFF,
+            settings.RESEARCH_SUBMIT_LEASE,
+        )
+    return _worker
@@ -0,0 +1,161 @@
+"""
+Учет расхода токенов по посетителям, моделям и дням.
+
+Каждый ответ OpenAI только прибавляет счетчики в памяти. Раз в USAGE_FLUSH_INTERVAL
+накопленное уходит в таблицу token_usage одним upsert, который прибавляет значения
+к уже записанным. Если запись не удалась, пачка возвращается в буфер.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from openai.types.responses import ResponseUsage
+from sqlalchemy import select, func, desc
+from sqlalchemy.dialects.postgresql import insert
+
+from config.settings import get_settings
+from domain.models import TokenUsage, Visitor
+from service.database import get_session_factory
+
+
+class UsageKey(NamedTuple):
+    user_id: int
+    model: str
+    day: date
+
+
+@dataclass
+class UsageCounts:
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+
+    def add(self, other: "UsageCounts") -> None:
+        self.requests += other.requests
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.reasoning_tokens += other.reasoning_tokens
+
+
+class TopConsumer(NamedTuple):
+    user_id: int
+    full_name: Optional[str]
+    username: Optional[str]
+    requests: int
+    tokens: int
+
+
+class UsageLedger:
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.buffer: dict[UsageKey, UsageCounts] = {}
+        self.flushes = 0
+        self._flusher: Optional[asyncio.Task] = None
+
+    def record(self, user_id: int, model: str, usage: Optional[ResponseUsage]) -> None:
+        if usage is None:
+            return
+        reasoning = usage.output_tokens_details.reasoning_tokens if usage.output_tokens_details else 0
+        key = UsageKey(user_id, model, datetime.now(timezone.utc).date())
+        self.buffer.setdefault(key, UsageCounts()).add(
+            UsageCounts(1, usage.input_tokens, usage.output_tokens, reasoning or 0)
+        )
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, {}
+        statement = insert(TokenUsage).values([
+            {
+                "user_id": key.user_id,
+                "model": key.model,
+                "day": key.day,
+                "requests": counts.requests,
+                "input_tokens": counts.input_tokens,
+                "output_tokens": counts.output_tokens,
+                "reasoning_tokens": counts.reasoning_tokens,
+            }
+            for key, counts in batch.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[TokenUsage.user_id, TokenUsage.model, TokenUsage.day],
+            set_={
+                "requests": TokenUsage.requests + statement.excluded.requests,
+                "input_tokens": TokenUsage.input_tokens + statement.excluded.input_tokens,
+                "output_tokens": TokenUsage.output_tokens + statement.excluded.output_tokens,
+                "reasoning_tokens": TokenUsage.reasoning_tokens + statement.excluded.reasoning_tokens,
+                "updated_at": func.now(),
+            }
+        )
+        try:
+            factory = get_session_factory()
+            async with factory() as session:
+                await session.execute(statement)
+                await session.commit()
+        except Exception as e:
+            logging.warning(f"Не удалось записать расход токенов ({len(batch)} строк), повторим позже: {e}")
+            for key, counts in batch.items():
+                self.buffer.setdefault(key, UsageCounts()).add(counts)
+            return
+        self.flushes += 1
+
+    async def close(self) -> None:
+        """Дописывает буфер при остановке"""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self._flusher = None
+        await self.flush()
+
+    async def get_top(self, days: int, limit: int) -> list[TopConsumer]:
+        """Самые расходные посетители за последние days дней"""
+        since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+        tokens = func.sum(TokenUsage.input_tokens + TokenUsage.output_tokens)
+        # Сначала сумма по пользователю, потом одна строка visitor: у пользователя может быть
+        # несколько чатов, и прямое соединение умножило бы его расход
+        usage = (
+            select(TokenUsage.user_id, func.sum(TokenUsage.requests).label("requests"), tokens.label("tokens"))
+            .where(TokenUsage.day >= since)
+            .group_by(TokenUsage.user_id)
+            .subquery()
+        )
+        visitor = (
+            select(Visitor.user_id, Visitor.full_name, Visitor.username)
+            .where(Visitor.user_id.is_not(None))
+            .distinct(Visitor.user_id)
+            # Личный чат пользователя, если он есть
+            .order_by(Visitor.user_id, Visitor.chat_id != Visitor.user_id, Visitor.chat_id)
+            .subquery()
+        )
+        factory = get_session_factory()
+        async with factory() as session:
+            result = await session.execute(
+                select(usage.c.user_id, visitor.c.full_name, visitor.c.username, usage.c.requests, usage.c.tokens)
+                .outerjoin(visitor, visitor.c.user_id == usage.c.user_id)
+                .order_by(desc(usage.c.tokens))
+                .limit(limit)
+            )
+            return [TopConsumer(*row) for row in result.all()]
+
+    def stats(self) -> dict[str, float]:
+        return {"buffered": len(self.buffer), "flushes": self.flushes}
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flusher = None
+        await self.flush()
+
+
+_ledger: Optional[UsageLedger] = None
+
+
+def get_usage_ledger() -> UsageLedger:
+    global _ledger
+    if _ledger is None:
+        _ledger = UsageLedger(get_settings().USAGE_FLUSH_INTERVAL)
+    return _ledger
@@ -1,11 +1,29 @@
-from typing import Optional, List
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Optional, List
 
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import select, func, ColumnElement
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from config.settings import PGSettings
-from domain.models import Base, Visitor, Status
-from helpers.open_ai_helper import GPTModel
+from config.settings import get_settings
+from domain.models import Visitor, Status
+from helpers.cache import TTLCache
+from service.database import get_engine_async, get_session_factory
+
+# Канал Postgres NOTIFY: chat_id посетителя, которого изменили в какой-то из реплик
+VISITOR_CHANNEL = "visitor_changed"
+
+# Кэш посетителей по chat_id. None в кэше означает, что посетителя нет в БД
+_visitor_cache: Optional[TTLCache[int, Optional[Visitor]]] = None
+_admin_chat_ids: Optional[TTLCache[str, List[int]]] = None
+
+
+def get_visitor_cache() -> TTLCache[int, Optional[Visitor]]:
+    global _visitor_cache
+    if _visitor_cache is None:
+        settings = get_settings()
+        _visitor_cache = TTLCache(settings.VISITOR_CACHE_SIZE, settings.VISITOR_CACHE_TTL)
+    return _visitor_cache
 
 
 async def add_visitor(visitor: Visitor) -> None:
@@ -13,20 +31,70 @@ async def add_visitor(visitor: Visitor) -> None:
     async with factory() as session:
         session.add(visitor)
         await session.commit()
+    get_visitor_cache().set(visitor.chat_id, visitor)
+    if visitor.is_admin and _admin_chat_ids is not None:
+        _admin_chat_ids.clear()
 
 
 async def get_visitor(chat_id: int) -> Optional[Visitor]:
+    cache = get_visitor_cache()
+    found, visitor = cache.lookup(chat_id)
+    if found:
+        return visitor
     factory = get_session_factory()
     async with factory() as session:
         visitor = await session.get(Visitor, chat_id)
-        return visitor
+    if visitor is None:
+        cache.set(chat_id, None, ttl=get_settings().VISITOR_CACHE_NEGATIVE_TTL)
+    else:
+        cache.set(chat_id, visitor)
+    return visitor
 
 
-async def get_all_visitors() -> List[Visitor]:
+def _visitor_filters(status: Optional[Status], username_prefix: str) -> list[ColumnElement[bool]]:
+    filters = []
+    if status is not None:
+        filters.append(Visitor.status == status.value)
+    if username_prefix:
+        # Совпадает с выражением индекса visitor_username_lower_idx
+        filters.append(func.lower(Visitor.username).like(f"{username_prefix.lower()}%"))
+    return filters
+
+
+async def count_visitors(status: Optional[Status] = None, username_prefix: str = "") -> int:
     factory = get_session_factory()
     async with factory() as session:
-        result = await session.execute(select(Visitor))
-        return result.scalars().unique().all()
+        result = await session.execute(
+            select(func.count()).select_from(Visitor).where(*_visitor_filters(status, username_prefix))
+        )
+        return result.scalar_one()
+
+
+async def get_visitors_page(
+        limit: int,
+        status: Optional[Status] = None,
+        username_prefix: str = "",
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        skip: int = 0
+) -> List[Visitor]:
+    """
+    Страница посетителей по возрастанию chat_id с пагинацией по ключу: after/before - chat_id
+    последнего/первого посетителя текущей страницы. skip пропускает несколько записей
+    за ключом, чтобы перейти через страницу, не сканируя все предыдущие
+    """
+    query = select(Visitor).where(*_visitor_filters(status, username_prefix))
+    if before is not None:
+        query = query.where(Visitor.chat_id < before).order_by(Visitor.chat_id.desc())
+    else:
+        if after is not None:
+            query = query.where(Visitor.chat_id > after)
+        query = query.order_by(Visitor.chat_id)
+    factory = get_session_factory()
+    async with factory() as session:
+        result = await session.execute(query.offset(skip).limit(limit))
+        visitors = list(result.scalars().all())
+    return visitors[::-1] if before is not None else visitors
 
 
 async def get_all_admins() -> List[Visitor]:
@@ -36,39 +104,124 @@ async def get_all_admins() -> List[Visitor]:
         return result.scalars().unique().all()
 
 
+async def get_admin_chat_ids() -> List[int]:
+    """chat_id админов. Список почти не меняется, поэтому кэшируется на VISITOR_CACHE_TTL"""
+    global _admin_chat_ids
+    if _admin_chat_ids is None:
+        _admin_chat_ids = TTLCache(1, get_settings().VISITOR_CACHE_TTL)
+    chat_ids = _admin_chat_ids.get("admins")
+    if chat_ids is None:
+        chat_ids = [admin.chat_id for admin in await get_all_admins()]
+        _admin_chat_ids.set("admins", chat_ids)
+    return chat_ids
+
+
+async def iter_visitor_chat_ids(status: Status, batch_size: int = 500) -> AsyncIterator[int]:
+    """chat_id посетителей со статусом status, выбираемые пачками по ключу"""
+    factory = get_session_factory()
+    after: Optional[int] = None
+    while True:
+        query = select(Visitor.chat_id).where(Visitor.status == status.value)
+        if after is not None:
+            query = query.where(Visitor.chat_id > after)
+        async with factory() as session:
+            result = await session.execute(query.order_by(Visitor.chat_id).limit(batch_size))
+            chat_ids = list(result.scalars().all())
+        if not chat_ids:
+            return
+        for chat_id in chat_ids:
+            yield chat_id
+        after = chat_ids[-1]
+
+
 async def change_visitor_status(chat_id: int, status: Status):
     factory = get_session_factory()
     async with factory() as session:
         visitor = await session.get(Visitor, chat_id)
         visitor.status = status.value
+        await _notify_changed(session, chat_id)
         await session.commit()
+    get_visitor_cache().set(chat_id, visitor)
 
 
-async def change_visitor_model(chat_id: int, model: GPTModel):
+async def change_visitor_model(chat_id: int, model: str):
     factory = get_session_factory()
     async with factory() as session:
         visitor = await session.get(Visitor, chat_id)
-        visitor.model = model.value
+        visitor.model = model
+        await _notify_changed(session, chat_id)
         await session.commit()
-
-
-def get_session_factory() -> async_sessionmaker[AsyncSession]:
-    return async_sessionmaker(
-        bind=get_engine_async(),
-        expire_on_commit=False,
-    )
-
-
-def get_engine_async():
-    return create_async_engine(
-        PGSettings().db_connection_async(),
-        isolation_level="REPEATABLE READ",
-        pool_pre_ping=True
-        # echo=True
-    )
-
-
-async def start_db_async():
-    engine = get_engine_async()
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    get_visitor_cache().set(chat_id, visitor)
+
+
+async def _notify_changed(session: AsyncSession, chat_id: int) -> None:
+    """Уведомление уходит другим репликам вместе с коммитом транзакции"""
+    if get_settings().VISITOR_CACHE_NOTIFY:
+        await session.execute(select(func.pg_notify(VISITOR_CHANNEL, str(chat_id))))
+
+
+class VisitorCacheListener:
+    """
+    Держит одно соединение пула с LISTEN visitor_changed и убирает из кэша посетителей,
+    которых изменили другие реплики. После обрыва соединения переподключается
+    и сбрасывает весь кэш, потому что уведомления за время обрыва потеряны
+    """
+
+    def __init__(self, reconnect_delay: float):
+        self.reconnect_delay = reconnect_delay
+        self.invalidations = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if get_settings().VISITOR_CACHE_NOTIFY and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception as e:
+                logging.warning(f"Соединение для уведомлений об изменении посетителей потеряно: {e}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _listen(self) -> None:
+        async with get_engine_async().connect() as conn:
+            raw = await conn.get_raw_connection()
+            driver = raw.driver_connection
+            closed = asyncio.Event()
+            driver.add_termination_listener(lambda _: closed.set())
+            await driver.add_listener(VISITOR_CHANNEL, self._on_notify)
+            self._invalidate_all()
+            try:
+                await closed.wait()
+            finally:
+                if not driver.is_closed():
+                    await driver.remove_listener(VISITOR_CHANNEL, self._on_notify)
+
+    def _on_notify(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        self.invalidations += 1
+        get_visitor_cache().pop(int(payload))
+        if _admin_chat_ids is not None:
+            _admin_chat_ids.clear()
+
+    @staticmethod
+    def _invalidate_all() -> None:
+        get_visitor_cache().clear()
+        if _admin_chat_ids is not None:
+            _admin_chat_ids.clear()
+
+
+_listener: Optional[VisitorCacheListener] = None
+
+
+def get_visitor_listener() -> VisitorCacheListener:
+    global _listener
+    if _listener is None:
+        _listener = VisitorCacheListener(get_settings().VISITOR_CACHE_RECONNECT_DELAY)
+    return _listener
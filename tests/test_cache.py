@@ -0,0 +1,34 @@
+from helpers.cache import TTLCache
+
+
+def test_least_recently_used_entry_is_evicted() -> None:
+    cache: TTLCache[str, int] = TTLCache(2, 60.0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_expired_entry_is_a_miss() -> None:
+    cache: TTLCache[str, int] = TTLCache(2, 60.0)
+    cache.set("a", 1, ttl=-1.0)
+    assert cache.lookup("a") == (False, None)
+    assert len(cache) == 0
+
+
+def test_sizeof_bounds_total_size() -> None:
+    cache: TTLCache[str, bytes] = TTLCache(10, 60.0, sizeof=len)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    cache.set("a", b"12345")
+    assert cache.stats()["total_size"] == 9
+    cache.set("c", b"123")
+    assert "b" not in cache
+    assert cache.stats()["total_size"] == 8
+    cache.set("d", b"12345678901")
+    assert "d" not in cache
+    assert cache.pop("a") == b"12345"
+    assert cache.stats()["total_size"] == 3
@@ -0,0 +1,102 @@
+import re
+
+from helpers.markdown_helper import (
+    MESSAGE_LIMIT, convert_code, convert_inline, escape, fit_escaped, split_markdown, tg_len
+)
+
+# Зарезервированный символ MarkdownV2 без обратного слэша перед ним
+UNESCAPED = re.compile(r"(?<!\\)(?:\\\\)*[_*\[\]()~`>#+\-=|{}.!]")
+
+
+def outside_entities(text: str) -> str:
+    """Текст без блоков кода и без маркеров, которые конвертер ставит сам"""
+    text = re.sub(r"```.*?```", "", text, flags=re.S)
+    return re.sub(r"(?<!\\)`.*?(?<!\\)`", "", text)
+
+
+def test_escape_reserved_characters() -> None:
+    assert escape("1.5 (a+b) = c! #tag [x] {y} ~z~ |w| > q - r") == (
+        r"1\.5 \(a\+b\) \= c\! \#tag \[x\] \{y\} \~z\~ \|w\| \> q \- r"
+    )
+
+
+def test_plain_text_has_no_unescaped_reserved_characters() -> None:
+    text = convert_inline("Цена 1.5 (примерно) - a+b=c! Файл config.json, версия 3.11")
+    assert UNESCAPED.search(text) is None
+
+
+def test_entities_are_converted() -> None:
+    assert convert_inline("**жирный**, *курсив*, ~~зачеркнутый~~") == "*жирный*, _курсив_, ~зачеркнутый~"
+    assert convert_inline("[сайт](https://example.com/a_b?x=1)") == "[сайт](https://example.com/a_b?x=1)"
+
+
+def test_inline_code_escapes_only_backslash_and_backtick() -> None:
+    assert convert_inline(r"`a\b.c`") == r"`a\\b.c`"
+
+
+def test_code_block_escapes_backslash_and_backtick() -> None:
+    assert convert_code("py", 'print("`\\n`")') == '```py\nprint("\\`\\\\n\\`")\n```'
+
+
+def test_code_block_body_is_not_markdown() -> None:
+    chunks = split_markdown("Пример:\n\n```python\nx = a_b * 2  # **не жирный**\n```")
+    assert len(chunks) == 1
+    assert chunks[0].text == "Пример:\n\n```python\nx = a_b * 2  # **не жирный**\n```"
+
+
+def test_unbalanced_bold_is_escaped() -> None:
+    assert convert_inline("**незакрытый") == r"\*\*незакрытый"
+    assert convert_inline("a ** b") == r"a \*\* b"
+
+
+def test_underscores_in_identifiers_are_not_italic() -> None:
+    text = convert_inline("snake_case_name, _private_var и MAX_SIZE")
+    assert text == r"snake\_case\_name, \_private\_var и MAX\_SIZE"
+
+
+def test_tg_len_counts_utf16_units() -> None:
+    assert tg_len("abc") == 3
+    assert tg_len("привет") == 6
+    assert tg_len("😀") == 2
+
+
+def test_fit_escaped_counts_emoji_and_escapes() -> None:
+    assert fit_escaped("😀😀😀", 4) == 2
+    assert fit_escaped("a.b", 3) == 2
+    assert fit_escaped("abc", 10) == 3
+
+
+def test_split_emoji_fits_utf16_limit() -> None:
+    text = " ".join(["😀" * 10] * 1000)
+    chunks = split_markdown(text)
+    assert len(chunks) > 1
+    assert all(tg_len(chunk.text) <= MESSAGE_LIMIT for chunk in chunks)
+    assert "".join(chunk.source for chunk in chunks).replace(" ", "") == text.replace(" ", "")
+
+
+def test_split_paragraphs_fit_limit() -> None:
+    text = "\n\n".join(f"Абзац {i}. " + "слово " * 50 for i in range(200))
+    chunks = split_markdown(text)
+    assert len(chunks) > 1
+    assert all(tg_len(chunk.text) <= MESSAGE_LIMIT for chunk in chunks)
+
+
+def test_split_does_not_break_code_fence() -> None:
+    code = "\n".join(f"line_{i} = {i}" for i in range(20))
+    text = "Текст. " * 580 + "\n\n```python\n" + code + "\n```"
+    chunks = split_markdown(text)
+    assert len(chunks) > 1
+    assert sum(f"```python\n{code}\n```" in chunk.text for chunk in chunks) == 1
+    for chunk in chunks:
+        assert tg_len(chunk.text) <= MESSAGE_LIMIT
+        assert chunk.text.count("```") % 2 == 0
+
+
+def test_long_code_block_is_split_into_closed_fences() -> None:
+    code = "\n".join(f"value_{i} = '{'x' * 60}'" for i in range(200))
+    chunks = split_markdown(f"```python\n{code}\n```")
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert tg_len(chunk.text) <= MESSAGE_LIMIT
+        assert chunk.text.startswith("```python\n") and chunk.text.endswith("\n```")
+    assert UNESCAPED.search(outside_entities(chunks[0].text)) is None
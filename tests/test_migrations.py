@@ -0,0 +1,115 @@
+"""
+Миграции на живом Postgres из настроек PGSettings (.env или переменные окружения).
+Тесты создают и удаляют отдельную базу, а без доступного сервера пропускаются.
+"""
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable
+
+import pytest
+from pydantic import ValidationError
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table, func, inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from config.settings import PGSettings
+from service import database
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Таблица visitor в том виде, в каком ее создавал create_all исходной версии бота
+baseline = MetaData()
+Table(
+    "visitor",
+    baseline,
+    Column("chat_id", BigInteger, primary_key=True),
+    Column("is_admin", Boolean, nullable=False),
+    Column("model", String, nullable=False),
+    Column("status", Integer, nullable=False),
+    Column("user_id", BigInteger),
+    Column("full_name", String),
+    Column("username", String),
+    Column("comment", String),
+    Column("created_at", DateTime, server_default=func.now()),
+    Column("updated_at", DateTime, server_default=func.now()),
+)
+
+BOT_TABLES = {
+    "visitor", "token_usage", "conversation_state", "conversation_transcript",
+    "response_cache", "fsm_state", "research_job",
+}
+
+
+def run_on_test_database(
+        monkeypatch: pytest.MonkeyPatch,
+        scenario: Callable[[AsyncEngine], Awaitable[None]]
+) -> None:
+    """Создает пустую базу, запускает в ней scenario и удаляет базу"""
+    try:
+        settings = PGSettings()
+    except ValidationError:
+        pytest.skip("Не заданы настройки Postgres")
+    name = f"bot_migrations_{uuid.uuid4().hex[:8]}"
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setenv("POSTGRES_DB", name)
+
+    @asynccontextmanager
+    async def test_database() -> AsyncIterator[None]:
+        engine = create_async_engine(settings.db_connection_async(), isolation_level="AUTOCOMMIT")
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text(f'CREATE DATABASE "{name}"'))
+        except (OSError, DBAPIError):
+            await engine.dispose()
+            pytest.skip("Postgres недоступен")
+        try:
+            yield
+        finally:
+            await database.dispose_db_async()
+            async with engine.connect() as conn:
+                await conn.execute(text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+            await engine.dispose()
+
+    async def run() -> None:
+        async with test_database():
+            await scenario(database.init_db_engine())
+
+    asyncio.run(run())
+
+
+async def schema_state(engine: AsyncEngine) -> tuple[set[str], set[str], str]:
+    async with engine.connect() as conn:
+        tables = set(await conn.run_sync(lambda sync: inspect(sync).get_table_names()))
+        indexes = {index["name"] for index in await conn.run_sync(lambda sync: inspect(sync).get_indexes("visitor"))}
+        revision = (await conn.execute(text("SELECT version_num FROM alembic_version"))).scalar_one()
+    return tables, indexes, revision
+
+
+def test_baseline_schema_is_stamped_and_upgraded(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario(engine: AsyncEngine) -> None:
+        async with engine.begin() as conn:
+            await conn.run_sync(baseline.create_all)
+            await conn.execute(text("INSERT INTO visitor VALUES (1, false, 'gpt-4o-mini', 3, 1)"))
+        await database.start_db_async()
+        tables, indexes, revision = await schema_state(engine)
+        assert BOT_TABLES <= tables
+        assert {"visitor_status_chat_id_idx", "visitor_username_lower_idx"} <= indexes
+        assert revision == database.SCHEMA_REVISION
+        async with engine.connect() as conn:
+            assert (await conn.execute(text("SELECT count(*) FROM visitor"))).scalar_one() == 1
+
+    run_on_test_database(monkeypatch, scenario)
+
+
+def test_empty_database_is_upgraded_to_head(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def scenario(engine: AsyncEngine) -> None:
+        await database.start_db_async()
+        tables, _, revision = await schema_state(engine)
+        assert BOT_TABLES <= tables
+        assert revision == database.SCHEMA_REVISION
+        # Второй старт видит актуальную версию и ничего не делает
+        await database.start_db_async()
+
+    run_on_test_database(monkeypatch, scenario)